@@ -6,23 +6,29 @@ import torch
 import torch.utils.data
 from torch import nn
 from module.optimizers import Optimizer
+from module import quantization
 from torch.nn import functional as F
 from module.losses import x_loss, mse_loss, categorical_loss
 from utils.save_load import LossRecorder, available_results, develop_starred_methods, MissingKeys
 from utils.save_load import DeletedModelError, NoModelError, StateFileNotFoundError
+from utils.save_load import eval_cache
 from utils.misc import make_list
-from module.vae_layers import Encoder, Classifier, Sigma, build_de_conv_layers, find_input_shape
+from module.vae_layers import Encoder, Classifier, Sigma, build_de_conv_layers, find_input_shape, fused_for_eval
 from module.vae_layers import onehot_encoding
 import tempfile
 import shutil
 import random
+from itertools import chain, islice
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import utils.torch_load as torchdl
-from utils.torch_load import choose_device, collate
+from utils.torch_load import choose_device, collate, interleaved_batches
 from utils import save_load
 import numpy as np
 
-from utils.roc_curves import roc_curve, fpr_at_tpr
+from utils.roc_curves import roc_curve, fpr_at_tpr, count_in, precision_recall_curve
 # from sklearn.metrics import auc, roc_curve
 
 from utils.print_log import EpochOutput
@@ -30,6 +36,7 @@ from utils.print_log import EpochOutput
 from utils.parameters import get_args
 
 from utils.signaling import SIGHandler
+from utils import distributed
 
 import os.path
 import time
@@ -57,6 +64,16 @@ class EmptyShell(object):
         super().__init__()
 
 
+def _with_layers_fused_for_eval(method):
+
+    @wraps(method)
+    def wrapper(self, *a, **kw):
+        with self.layers_fused_for_eval():
+            return method(self, *a, **kw)
+
+    return wrapper
+
+
 class ClassificationVariationalNetwork(nn.Module):
     r"""Creates a network
 
@@ -207,6 +224,7 @@ class ClassificationVariationalNetwork(nn.Module):
         logging.debug('y is%s coded', '' if self.y_is_coded else ' not')
 
         self._measures = {}
+        self._fused_layers = None
 
         if self.y_is_decoded:
             self.classifier_type = 'linear'
@@ -445,7 +463,8 @@ class ClassificationVariationalNetwork(nn.Module):
             x_features = x
 
         if x_features is None:
-            x_features = self.features(x.view(-1, *self.input_shape)).view(*batch_shape, *f_shape)
+            features = self.layer_for_eval('features')
+            x_features = features(x.view(-1, *self.input_shape)).view(*batch_shape, *f_shape)
 
         return self.forward_from_features(x_features,
                                           None if y is None else y.view(
@@ -490,7 +509,7 @@ class ClassificationVariationalNetwork(nn.Module):
         if not self.is_vib:
             u = self.decoder(z)
             # x_output of size LxN1x...xKgxD
-            x_ = self.imager(u.view(-1, *self.imager.input_shape))
+            x_ = self.layer_for_eval('imager')(u.view(-1, *self.imager.input_shape))
 
         if self.classifier_type in ('linear', None):
             # y_output = self.classifier(z_mean.unsqueeze(0))  # for classification on the means
@@ -528,6 +547,7 @@ class ClassificationVariationalNetwork(nn.Module):
                  kl_var_weighting=1.,
                  gamma_weighting=1,
                  z_output=False,
+                 update_sigma=True,
                  **kw):
         """x input of size (N1, .. ,Ng, D1, D2,..., Dt)
 
@@ -546,20 +566,7 @@ class ClassificationVariationalNetwork(nn.Module):
 
         """
         y_in_input = y is not None
-        x_repeated_along_classes = self.y_is_coded and not y_in_input
-        losses_computed_for_each_class = (self.losses_might_be_computed_for_each_class
-                                          and not y_in_input)
-
-        y_is_built = losses_computed_for_each_class
-
-        compute_iws = not self.training
-
-        cross_y_weight = False
-        if self.y_is_decoded:
-            if self.is_cvae or self.is_vae:
-                cross_y_weight = gamma_weighting * self.gamma if self.training else False
-            else:
-                cross_y_weight = gamma_weighting * self.gamma
+        y_is_built = self.losses_might_be_computed_for_each_class and not y_in_input
 
         if not batch:
             # print('*** training:', self.training)
@@ -568,6 +575,42 @@ class ClassificationVariationalNetwork(nn.Module):
                           'y {}in input'.format('' if y_in_input else '*not* '))
             pass
 
+        y, o = self.forward_for_evaluation(x, y, **kw)
+
+        return self.evaluate_from_forward(x, y, o,
+                                          y_is_built=y_is_built,
+                                          batch=batch,
+                                          current_measures=current_measures,
+                                          with_beta=with_beta,
+                                          kl_var_weighting=kl_var_weighting,
+                                          gamma_weighting=gamma_weighting,
+                                          z_output=z_output,
+                                          update_sigma=update_sigma)
+
+    def labels_for_each_class(self, y_shape, device=None):
+        """create a C * N1 * ... * Ng y tensor y[c,:,:,:...] = c
+
+        """
+        C = self.num_labels
+        y_shape_per_class = (1,) + tuple(y_shape)
+        return torch.cat([c * torch.ones(y_shape_per_class,
+                                         dtype=int,
+                                         device=device)
+                          for c in range(C)], dim=0)
+
+    def forward_for_evaluation(self, x, y=None, **kw):
+        """Network part of evaluate: features, encoder, sampling, decoder,
+        imager and classifier.
+
+        Returns y (built along classes if losses are computed for each
+        class) and the outputs of forward, to be fed to
+        evaluate_from_forward
+
+        """
+        y_in_input = y is not None
+        x_repeated_along_classes = self.y_is_coded and not y_in_input
+        y_is_built = self.losses_might_be_computed_for_each_class and not y_in_input
+
         C = self.num_labels
 
         if self.features:
@@ -577,7 +620,7 @@ class ClassificationVariationalNetwork(nn.Module):
                 batch_shape = (1,)
             else:
                 batch_shape = x.shape[:-self.input_dim]
-            t = self.features(x.view(-1, *self.input_shape)).view(*batch_shape, *f_shape)
+            t = self.layer_for_eval('features')(x.view(-1, *self.input_shape)).view(*batch_shape, *f_shape)
 
         else:
             t = x
@@ -591,12 +634,7 @@ class ClassificationVariationalNetwork(nn.Module):
             t = t.expand(C, *t_shape)
 
         if y_is_built:
-            # create a C * N1 * ... * Ng y tensor y[c,:,:,:...] = c
-            y_shape_per_class = (1,) + y_shape
-            y = torch.cat([c * torch.ones(y_shape_per_class,
-                                          dtype=int,
-                                          device=x.device)
-                           for c in range(C)], dim=0)
+            y = self.labels_for_each_class(y_shape, device=x.device)
             y_shape = y.shape
 
         y_in = y.view(y_shape) if self.y_is_coded else None
@@ -606,6 +644,36 @@ class ClassificationVariationalNetwork(nn.Module):
                          sigma_out=True,
                          **kw)
 
+        return y, o
+
+    def evaluate_from_forward(self, x, y, o,
+                              y_is_built=False,
+                              batch=0,
+                              current_measures=None,
+                              with_beta=False,  #
+                              kl_var_weighting=1.,
+                              gamma_weighting=1,
+                              z_output=False,
+                              update_sigma=True):
+        """Losses part of evaluate, o being the outputs of
+        forward_for_evaluation. Only the prior (kl and log density)
+        depends on the current prior, hence the same o may be scored
+        under different priors.
+
+        If not update_sigma, sigma is left as is when training and the
+        mean mse of the batch is returned in measures as batch_mse
+        (for sigma to be updated once for several micro batches).
+
+        """
+        compute_iws = not self.training
+
+        cross_y_weight = False
+        if self.y_is_decoded:
+            if self.is_cvae or self.is_vae:
+                cross_y_weight = gamma_weighting * self.gamma if self.training else False
+            else:
+                cross_y_weight = gamma_weighting * self.gamma
+
         x_reco, y_est, mu, log_var, z, eps_norm, sigma_coded = o
         # print('*** eps norm:', *eps_norm.shape)
 
@@ -662,7 +730,7 @@ class ClassificationVariationalNetwork(nn.Module):
             if self.sigma.is_rmse:
                 if not batch and False:
                     print('**** wmse', *weighted_mse_loss_sampling.shape,
-                          '({})'.format(mode))
+                          '({})'.format('training' if self.training else 'eval'))
                 sigma2_ = weighted_mse_loss_sampling.mean(0)
                 sigma_ = sigma2_.sqrt()
                 log_sigma = sigma_.log().squeeze()
@@ -765,7 +833,10 @@ class ClassificationVariationalNetwork(nn.Module):
             batch_wmse = batch_quants['wmse']
             D = np.prod(self.input_shape)
 
-            if self.training:
+            if self.training and not update_sigma:
+                total_measures['batch_mse'] = batch_quants['mse'].mean().detach()
+
+            elif self.training:
                 self.sigma.update(rmse=batch_quants['mse'].mean().sqrt())
                 # if not batch: print('**** sigma', ' -- '.join(f'{k}:{v}' for k, v in self.sigma.params.items()))
                 self.training_parameters['sigma'] = self.sigma.params
@@ -1184,6 +1255,34 @@ class ClassificationVariationalNetwork(nn.Module):
         #     print('*** test measures set:', *d)
         self._test_measures = d
 
+    @ contextmanager
+    def layers_fused_for_eval(self):
+        """Within the context, in eval mode, features and imager are run
+        as copies with batch norms folded in convs, in channels last
+        format. Modules themselves (and their states) are untouched.
+
+        """
+        fused_layers = self._fused_layers
+        if fused_layers is None:
+            self._fused_layers = {}
+        try:
+            yield
+        finally:
+            self._fused_layers = fused_layers
+
+    def layer_for_eval(self, name):
+
+        layer = getattr(self, name)
+        if self.training or self._fused_layers is None or layer is None:
+            return layer
+
+        # copies are made again if weights have been moved or modified
+        key = (id(layer), *((_.data_ptr(), _._version) for _ in chain(layer.parameters(), layer.buffers())))
+        if self._fused_layers.get(name, (None,))[0] != key:
+            self._fused_layers[name] = (key, fused_for_eval(layer))
+        return self._fused_layers[name][1]
+
+    @ _with_layers_fused_for_eval
     def accuracy(self, testset=None,
                  batch_size=100,
                  num_batch='all',
@@ -1196,13 +1295,23 @@ class ClassificationVariationalNetwork(nn.Module):
                  epoch='last',
                  from_where='all',
                  epoch_tolerance=0,
+                 quantized=False,
                  log=True):
         """return detection rate.
         method can be a list of methods
 
+        if quantized, computed (on cpu) by the int8 copy of the model,
+        without updating results of self
+
         """
         MAX_SAMPLE_SAVE = 200
 
+        if quantized:
+            return self.quantized().accuracy(testset, batch_size=batch_size, num_batch=num_batch,
+                                             method=method, print_result=print_result,
+                                             update_self_testing=False, outputs=outputs,
+                                             epoch=epoch, from_where=['compute'], log=log)
+
         device = next(self.parameters()).device
 
         if not testset:
@@ -1238,6 +1347,13 @@ class ClassificationVariationalNetwork(nn.Module):
         if epoch == 'last':
             epoch = self.trained
 
+        # evaluations of the same weights are shared through the cache
+        cache_keys = {}
+        if recorder is None and not shuffle and sample_dirs and epoch == self.trained and eval_cache.get_dir():
+            cache_keys = eval_cache.keys(self, testset)
+            eval_cache.restore(cache_keys, sample_dirs[0])
+            recorder = LossRecorder(batch_size)
+
         froms = available_results(self, testset=testset_name,
                                   oodsets=[],
                                   predict_methods=predict_methods,
@@ -1403,6 +1519,9 @@ class ClassificationVariationalNetwork(nn.Module):
                 logging.debug(f'Saving recorder in {f}')
                 recorder.save(f)
 
+            if cache_keys:
+                eval_cache.store(cache_keys[testset.name], testset.name, f)
+
         if not recorded:
             saved_dict = {
                 'losses': {m: batch_losses[m][:MAX_SAMPLE_SAVE] for m in batch_losses},
@@ -1452,6 +1571,27 @@ class ClassificationVariationalNetwork(nn.Module):
 
         return acc[m] if only_one_method else acc
 
+    def odin_softmax(self, x):
+        """ODIN max softmax of x (requiring grad) for all temperatures and
+        perturbations
+
+        """
+        odin_softmax = {}
+        for T in self.ODIN_TEMPS:
+            with torch.enable_grad():
+                _, no_temp_logits = self.forward(x, z_output=False)
+                softmax = (no_temp_logits[1:].mean(0) / T).softmax(-1).max(-1)[0]
+                X = softmax.sum()
+            X.backward()
+            dx = x.grad.sign()
+            for eps in self.ODIN_EPS:
+                _, odin_logits = self.forward(x + eps * dx, z_output=False)
+                out_probs = (odin_logits[1:].mean(0) / T).softmax(-1).max(-1)[0]
+                odin_softmax['odin-{:.0f}-{:.4f}'.format(T, eps)] = out_probs
+
+        return odin_softmax
+
+    @ _with_layers_fused_for_eval
     def ood_detection_rates(self, oodsets=None,
                             testset=None,
                             batch_size=100,
@@ -1465,8 +1605,17 @@ class ClassificationVariationalNetwork(nn.Module):
                             from_where='all',
                             sample_dirs=[],
                             sample_recorders=None,
+                            quantized=False,
                             log=True):
 
+        if quantized:
+            return self.quantized().ood_detection_rates(oodsets=oodsets, testset=testset,
+                                                        batch_size=batch_size, num_batch=num_batch,
+                                                        method=method, print_result=print_result,
+                                                        update_self_ood=False, epoch=epoch,
+                                                        outputs=outputs, from_where=['compute'],
+                                                        log=log)
+
         if epoch == 'last':
             epoch = self.trained
 
@@ -1499,6 +1648,14 @@ class ClassificationVariationalNetwork(nn.Module):
         ood_methods_per_set = {s: ood_methods for s in all_set_names}
         all_ood_methods = ood_methods
 
+        # evaluations of the same weights are shared through the cache
+        cache_keys = {}
+        if (recorders is None and not sample_recorders and num_batch == 'all' and sample_dirs
+                and epoch == self.trained and eval_cache.get_dir()):
+            cache_keys = eval_cache.keys(self, testset, *oodsets)
+            eval_cache.restore(cache_keys, sample_dirs[0])
+            recorders = {}
+
         if recorders == {}:
             recorders = {n: LossRecorder(batch_size) for n in all_set_names}
 
@@ -1642,25 +1799,7 @@ class ClassificationVariationalNetwork(nn.Module):
                             sample_recorders[s].append_batch(**batch_samples)
 
                     _test_measures.append({k: testset_measures[k] for k in testset_measures})
-                    odin_softmax = {}
-                    if odin_parameters:
-                        for T in self.ODIN_TEMPS:
-                            with torch.enable_grad():
-                                _, no_temp_logits = self.forward(
-                                    x, z_output=False)
-                                softmax = (no_temp_logits[1:].mean(
-                                    0) / T).softmax(-1).max(-1)[0]
-                                X = softmax.sum()
-                            # print('***', X.requires_grad, (X / batch_size).cpu().item())
-                            X.backward()
-                            dx = x.grad.sign()
-                            for eps in self.ODIN_EPS:
-                                _, odin_logits = self.forward(
-                                    x + eps * dx, z_output=False)
-                                out_probs = (odin_logits[1:].mean(
-                                    0) / T).softmax(-1).max(-1)[0]
-                                odin_softmax['odin-{:.0f}-{:.4f}'.format(
-                                    T, eps)] = out_probs
+                    odin_softmax = self.odin_softmax(x) if odin_parameters else {}
                 else:
                     components = [k for k in recorders[s].keys()
                                   if k in self.loss_components or k.startswith('odin')]
@@ -1725,6 +1864,9 @@ class ClassificationVariationalNetwork(nn.Module):
 
                     recorders[s].save(f.format(s=s))
 
+                if s in cache_keys:
+                    eval_cache.store(cache_keys[s], s, f)
+
                 recorded[s] = True
                 recording[s] = False
 
@@ -1739,164 +1881,181 @@ class ClassificationVariationalNetwork(nn.Module):
                      'std': np.nan
                      }
 
-        for oodset in [_ for _ in oodsets if _] + [testset] if oodsets else []:
+        def roc_curves(ind_measures, ood_measures, methods):
+            rocs = {}
+            for m in methods:
+                two_sided = False
+                if m.endswith('-2s'):
+                    two_sided = 'around-mean'
+                if '-a-' in m:
+                    two_sided = tuple(int(_) for _ in m.split('-')[-2:])
+                rocs[m] = roc_curve(ind_measures[m], ood_measures[m], *kept_tpr, two_sided=two_sided)
+            return rocs
 
-            s = oodset.name
-            ood_n_batch = num_batch[s]
+        if oodsets:
 
-            ood_results[s] = {m: copy.deepcopy(
-                no_result) for m in ood_methods_per_set[s]}
-            ood_measures = {m: np.ndarray(0) for m in ood_methods_per_set[s]}
+            # roc curves are computed in the background while next sets are evaluated
+            executor = ThreadPoolExecutor(max_workers=2)
+            rocs = {}
 
-            fpr_ = {}
-            tpr_ = {}
-            thresholds_ = {}
-            auc_ = {}
-            r_ = {}
+            ood_measures = {s: {m: [] for m in ood_methods_per_set[s]} for s in all_set_names}
+            ood_measures[testset.name] = ind_measures
 
-            if recorders[s] is not None:
-                recorders[s].init_seed_for_dataloader()
+            rocs[testset.name] = executor.submit(roc_curves, ind_measures, ind_measures,
+                                                 ood_methods_per_set[testset.name])
 
-            loader = torch.utils.data.DataLoader(oodset,
-                                                 num_workers=0,
-                                                 collate_fn=collate,
-                                                 shuffle=shuffle[s],
-                                                 batch_size=batch_size[s])
+            def finish(s):
+                ood_measures[s] = {m: np.concatenate([np.ndarray(0), *ood_measures[s][m]])
+                                   for m in ood_methods_per_set[s]}
+                rocs[s] = executor.submit(roc_curves, ind_measures, ood_measures[s], ood_methods_per_set[s])
 
-            _s = 'Computing for set {o} ({n}) with {b} batches of {k} images'
-            logging.debug(_s.format(o=oodset.name, b=ood_n_batch,
-                                    k=batch_size[s], n=len(oodset)))
+                if s in sample_recorders:
+                    sample_recorders[s].flush()
 
-            t_0 = time.time()
-            test_iterator = iter(loader)
+                if recording[s]:
+                    recorders[s].flush()
+                    for d in sample_dirs:
+                        f = os.path.join(d, f'record-{s}.pth')
+                        recorders[s].save(f.format(s=s))
+                    if s in cache_keys:
+                        eval_cache.store(cache_keys[s], s, f)
+                    recorded[s] = True
+                    recording[s] = False
+
+            for oodset in [_ for _ in oodsets if recorded[_.name]]:
+
+                s = oodset.name
+                components = [k for k in recorders[s].keys()
+                              if k in self.loss_components or k.startswith('odin')]
+
+                for i in range(num_batch[s]):
+                    losses = recorders[s].get_batch(i, *components)
+                    logits = recorders[s].get_batch(i, 'logits').T
+                    measures = self.batch_dist_measures(logits, losses, ood_methods_per_set[s])
+                    for m in ood_methods_per_set[s]:
+                        ood_measures[s][m].append(measures[m].cpu().numpy())
 
-            n_samples = 0
-            for i in range(ood_n_batch):
+                finish(s)
 
-                if not recorded[s]:
-                    data = next(test_iterator)
-                    x = data[0].to(device)
-                    y = data[1].to(device)
-                    if odin_parameters:
-                        x.requires_grad_(True)
+            # sets to be evaluated are interleaved in one stream of full batches
+            computed_sets = [_ for _ in oodsets if not recorded[_.name]]
+            iterators = {}
 
-                    with torch.no_grad():
-                        _, logits, losses, testset_measures, mu, log_var, z = self.evaluate(x,
-                                                                                            batch=i,
-                                                                                            z_output=True)
+            for oodset in computed_sets:
+                s = oodset.name
+                if recorders[s] is not None:
+                    recorders[s].init_seed_for_dataloader()
 
-                        if sample_recorders and s in sample_recorders:
-                            if 'mu' in sample_recorders[s]:
-                                sample_recorders[s].append_batch(mu=mu)
+                loader = torch.utils.data.DataLoader(oodset,
+                                                     num_workers=0,
+                                                     collate_fn=collate,
+                                                     shuffle=shuffle[s],
+                                                     batch_size=batch_size[s])
+                loader = islice(loader, num_batch[s])
+                # first batch is drawn while seed is set
+                first_batch = next(loader, None)
+                iterators[s] = chain([first_batch] if first_batch is not None else [], loader)
 
-                    odin_softmax = {}
-                    if odin_parameters:
-                        for T in self.ODIN_TEMPS:
-                            with torch.enable_grad():
-                                _, no_temp_logits = self.forward(
-                                    x, z_output=False)
-                                softmax = (no_temp_logits[1:].mean(
-                                    0) / T).softmax(-1).max(-1)[0]
-                                X = softmax.sum()
-                            # print('***', X.requires_grad, (X / batch_size).cpu().item())
-                            X.backward()
-                            dx = x.grad.sign()
-                            for eps in self.ODIN_EPS:
-                                _, odin_logits = self.forward(
-                                    x + eps * dx, z_output=False)
-                                out_probs = (odin_logits[1:].mean(
-                                    0) / T).softmax(-1).max(-1)[0]
-                                odin_softmax['odin-{:.0f}-{:.4f}'.format(
-                                    T, eps)] = out_probs
+                if recorders[s] is not None:
+                    recorders[s].restore_seed()
 
-                else:
-                    components = [k for k in recorders[s].keys()
-                                  if k in self.loss_components or k.startswith('odin')]
-                    losses = recorders[s].get_batch(i, *components)
-                    logits = recorders[s].get_batch(i, 'logits').T
-                    odin_softmax = {}
+                _s = 'Computing for set {o} ({n}) with {b} batches of {k} images'
+                logging.debug(_s.format(o=s, b=num_batch[s], k=batch_size[s], n=len(oodset)))
 
-                if recording[s]:
-                    recorders[s].append_batch(
-                        **losses, **odin_softmax, y_true=y, logits=logits.T)
+            stream_recorder = next((recorders[_.name] for _ in computed_sets if recorders[_.name] is not None), None)
+            if stream_recorder is not None:
+                stream_recorder.init_seed_for_dataloader()
 
-                # logging.info('batch {}/{} losses for {} '.format(i, ood_n_batch, s) + ' - '.join(losses))
-                measures = self.batch_dist_measures(logits, dict(**losses, **odin_softmax),
-                                                    ood_methods_per_set[s])
+            stream_batch_size = batch_size[testset.name]
+            n_stream_samples = sum(min(len(_), num_batch[_.name] * batch_size[_.name]) for _ in computed_sets)
+            n_stream_batches = int(np.ceil(n_stream_samples / stream_batch_size))
 
-                for m in ood_methods_per_set[s]:
-                    ood_measures[m] = np.concatenate([ood_measures[m],
-                                                      measures[m].cpu()])
+            sums = {s: {m: 0. for m in ood_methods_per_set[s]} for s in iterators}
+            n_samples = {s: 0 for s in iterators}
 
-                t_i = time.time() - t_0
-                t_per_i = t_i / (i + 1)
-                meaned_measures = {m: ood_measures[m].mean()
-                                   for m in ood_methods_per_set[s]}
+            t_0 = time.time()
 
-                t0 = time.time()
+            for i, (x, y, segments) in enumerate(interleaved_batches(iterators, stream_batch_size)):
+
+                x = x.to(device)
+                y = y.to(device)
+                if odin_parameters:
+                    x.requires_grad_(True)
+
+                with torch.no_grad():
+                    _, logits, losses, _, mu, log_var, z = self.evaluate(x, batch=i, z_output=True)
+
+                odin_softmax = self.odin_softmax(x) if odin_parameters else {}
+
+                measures = self.batch_dist_measures(logits, dict(**losses, **odin_softmax), ood_methods)
+
+                for s, start, end, last in segments:
+
+                    if s in sample_recorders and 'mu' in sample_recorders[s]:
+                        sample_recorders[s].append_samples(mu=mu[start:end])
+
+                    if recording[s]:
+                        recorded_tensors = dict(**losses, **odin_softmax, y_true=y, logits=logits.T)
+                        recorders[s].append_samples(**{k: t[..., start:end] for k, t in recorded_tensors.items()})
 
-                if not (recorded[s] or i % 100) or i == ood_n_batch - 1:
                     for m in ood_methods_per_set[s]:
-                        logging.debug(
-                            f'Computing roc curves for with metrics {m}')
-                        _debug = 'medium' if i == ood_n_batch - 1 else 'soft'
-                        _debug = False
-                        two_sided = False
-                        if m.endswith('-2s'):
-                            two_sided = 'around-mean'
-                        if '-a-' in m:
-                            two_sided = tuple(int(_)
-                                              for _ in m.split('-')[-2:])
-
-                        # print('***',s, m, two_sided)
-                        auc_[m], fpr_[m], tpr_[m], thresholds_[m] = roc_curve(ind_measures[m], ood_measures[m],
-                                                                              *kept_tpr,
-                                                                              debug=_debug,
-                                                                              two_sided=two_sided)
-                        # print('*** fpr at tpr', s, m)
-                        for _, __ in zip(fpr_[m], tpr_[m]):
-                            pass
-                            # print('{:.2%} : {:.2%}'.format(_, __))
-                        r_[m] = fpr_at_tpr(fpr_[m],
-                                           tpr_[m],
-                                           0.95,
-                                           thresholds_[m])
-
-                    outputs.results(i, ood_n_batch, 0, 1,
-                                    metrics=meaned_measures,
-                                    fpr=r_,
-                                    time_per_i=t_per_i,
-                                    batch_size=batch_size[s],
-                                    preambule=oodset.name)
+                        ood_measures[s][m].append(measures[m][start:end].cpu().numpy())
+                        sums[s][m] += ood_measures[s][m][-1].sum()
+                    n_samples[s] += end - start
 
-            if recorders[s] is not None:
-                recorders[s].restore_seed()
+                    if last:
+                        finish(s)
+
+                t_per_i = (time.time() - t_0) / (i + 1)
+
+                outputs.results(i, n_stream_batches, 0, 1,
+                                metrics={m: sums[s][m] / n_samples[s] for m in ood_methods_per_set[s]},
+                                fpr={m: np.nan for m in ood_methods_per_set[s]},
+                                time_per_i=t_per_i,
+                                batch_size=stream_batch_size,
+                                preambule=s)
+
+            if stream_recorder is not None:
+                stream_recorder.restore_seed()
+
+            # empty sets
+            for s in iterators:
+                if s not in rocs:
+                    finish(s)
 
             if epoch not in self.ood_results:
                 self.ood_results[epoch] = {}
 
-            for m in ood_methods_per_set[s]:
+            for s in [_.name for _ in oodsets] + [testset.name]:
 
-                ood_results[s][m] = {'epochs': epoch,
-                                     'n': len(ood_measures[m]),
-                                     'mean': ood_measures[m].mean(),
-                                     'std': ood_measures[m].std(),
-                                     'auc': auc_[m],
-                                     'tpr': kept_tpr,
-                                     'fpr': list(fpr_[m]),
-                                     'thresholds': list(thresholds_[m])}
+                ood_results[s] = {m: copy.deepcopy(no_result) for m in ood_methods_per_set[s]}
 
-                if update_self_ood:
+                r_ = {}
+                for m, (auc, fpr, tpr, thresholds) in rocs[s].result().items():
 
-                    if oodset.name not in self.ood_results[epoch]:
-                        self.ood_results[epoch][oodset.name] = {}
-                    self.ood_results[epoch][s][m] = ood_results[s][m]
+                    ood_results[s][m] = {'epochs': epoch,
+                                         'n': len(ood_measures[s][m]),
+                                         'mean': ood_measures[s][m].mean(),
+                                         'std': ood_measures[s][m].std(),
+                                         'auc': auc,
+                                         'tpr': kept_tpr,
+                                         'fpr': list(fpr),
+                                         'thresholds': list(thresholds)}
 
-            if recording[s]:
-                for d in sample_dirs:
-                    f = os.path.join(d, f'record-{s}.pth')
+                    r_[m] = fpr_at_tpr(fpr, tpr, 0.95, thresholds)
 
-                    recorders[s].save(f.format(s=s))
+                    if update_self_ood:
+                        if s not in self.ood_results[epoch]:
+                            self.ood_results[epoch][s] = {}
+                        self.ood_results[epoch][s][m] = ood_results[s][m]
+
+                outputs.results(num_batch[s] - 1, num_batch[s], 0, 1,
+                                metrics={m: ood_results[s][m]['mean'] for m in r_},
+                                fpr=r_,
+                                batch_size=batch_size[s],
+                                preambule=s)
+
+            executor.shutdown()
 
         for s in sample_recorders:
             for sdir in sample_dirs:
@@ -1967,6 +2126,13 @@ class ClassificationVariationalNetwork(nn.Module):
         _p = 5.2
         _p_1 = 4.1
 
+        # measures do not depend on predict method
+        computed_m = [m for m in methods['miss']
+                      if any(available['recorders']['{}-{}'.format(_, m)] for _ in methods['predict'])]
+        if computed_m:
+            all_measures = self.batch_dist_measures(logits, losses, computed_m, to_cpu=True)
+            all_measures = {m: np.asarray(all_measures[m]) for m in computed_m}
+
         for predict_method in methods['predict']:
 
             m_ = ['{}-{}'.format(predict_method, _) for _ in methods['miss']]
@@ -1982,10 +2148,8 @@ class ClassificationVariationalNetwork(nn.Module):
             correct = np.asarray(y_ == y)
 
             acc = correct.sum() / (correct.sum() + missed.sum())
-            test_measures = self.batch_dist_measures(
-                logits, losses, available_m, to_cpu=True)
 
-            fpr_, tpr_, precision_, recall_, thresholds_ = {}, {}, {}, {}, {}
+            precision_, aupr_ = {}, {}
 
             logging.debug(
                 f'Acc. for method {predict_method}: ({100 * acc:{_p}f}) ****')
@@ -1993,46 +2157,28 @@ class ClassificationVariationalNetwork(nn.Module):
             max_P = 0
 
             for m in available_m:
-                measures = np.asarray(test_measures[m])
+                measures = all_measures[m]
+
+                two_sided = False
+                if m.endswith('-2s'):
+                    two_sided = 'around-mean'
+                if '-a-' in m:
+                    two_sided = tuple(int(_) for _ in m.split('-')[-2:])
 
                 auc, fpr, tpr, thr = roc_curve(measures[correct],
-                                               measures[missed], *kept_tpr, debug=False)
-
-                thr = thr['low']
-                tp, fp, tn, fn = [], [], [], []
-
-                for t in thr:
-                    pos = measures >= t
-                    neg = ~pos
-                    tp.append((pos * correct).sum())
-                    fp.append((pos * missed).sum())
-                    tn.append((neg * missed).sum())
-                    fn.append((neg * correct).sum())
-
-                    _print = True
-                    _print = False
-                    if _print:
-                        print('**** Correct: {:5} + {:5}, Missed: {:5} + {:5}'.format(tp[-1],
-                                                                                      fn[-1],
-                                                                                      tn[-1],
-                                                                                      fp[-1]),
-                              end=' ')
-                        print('**** P={:4.1f} TPR={:4.1f} FPR={:4.1f} t={}'.format(
-                            100 * tp[-1] / (tp[-1] + fp[-1]),
-                            100 * tp[-1] / (tp[-1] + fn[-1]),
-                            100 * fp[-1] / (fp[-1] + tn[-1]),
-                            t
-                        ))
+                                               measures[missed], *kept_tpr,
+                                               two_sided=two_sided, debug=False)
+
+                # correct (tp) and missed (fp) samples within thresholds of kept tprs
+                sorted_measures = {w: np.sort(measures[_]) for w, _ in zip(('correct', 'missed'), (correct, missed))}
+                tp, fp = (count_in(sorted_measures[w], thr['low'], thr['up']) for w in ('correct', 'missed'))
 
                 # print('*** fpr: {:.1f} -> {:.1f}'.format(100 * fpr[0], 100 * fpr[-1]))
                 # print('*** tpr: {:.1f} -> {:.1f}'.format(100 * tpr[0], 100 * tpr[-1]))
-                t95 = fpr_at_tpr(fpr, tpr, shown_tpr, thr,
-                                 return_threshold=True)[1]
+                i95 = np.where(np.asarray(tpr) >= shown_tpr)[0].min()
 
-                pos = measures >= t95
-                neg = ~pos
-                tp95 = (pos * correct).sum()
-                fp95 = (pos * missed).sum()
+                tp95 = tp[i95]
+                fp95 = fp[i95]
 
                 p95 = tp95 / (tp95 + fp95)
 
@@ -2041,10 +2187,11 @@ class ClassificationVariationalNetwork(nn.Module):
                 r95 = tp95 / correct.sum()
                 fpr95 = fp95 / missed.sum()
 
-                # tpr95 = p95
+                precision_[m] = tp / (tp + fp)
 
-                precision_[m] = [(t / (t + f)) for t, f in zip(tp, fp)]
-                recall_[m] = [t / correct.sum() for t in tp]
+                # areas under precision recall curves of success and error
+                aupr_[m] = {'success': precision_recall_curve(measures[correct], measures[missed])[-1],
+                            'error': precision_recall_curve(-measures[missed], -measures[correct])[-1]}
 
                 if p95 > max_P:
                     best_m = m
@@ -2069,7 +2216,8 @@ class ClassificationVariationalNetwork(nn.Module):
                     r = {'n': n, 'epochs': epoch,
                          'sampling': self._latent_samplings['eval']}
                     r.update(dict(tpr=list(tpr), fpr=list(fpr),
-                                  auc=auc, precision=list(precision_[m])))
+                                  auc=auc, precision=list(precision_[m]),
+                                  aupr_success=aupr_[m]['success'], aupr_error=aupr_[m]['error']))
                     # print(epoch, predict_method, m)
                     self.testing[epoch][predict_method][m] = r
 
@@ -2080,6 +2228,7 @@ class ClassificationVariationalNetwork(nn.Module):
                     optimizer=None,
                     epochs=50,
                     batch_size=100,
+                    micro_batch_size=None,
                     test_batch_size=100,
                     validation=4096,
                     device=None,
@@ -2152,6 +2301,16 @@ class ClassificationVariationalNetwork(nn.Module):
             self.training_parameters['validation_split_seed'] = np.random.randint(
                 0, 2 ** 12)
 
+        # processes have to share the same split and the same starting point
+        self.training_parameters['validation_split_seed'] = distributed.broadcast_object(
+            self.training_parameters['validation_split_seed'])
+        distributed.broadcast_module(self)
+
+        is_main = distributed.is_main()
+        world_size = distributed.world_size()
+        if not is_main:
+            save_dir = None
+
         trainset, testset = torchdl.get_dataset(set_name,
                                                 transformer=transformer,
                                                 data_augmentation=data_augmentation)
@@ -2180,13 +2339,25 @@ class ClassificationVariationalNetwork(nn.Module):
             'Test batch size wanted {} / max {}'.format(test_batch_size, max_batch_sizes['test']))
 
         if batch_size:
-            train_batch_size = min(batch_size, max_batch_sizes['train'])
+            train_batch_size = batch_size
         else:
             train_batch_size = max_batch_sizes['train']
             logging.info(
                 'Train batch size wanted {} / max {}'.format(train_batch_size, max_batch_sizes['train']))
 
-        logging.info('Train batch size is {}'.format(train_batch_size))
+        if world_size > 1:
+            train_batch_size = -(-train_batch_size // world_size)
+            logging.info('Train batch size is {} x {} processes'.format(train_batch_size, world_size))
+        else:
+            logging.info('Train batch size is {}'.format(train_batch_size))
+
+        # gradients are accumulated over micro batches that fit in
+        # memory, the optimizer steps once per batch of train_batch_size
+        if not micro_batch_size:
+            micro_batch_size = max_batch_sizes['train']
+        micro_batch_size = min(micro_batch_size, train_batch_size)
+        if micro_batch_size < train_batch_size:
+            logging.info('Gradients accumulated over micro batches of {}'.format(micro_batch_size))
 
         warmup_ = self.training_parameters.get('warmup', [0, 0])
         warmup_gamma_ = self.training_parameters.get('warmup_gamma', [0, 0])
@@ -2237,10 +2408,16 @@ class ClassificationVariationalNetwork(nn.Module):
         logging.debug('Length of datasets: train={}, valid={}'.format(
             len(trainset), l_valid))
 
+        if world_size > 1:
+            trainsampler = torch.utils.data.DistributedSampler(trainset, seed=seed)
+        else:
+            trainsampler = None
+
         trainloader = torch.utils.data.DataLoader(trainset,
                                                   batch_size=train_batch_size,
                                                   # pin_memory=True,
-                                                  shuffle=True,
+                                                  shuffle=trainsampler is None,
+                                                  sampler=trainsampler,
                                                   num_workers=0)
 
         if validationset:
@@ -2252,7 +2429,7 @@ class ClassificationVariationalNetwork(nn.Module):
 
         logging.debug('...done')
 
-        dataset_size = len(trainset)
+        dataset_size = len(trainsampler or trainset)
         remainder = (dataset_size % train_batch_size) > 0
         per_epoch = dataset_size // train_batch_size + remainder
 
@@ -2320,7 +2497,7 @@ class ClassificationVariationalNetwork(nn.Module):
             with torch.no_grad():
                 self.test_losses = {}
                 self.test_measures = {}
-                if oodsets and ood_detection:
+                if is_main and oodsets and ood_detection:
 
                     self.ood_detection_rates(oodsets=oodsets, testset=testset,
                                              batch_size=test_batch_size,
@@ -2330,7 +2507,7 @@ class ClassificationVariationalNetwork(nn.Module):
                                              sample_dirs=sample_dirs,
                                              print_result='*')
 
-                if full_test:
+                if is_main and full_test:
                     test_accuracy = self.accuracy(testset,
                                                   batch_size=test_batch_size,
                                                   num_batch='all',
@@ -2349,7 +2526,7 @@ class ClassificationVariationalNetwork(nn.Module):
                     history_checkpoint['test_measures'] = test_measures
                     history_checkpoint['test_loss'] = test_loss
 
-                if validation:
+                if is_main and validation:
                     validation_accuracy = self.accuracy(validationset,
                                                         batch_size=test_batch_size,
                                                         num_batch='all',
@@ -2369,7 +2546,9 @@ class ClassificationVariationalNetwork(nn.Module):
                                     (validation_accuracy, validation_measures, validation_loss)):
                         history_checkpoint['validation_' + k] = v
 
-                if signal_handler.sig > 3:
+                # all processes break at the same epoch
+                sig = distributed.reduce_max(signal_handler.sig)
+                if sig > 3:
                     logging.warning(
                         f'Abruptly breaking training loop bc of {signal_handler}')
                     break
@@ -2380,7 +2559,7 @@ class ClassificationVariationalNetwork(nn.Module):
             if epoch == epochs:
                 break
 
-            if train_accuracy:
+            if is_main and train_accuracy:
                 with torch.no_grad():
                     train_accuracy = self.accuracy(trainset,
                                                    batch_size=test_batch_size,
@@ -2397,7 +2576,8 @@ class ClassificationVariationalNetwork(nn.Module):
             train_mean_loss = {k: 0. for k in self.loss_components}
             train_total_loss = train_mean_loss.copy()
 
-            if signal_handler.sig > 3:
+            sig = distributed.reduce_max(signal_handler.sig)
+            if sig > 3:
                 logging.warning(
                     f'Abruptly breaking training loop bc of {signal_handler}')
                 break
@@ -2407,7 +2587,7 @@ class ClassificationVariationalNetwork(nn.Module):
 
             current_measures = {}
 
-            if signal_handler.sig > 2 or full_test and signal_handler.sig > 1:
+            if sig > 2 or full_test and sig > 1:
                 logging.warning(f'Breaking training loop bc of signal {signal_handler}'
                                 f' after {epoch} epochs.')
                 break
@@ -2416,6 +2596,10 @@ class ClassificationVariationalNetwork(nn.Module):
 
             self.train()
 
+            if trainsampler is not None:
+                trainsampler.set_epoch(epoch)
+
+            micro_batches = 0
             for i, data in enumerate(trainloader, 0):
 
                 # get the inputs; data is a list of [inputs, labels]
@@ -2430,28 +2614,47 @@ class ClassificationVariationalNetwork(nn.Module):
                     warmup_weighting = 1.
                     gamma_weightting = 1.
 
-                # with autograd.detect_anomaly():
-                # forward + backward + optimize
-                (_, y_est,
-                 batch_losses, measures) = self.evaluate(x, y,
-                                                         batch=i,
-                                                         with_beta=True,
-                                                         kl_var_weighting=warmup_weighting,
-                                                         gamma_weighting=gamma_weighting,
-                                                         # mse_weighting=warmup_weighting,
-                                                         current_measures=current_measures)
-
-                current_measures = measures
-                batch_loss = batch_losses['total'].mean()
-
-                L = batch_loss
-
                 for p in self.parameters():
                     if torch.isnan(p).any() or torch.isinf(p).any():
                         print('GRAD NAN')
                         sys.exit(1)
 
-                L.backward()
+                batch_losses = {}
+                batch_mse = 0.
+                for x_, y_ in zip(x.split(micro_batch_size), y.split(micro_batch_size)):
+
+                    # with autograd.detect_anomaly():
+                    # forward + backward + optimize
+                    (_, y_est,
+                     micro_losses, measures) = self.evaluate(x_, y_,
+                                                             batch=micro_batches,
+                                                             with_beta=True,
+                                                             kl_var_weighting=warmup_weighting,
+                                                             gamma_weighting=gamma_weighting,
+                                                             # mse_weighting=warmup_weighting,
+                                                             current_measures=current_measures,
+                                                             update_sigma=False)
+
+                    micro_batches += 1
+                    current_measures = measures
+
+                    # weighted for the gradient to be the one of the mean over the batch
+                    weight = len(x_) / len(x)
+                    batch_mse += measures.pop('batch_mse', 0.) * weight
+                    L = micro_losses['total'].mean() * weight
+                    L.backward()
+
+                    for k in micro_losses:
+                        batch_losses[k] = batch_losses.get(k, 0.) + micro_losses[k].mean().detach() * weight
+
+                distributed.average_gradients(self.parameters())
+                # one step of sigma per step of optimizer, from the mse
+                # of the whole batch (of all processes, for sigma not to
+                # drift apart)
+                if self.x_is_generated:
+                    batch_mse = distributed.average_dict({'mse': batch_mse})['mse']
+                    self.sigma.update(rmse=torch.as_tensor(batch_mse).sqrt())
+                    self.training_parameters['sigma'] = self.sigma.params
                 optimizer.clip(self.parameters())
                 optimizer.step()
 
@@ -2460,7 +2663,8 @@ class ClassificationVariationalNetwork(nn.Module):
                         train_total_loss[k] = 0.0
                         train_mean_loss[k] = 0.0
 
-                    train_total_loss[k] += batch_losses[k].mean().item()
+                    # no sync here, losses are formatted by outputs in background
+                    train_total_loss[k] += batch_losses[k]
                     train_mean_loss[k] = train_total_loss[k] / (i + 1)
 
                 t_per_i = (time.time() - t_start_train) / (i + 1)
@@ -2474,7 +2678,10 @@ class ClassificationVariationalNetwork(nn.Module):
                                 end_of_epoch='\n')
 
             self.eval()
-            train_measures = measures.copy()
+            train_mean_loss = {k: float(v) for k, v in train_mean_loss.items()}
+            train_mean_loss = distributed.average_dict(train_mean_loss)
+            train_measures = distributed.average_dict(measures.copy())
+            distributed.average_buffers(self)
             if train_accuracy:
                 history_checkpoint['train_accuracy'] = train_accuracy
             history_checkpoint['train_loss'] = train_mean_loss
@@ -2487,7 +2694,8 @@ class ClassificationVariationalNetwork(nn.Module):
 
             optimizer.update_lr()
 
-            if signal_handler.sig > 3:
+            sig = distributed.reduce_max(signal_handler.sig)
+            if sig > 3:
                 logging.warning(
                     f'Abruptly breaking training loop bc of {signal_handler}')
                 break
@@ -2505,7 +2713,7 @@ class ClassificationVariationalNetwork(nn.Module):
                 if not os.path.exists(d):
                     os.makedirs(d)
 
-        if oodsets and not signal_handler.sig > 1:
+        if is_main and oodsets and not signal_handler.sig > 1:
 
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -2520,7 +2728,7 @@ class ClassificationVariationalNetwork(nn.Module):
                                          sample_dirs=sample_dirs,
                                          print_result='*')
 
-        if testset and not signal_handler.sig > 1:
+        if is_main and testset and not signal_handler.sig > 1:
 
             recorder = recorders[set_name]
             # print(num_batch, sample_size)
@@ -2658,14 +2866,17 @@ class ClassificationVariationalNetwork(nn.Module):
         save_load.save_json(self.testing, dir_name, 'test.json')
         save_load.save_json(self.ood_results, dir_name, 'ood.json')
         save_load.save_json(self.train_history, dir_name, 'history.json')
+        save_load.save_json(save_load.manifest(self), dir_name, 'manifest.json')
 
         if self.trained and not except_state:
             w_p = save_load.get_path(dir_name, 'state.pth')
-            torch.save(self.state_dict(), w_p)
+            with save_load.atomic_write(w_p, 'wb') as f:
+                torch.save(self.state_dict(), f)
             # print('**** state saved')
             if not except_optimizer:
                 w_p = save_load.get_path(dir_name, 'optimizer.pth')
-                torch.save(self.optimizer.state_dict(), w_p)
+                with save_load.atomic_write(w_p, 'wb') as f:
+                    torch.save(self.optimizer.state_dict(), f)
 
         return dir_name
 
@@ -2851,6 +3062,37 @@ class ClassificationVariationalNetwork(nn.Module):
 
         return model
 
+    def quantized(self, calibration_set=None, num_batch=10, batch_size=100, save=True):
+        """Int8 copy of the model for cpu inference (see
+        module/quantization.py), loaded from the directory of the model if
+        saved from the current weights, else calibrated on
+        calibration_set (the training set if None) and saved there.
+
+        """
+        saved_dir = getattr(self, 'saved_dir', None)
+        quantized_file = os.path.join(saved_dir or '', quantization.STATE_FILE)
+        source = eval_cache.state_hash(self)
+
+        q = None
+        if saved_dir and calibration_set is None and os.path.exists(quantized_file):
+            logging.debug('Loading quantized state from {}'.format(quantized_file))
+            q = quantization.load(self, saved_dir, source=source)
+            if q is None:
+                logging.info('Quantized state in {} made from other weights'.format(saved_dir))
+
+        if q is None:
+            if calibration_set is None:
+                calibration_set, _ = torchdl.get_dataset(self.training_parameters['set'],
+                                                         transformer=self.training_parameters['transformer'],
+                                                         splits=['train'])
+            q = quantization.quantize(self, calibration_set, num_batch=num_batch, batch_size=batch_size)
+            if saved_dir and save:
+                quantization.save(q, saved_dir, source=source)
+
+        # no gradients through quantized layers
+        q.ood_methods = [m for m in q.ood_methods if not m.startswith('odin')]
+        return q
+
     def copy(self, with_state=True):
 
         s = ''.join([random.choice('0123456789abcedf') for _ in range(30)])
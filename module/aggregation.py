@@ -1,9 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 from torch.nn.functional import one_hot
 
 TEMPS = [None, 1, 5]
 NAN_TEMPS = [None, -1, 0]
 
+# max number of elements of tensors built at once for batched aggregations
+MAX_NUMEL = 2 ** 27
+
 
 def log_mean_exp(*tensors, normalize=False):
 
@@ -23,7 +28,7 @@ def posterior(logits, axis=0, temps=TEMPS):
     for _ in nan_temps:
         posterior[_] = logits.clone()
 
-    posterior.update({t: (logits / t).softmax(0) for t in temps if t not in nan_temps})
+    posterior.update({t: (logits / t).softmax(axis) for t in temps if t not in nan_temps})
 
     return posterior
 
@@ -49,66 +54,197 @@ def voting_posterior(*y, temps=[None]):
     return {t: p_y_x for t in temps}
 
 
-def compute_latent_mutual_info(pyz1, pyz2, sampling1, sampling2):
+def combinations_index(n, l, device=None):
+    """K x l tensor of the K combinations of l among n, in itertools order
+
+    """
+    return torch.combinations(torch.arange(n, device=device), l)
+
+
+def _chunks(idx, numel_per_combo, max_numel=MAX_NUMEL):
+
+    chunk_size = max(1, int(max_numel // max(numel_per_combo, 1)))
+    return idx.split(chunk_size)
+
+
+def batched_aggregated_posterior(t, idx, agg='mean', temps=TEMPS, num_labels=None):
+    """Aggregated posteriors p(y|x) of all combinations of models at once
+
+    -- t: M x C x N stacked iws (mean), zdist (joint), kl (mean~) or M x N
+       predicted labels (vote)
+
+    -- idx: K x l combinations of models
+
+    Returns y predicted on first temp (K x N) and max of posteriors
+    (dict of K x N tensors indexed by temps)
+
+    """
+    l = idx.shape[-1]
+
+    if agg == 'vote':
+        C = num_labels or int(t.max()) + 1
+        numel = l * C * t.shape[-1]
+    else:
+        numel = l * t[0].numel()
+
+    y_pred = []
+    max_p = {T: [] for T in temps}
+
+    for idx_ in _chunks(idx, numel):
+
+        if agg == 'vote':
+            p = one_hot(t[idx_], C).sum(1).transpose(-1, -2) / l
+            p_y_x = {T: p for T in temps}
+        elif agg == 'joint':
+            p_y_x = posterior(-t[idx_].sum(1) / 2, axis=1, temps=temps)
+        elif agg == 'mean':
+            p_y_x = posterior(t[idx_].logsumexp(1) - np.log(l), axis=1, temps=temps)
+        elif agg == 'mean~':
+            p_y_x = {T: p.mean(1) for T, p in posterior(-t[idx_], axis=2, temps=temps).items()}
+        else:
+            raise ValueError('{} is an unknown aggregation'.format(agg))
+
+        y_pred.append(p_y_x[temps[0]].argmax(1))
+        for T in temps:
+            max_p[T].append(p_y_x[T].max(1)[0])
+
+    return torch.cat(y_pred), {T: torch.cat(max_p[T]) for T in temps}
+
+
+def batched_log_p_x_y(iws, idx):
+    """max over y of log mean exp of p(x|y) of models of all
+    combinations (K x N)
+
+    """
+    l = idx.shape[-1]
+    return torch.cat([(iws[idx_].logsumexp(1) - np.log(l)).max(1)[0]
+                      for idx_ in _chunks(idx, l * iws[0].numel())])
+
+
+def batched_thresholds(t, tpr_l, tpr_r, mask=None):
+    """Thresholds of each row of t such as values in [thr_l, thr_r] are
+    a tpr_r - tpr_l ratio of values: sorted(t)[int(n * tpr_l)] and
+    sorted(t)[int(n * tpr_r) - 1]
+
+    -- t: K x N tensor
+
+    -- tpr_l, tpr_r: floats or K tensors
+
+    -- mask: None or K x N boolean tensor of kept values (then n depends
+       on the row)
+
+    """
+    K, N = t.shape
+
+    if mask is None and np.isscalar(tpr_l) and np.isscalar(tpr_r):
+        i_l = int(N * tpr_l) % N
+        i_r = (int(N * tpr_r) - 1) % N
+        return t.kthvalue(i_l + 1, -1)[0], t.kthvalue(i_r + 1, -1)[0]
+
+    if mask is None:
+        n = torch.full((K,), N, device=t.device)
+    else:
+        n = mask.sum(-1)
+        # masked values are sorted at the end
+        t = t.masked_fill(~mask, np.inf)
+
+    t_sorted = t.sort(-1)[0]
+
+    n_ = n.double()
+    i_l = (n_ * torch.as_tensor(tpr_l, dtype=torch.float64, device=t.device)).floor().long()
+    i_r = (n_ * torch.as_tensor(tpr_r, dtype=torch.float64, device=t.device)).floor().long() - 1
+
+    i_l = i_l.remainder(n.clamp(min=1)).expand(K)
+    i_r = i_r.remainder(n.clamp(min=1)).expand(K)
+
+    return t_sorted.gather(-1, i_l.unsqueeze(-1)).squeeze(-1), t_sorted.gather(-1, i_r.unsqueeze(-1)).squeeze(-1)
+
+
+def batched_rates(t, thr_l, thr_r, mask=None):
+    """Ratios per row of t of values in [thr_l, thr_r] (among values in
+    mask if not None), returned with the K x N booleans of values in
+
+    """
+    as_in = (t >= thr_l.unsqueeze(-1)) & (t <= thr_r.unsqueeze(-1))
+
+    if mask is None:
+        return as_in.float().mean(-1), as_in
+
+    return (as_in & mask).sum(-1) / mask.sum(-1), as_in
+
+
+def compute_latent_mutual_info(pyz1, pyz2):
+    """Mutual information of latent samplings of two models from their
+    posteriors p(y|z) of shapes ... x C x L1 x N and ... x C x L2 x N
+
+    Returns a ... x N tensor of mean over L1 x L2 of log sum_y p1.p2
+
+    """
+    return torch.einsum('...can,...cbn->...abn', pyz1, pyz2).log().mean((-3, -2))
+
+
+def pairwise_latent_mutual_info(*pyz):
+    """Mutual informations of all pairs (i, j) with j < i (in order of
+    torch.tril_indices) of M posteriors p(y|z) of shapes ... x C x L x N
+
+    Returns a ... x P x N tensor, contracted at once if all samplings are
+    of same size
 
-    pyzs = [pyz1, pyz2]
-    samplings = [sampling1, sampling2]
+    """
+    M = len(pyz)
+    i, j = torch.tril_indices(M, M, -1)
 
-    for i1 in range(2):
-        i2 = (i1 + 1) % 2
-        L1 = 'L{}'.format(i1)
-        L2 = 'L{}'.format(i2)
-        pyzs[i1] = pyzs[i1].unsqueeze(1).expand(-1, samplings[i2], -1, -1).rename('y', L2, L1, 'M')
+    if len(set(_.shape for _ in pyz)) == 1:
+        pyz = torch.stack(pyz, dim=-4)
+        return compute_latent_mutual_info(pyz[..., i, :, :, :], pyz[..., j, :, :, :])
 
-    pyzs[1] = pyzs[1].align_as(pyzs[0])
+    return torch.stack([compute_latent_mutual_info(pyz[i_], pyz[j_])
+                        for i_, j_ in zip(i.tolist(), j.tolist())], dim=-2)
 
-    Im = (pyzs[0] * pyzs[1]).sum('y').log().mean(('L0', 'L1'))
 
-    return Im
+def ensemble_map(func, models, *a, **kw):
+    """Concurrently apply func(m, *a, **kw) to independent models (ops
+    release the GIL, so forwards of models run in parallel)
 
+    """
+    grad_enabled = torch.is_grad_enabled()
 
-def latent_mutual_info(m1, m2, x, y, temps=[1]):
+    def _func(m):
+        with torch.set_grad_enabled(grad_enabled):
+            return func(m, *a, **kw)
 
-    assert m1.is_cvae
-    assert m2.is_cvae
-    assert m1.input_shape == m2.input_shape
-    assert m1.num_labels == m2.num_labels
-    models = {0: m1, 1: m2}
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        return list(executor.map(_func, models))
 
-    sampling = {_: models[_].latent_sampling for _ in models}
 
-    C = m1.num_labels
-    z = {}
-    muz = {}
-    y_ = {}
-    pyz = {}
+def latent_log_density_per_class(m, x):
+    """log p(z|y) for all y of z sampled from q(z|x) by m: C x L x N
 
-    stacked_y = {_: torch.stack([c * torch.ones((sampling[_], len(x)),
-                                                dtype=int,
-                                                device=x.device)
-                                 for c in range(C)], dim=0)
-                 for _ in models}
+    """
+    z = m.forward(x)[-1][1:]
+    y = m.labels_for_each_class(z.shape[:-1], device=x.device)
 
-    for _ in models:
-        m = models[_]
+    return m.encoder.prior.log_density(z.expand(m.num_labels, *z.shape), y)
 
-        outs = m.forward(x)
 
-        # z is of shape LxMxK
-        z[_] = outs[-1][1:]
+def latent_mutual_info(models, x, y=None, temps=[1]):
+    """Mutual informations of all pairs of models (P x N tensors indexed
+    by temps) and labels predicted by first model
 
-        z = z[_].expand(C, *z[_].shape)
-        muz[_] = outs[-2]
+    """
+    m1 = models[0]
+    for m in models:
+        assert m.is_cvae
+        assert m.input_shape == m1.input_shape
+        assert m.num_labels == m1.num_labels
 
-        # names: 'y', thisL, 'M'
-        logpzy = m.encoder.prior.log_density(z, stacked_y[_])
+    logpzy = ensemble_map(latent_log_density_per_class, models, x)
 
-        pyz[_] = {T: (logpzy / T).softmax(0) for T in temps}
-        y_[_] = logpzy.mean(1).argmax(0)
+    pyz = [torch.stack([(_ / T).softmax(0) for T in temps]) for _ in logpzy]
 
-    Im = {T: compute_latent_mutual_info(pyz[0][T], pyz[1][T], sampling[0], sampling[1]) for T in temps}
+    Im = dict(zip(temps, pairwise_latent_mutual_info(*pyz)))
 
-    return Im, y_[0]
+    return Im, logpzy[0].mean(1).argmax(0)
 
 
 if __name__ == '__main__':
@@ -125,7 +261,7 @@ if __name__ == '__main__':
     from cvae import ClassificationVariationalNetwork as M
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('jobs', nargs=2, type=int)
+    parser.add_argument('jobs', nargs='+', type=int)
     parser.add_argument('--job-dir', default='parallel-jobs')
     parser.add_argument('-v', action='count', default=0)
     parser.add_argument('--device', default='cuda')
@@ -146,14 +282,14 @@ if __name__ == '__main__':
 
     models = find_by_job_number(*jobs, load_state=False, build_module=True)
 
-    assert len(models) == 2
+    assert len(models) == len(jobs) > 1
 
     params = {}
 
     for k in ('set', 'transformer'):
         params[k] = models[jobs[0]][k]
         logging.info('{:12}: {}'.format(k, params[k]))
-        assert params[k] == models[jobs[1]][k]
+        assert all(params[k] == models[_][k] for _ in jobs[1:])
 
     mdirs = [models[_]['dir'] for _ in models]
 
@@ -209,17 +345,18 @@ if __name__ == '__main__':
             n += len(x)
 
             with torch.no_grad():
-                Im, y_ = latent_mutual_info(*m_, x.to(device), y.to(device), temps=args.T)
+                Im, y_ = latent_mutual_info(m_, x.to(device), y.to(device), temps=args.T)
 
             if s == sets[0]:
                 correct += (y == y_.to('cpu')).sum()
 
             accuracy = correct / n
 
-            dict_of_tensors = {'Im-{}'.format(_): Im[_].rename(None).to('cpu') for _ in Im}
+            # one pair of models: Im of size N, P x N otherwise
+            dict_of_tensors = {'Im-{}'.format(_): (Im[_] if len(Im[_]) > 1 else Im[_][0]).to('cpu') for _ in Im}
             recorder.append_batch(**dict_of_tensors,
                                   y_true=y.to('cpu'),
-                                  y_=y_.rename(None).to('cpu'))
+                                  y_=y_.to('cpu'))
 
             t1 = time.time()
             t_per_i = (t1 - t0) / n
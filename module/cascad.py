@@ -3,7 +3,7 @@ import sys
 import torch
 from cvae import ClassificationVariationalNetwork as M
 from utils import save_load
-from module.aggregation import compute_latent_mutual_info
+from module.aggregation import pairwise_latent_mutual_info
 import logging
 import argparse
 from utils.save_load import load_json, needed_remote_files, LossRecorder
@@ -86,8 +86,6 @@ class CascadModels(M):
 
         logpzy_ = []
 
-        mse_ = []
-
         for (i, m) in enumerate(self._models):
 
             C = m.num_labels
@@ -114,37 +112,23 @@ class CascadModels(M):
             if z_output:
                 z = out[-1][1:]
                 z = z.expand(C, *z.shape)
-                y_in = y or torch.stack([c * torch.ones((m.latent_sampling, len(x)),
-                                                        dtype=int,
-                                                        device=x.device)
-                                         for c in range(C)], dim=0)
-
-                # print('*** z:', *z.shape, 'y:', *y_in.shape) 
+                y_in = y or m.labels_for_each_class(z.shape[1:-1], device=x.device)
 
                 logpzy_.append(m.encoder.prior.log_density(z, y_in))
 
         x_ = torch.stack(x_)
         y_ = torch.stack(y_)
 
-        input_dims = tuple([0] + [_ - self.input_dim for _ in range(self.input_dim)])
-
-        for i in range(len(x_) + 1):
-            for j in range(i):
+        input_dims = tuple([1] + [_ - self.input_dim for _ in range(self.input_dim)])
 
-                x_i = x_[i - 1][1:]
-                x_j = x.unsqueeze(0) if not j else x_[j - 1][1:]
-
-                mse_.append((x_i - x_j).pow(2).mean(input_dims))
+        # mse of all pairs (i, j), j < i of x, x_1, ..., x_M at once
+        x_all = torch.cat([x.expand_as(x_[0][1:]).unsqueeze(0), x_[:, 1:]])
+        i, j = torch.tril_indices(len(x_all), len(x_all), -1)
+        mse_ = (x_all[i] - x_all[j]).pow(2).mean(input_dims)
 
         if z_output:
-            Im = {T: [] for T in temps}
-
-            for T in temps:
-                for i in range(len(self)):
-                    for j in range(i):
-                        pyzs = [(logpzy_[_] / T).softmax(0) for _ in (i, j)]
-                        samplings = [self._models[_].latent_sampling for _ in (i, j)]
-                        Im[T].append(compute_latent_mutual_info(*pyzs, *samplings).rename(None))
+            pyzs = [torch.stack([(_ / T).softmax(0) for T in temps]) for _ in logpzy_]
+            Im = dict(zip(temps, pairwise_latent_mutual_info(*pyzs)))
 
         output_losses = {}
         output_measures = {}
@@ -155,11 +139,11 @@ class CascadModels(M):
         for k in measures_[0]:
             output_measures[k] = torch.tensor([_[k] for _ in measures_])
 
-        output_losses['mse'] = torch.stack(mse_)
+        output_losses['mse'] = mse_
 
         if z_output:
             for T in temps:
-                output_losses['Im-{}'.format(T)] = torch.stack(Im[T])
+                output_losses['Im-{}'.format(T)] = Im[T]
 
         return x_, y_, output_losses, output_measures
 
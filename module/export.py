@@ -0,0 +1,295 @@
+"""Scoring graphs of trained networks, exported with TorchScript or
+ONNX, for OOD detection without this project
+
+The network is specialized for a list of methods: the graph takes a
+batch x (N x D1 x ... x Dt) and the sampling noise eps (L x N x K, L
+being the test latent sampling and K the latent dim) and returns the
+scores of the methods (each of size N), as batch_dist_measures does on
+the outputs of evaluate.
+
+Types cvae and vae with gaussian output and gaussian prior are
+supported. Method mag needs a median, that has no onnx operator.
+
+"""
+import os
+import sys
+import logging
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+from module.priors import GaussianPrior
+
+# methods by losses (or logits) they need, for cvae: scores are
+# computed for each class, then reduced
+EXPORTABLE_METHODS = {'cvae': ('iws', 'elbo', 'max', 'sum', 'mean', 'std', 'mag', 'nstd', 'IYx', 'kl', 'zdist',
+                               'soft', 'softkl', 'softzdist', 'softiws', 'mse', 'wmse', 'logits', 'baseline',
+                               'hyz'),
+                      'vae': ('iws', 'elbo', 'kl', 'zdist')}
+
+
+def _base_method(m):
+
+    if m.endswith('-2s'):
+        m = m[:-3]
+    if '-a-' in m:
+        m = m.split('-')[0]
+    return m
+
+
+def _temperature(m):
+    """softkl-10 -> ('softkl', 10.), softkl -> ('softkl', None)"""
+    if m.startswith(('soft', 'baseline')) and '-' in m:
+        base, T = m.split('-', 1)
+        return base, float(T)
+    return m, None
+
+
+class Scorer(nn.Module):
+
+    def __init__(self, model, methods):
+
+        super().__init__()
+
+        if model.type not in EXPORTABLE_METHODS:
+            raise ValueError('Can not export networks of type {}'.format(model.type))
+        if model.output_distribution != 'gaussian':
+            raise ValueError('Can not export networks with {} output'.format(model.output_distribution))
+        prior = model.encoder.prior
+        if type(prior) is not GaussianPrior:
+            raise ValueError('Can not export networks with {} prior'.format(prior.params['distribution']))
+        if model.sigma.coded or model.sigma.per_dim:
+            raise ValueError('Can not export networks with coded or per dim sigma')
+
+        self.methods = list(methods)
+        for m in self.methods:
+            base, _ = _temperature(_base_method(m))
+            if base not in EXPORTABLE_METHODS[model.type]:
+                raise ValueError('{} can not be exported for {}'.format(m, model.type))
+
+        self.per_class = model.losses_might_be_computed_for_each_class
+        self.input_shape = model.input_shape
+        self.C = model.num_labels
+        self.K = model.encoder.dense_mean.out_features
+        self.D = int(np.prod(model.input_shape))
+
+        self.features = model.features or nn.Identity()
+        self.dense_projs = model.encoder.dense_projs
+        self.dense_mean = model.encoder.dense_mean
+        self.dense_log_var = model.encoder.dense_log_var
+        self.forced_variance = model.encoder.forced_variance
+        self.is_sampled = float(model.encoder.sampling.is_sampled)
+        self.decoder = model.decoder
+        self.imager = model.imager
+        self.imager_input_shape = tuple(model.imager.input_shape)
+        self.classifier_type = model.classifier_type
+        if self.classifier_type in ('linear', None):
+            self.classifier = model.classifier
+
+        with torch.no_grad():
+            # whitening matrices W such that |W(z - mu)|^2 is the mahalanobis distance
+            P = prior.num_priors if prior.conditional else 1
+            inv_trans = prior.inv_trans.detach().reshape(P, *prior.inv_trans.shape[prior.conditional:])
+            if prior.var_dim == 'full':
+                W = inv_trans.tril()
+            elif prior.var_dim == 'diag':
+                W = torch.diag_embed(inv_trans)
+            else:
+                W = inv_trans.view(P, 1, 1) * torch.eye(self.K)
+            self.register_buffer('prior_mean', prior.mean.detach().reshape(P, self.K).clone())
+            self.register_buffer('prior_whitening', W.clone())
+            self.register_buffer('prior_log_det', prior.log_det_per_class().detach().reshape(P).clone())
+
+        self.sigma_is_rmse = model.sigma.is_rmse
+        if not self.sigma_is_rmse:
+            s = model.sigma.data.item()
+            self.sigma = np.exp(s) if model.sigma.is_log else s
+            self.log_sigma = s if model.sigma.is_log else np.log(s)
+
+    def _mahala(self, z):
+        """z: ... x K, returns P x ... distances to prior means"""
+
+        d = z.unsqueeze(-2) - self.prior_mean
+        # ... x P x K
+        u = torch.einsum('pjk,...pk->...pj', self.prior_whitening, d)
+        u = u.pow(2).sum(-1)
+        return u.movedim(-1, 0)
+
+    def losses(self, x, eps):
+
+        L = eps.shape[0]
+        t = self.features(x.view(-1, *self.input_shape)).flatten(1)
+
+        u = self.dense_projs(t)
+        mu = self.dense_mean(u)
+        if self.forced_variance:
+            log_var = np.log(self.forced_variance) * torch.ones_like(mu)
+        else:
+            log_var = torch.clip(self.dense_log_var(u), -20, 20)
+        var = log_var.exp()
+
+        eps_ = torch.cat([torch.zeros_like(eps[:1]), eps])
+        z = mu + torch.exp(0.5 * log_var) * eps_ * self.is_sampled
+
+        x_reco = self.imager(self.decoder(z).view(-1, *self.imager_input_shape)).view(L + 1, -1, *self.input_shape)
+
+        losses = {}
+
+        input_dims = tuple(range(-len(self.input_shape), 0))
+        if self.sigma_is_rmse:
+            wmse_sampling = (x_reco[1:] - x).pow(2).mean(input_dims)
+            sigma2 = wmse_sampling.mean(0)
+            log_sigma = sigma2.sqrt().log()
+            wmse_sampling = wmse_sampling / sigma2
+        else:
+            wmse_sampling = (x_reco[1:] / self.sigma - x / self.sigma).pow(2).mean(input_dims)
+            sigma2 = self.sigma ** 2
+            log_sigma = self.log_sigma
+
+        losses['wmse'] = wmse_sampling.mean(0)
+        losses['cross_x'] = self.D * (2 * log_sigma + losses['wmse'] + np.log(2 * np.pi)) / 2
+
+        # P x N
+        distance = self._mahala(mu)
+        trace = (var.unsqueeze(0) * self.prior_whitening.pow(2).sum(-2).unsqueeze(1)).sum(-1)
+        var_kl = trace - log_var.sum(-1) + self.prior_log_det.unsqueeze(-1) - self.K
+        losses['zdist'] = distance
+        losses['kl'] = 0.5 * (distance + var_kl)
+
+        # L x N
+        log_iws = -self.D / 2 * (wmse_sampling + 2 * log_sigma + np.log(2 * np.pi))
+        log_inv_q_z_x = (eps.pow(2).sum(-1) + log_var.sum(-1)) / 2 + self.K / 2 * np.log(2 * np.pi)
+
+        # L x P x N
+        log_p_z_y = (-np.log(2 * np.pi) * self.K / 2 - self._mahala(z[1:]).movedim(0, 1) / 2
+                     - self.prior_log_det.unsqueeze(-1) / 2)
+        log_iws = log_iws.unsqueeze(1) + log_p_z_y + log_inv_q_z_x.unsqueeze(1)
+        log_iws_remainder = log_iws.max(0)[0]
+        losses['iws'] = (log_iws - log_iws_remainder).exp().mean(0) + log_iws_remainder
+
+        losses['total'] = losses['cross_x'] + losses['kl']
+
+        if not self.per_class:
+            losses = {k: v.squeeze(0) if v.dim() > 1 else v for k, v in losses.items()}
+
+        if self.classifier_type in ('linear', None):
+            logits = self.classifier(z)[1:].mean(0)
+        else:
+            logits = F.linear(z, self.prior_mean, self.prior_mean.pow(2).sum(-1) / 2)[1:].mean(0)
+
+        return losses, logits
+
+    def forward(self, x, eps):
+
+        losses, logits = self.losses(x, eps)
+        logp = -losses['total']
+
+        scores = []
+        for m in self.methods:
+            m, T = _temperature(_base_method(m))
+            T_ = T or 1.
+
+            if not self.per_class:
+                measures = {'elbo': logp, 'iws': losses['iws']}.get(m)
+                if measures is None:
+                    measures = -losses[m]
+
+            elif m in ('elbo', 'max'):
+                measures = logp.max(0)[0]
+            elif m == 'iws':
+                measures = losses['iws'].logsumexp(0) + np.log(self.C)
+            elif m == 'sum':
+                measures = logp.logsumexp(0)
+            elif m == 'mean':
+                measures = logp.logsumexp(0) - np.log(self.C)
+            elif m == 'std':
+                measures = logp.std(0)
+            elif m == 'mag':
+                measures = logp.max(0)[0] - logp.median(0)[0]
+            elif m == 'nstd':
+                d_logp = (logp - logp.max(0)[0]).exp()
+                measures = (d_logp.std(0) / d_logp.mean(0)).pow(2)
+            elif m == 'IYx':
+                d_logp = logp - logp.max(0)[0]
+                d_logp_x = d_logp.exp().mean(0).log()
+                measures = (d_logp * d_logp.exp()).sum(0) / (self.C * d_logp_x.exp()) - d_logp_x
+            elif m in ('kl', 'zdist'):
+                measures = (-losses[m]).max(0)[0]
+            elif m in ('soft', 'softkl'):
+                measures = (-losses['kl'] / T_).softmax(0).max(0)[0]
+            elif m == 'softzdist':
+                measures = (-losses['zdist'] / T_).softmax(0).max(0)[0]
+            elif m == 'softiws':
+                # sic, as in batch_dist_measures
+                measures = (losses['iws'] if T is None else -losses['iws'] / T).softmax(0).max(0)[0]
+            elif m in ('mse', 'wmse'):
+                measures = -losses[{'mse': 'cross_x'}.get(m, m)]
+            elif m == 'logits':
+                measures = logits.max(-1)[0]
+            elif m == 'baseline':
+                measures = (logits / T_).softmax(-1).max(-1)[0]
+            elif m == 'hyz':
+                p_y_z = logits.softmax(-1)
+                measures = (p_y_z * p_y_z.log()).sum(-1)
+
+            scores.append(measures)
+
+        return tuple(scores)
+
+
+def example_inputs(model, batch_size=2):
+
+    K = model.encoder.dense_mean.out_features
+    L = model._latent_samplings['eval']
+    return torch.randn(batch_size, *model.input_shape), torch.randn(L, batch_size, K)
+
+
+def export(model, methods, file_path):
+    """Export the scorer of model for methods in file_path: onnx if its
+    extension is .onnx, else TorchScript
+
+    """
+    model.eval()
+    scorer = Scorer(model, methods).to('cpu').eval()
+    inputs = example_inputs(model)
+
+    with torch.no_grad():
+        if os.path.splitext(file_path)[-1] == '.onnx':
+            if any(_base_method(_) == 'mag' for _ in methods):
+                raise ValueError('mag can not be exported with onnx')
+            output_names = [m.replace('-', '_') for m in methods]
+            dynamic_axes = {'x': {0: 'batch'}, 'eps': {1: 'batch'}}
+            dynamic_axes.update({_: {0: 'batch'} for _ in output_names})
+            torch.onnx.export(scorer, inputs, file_path, input_names=['x', 'eps'],
+                              output_names=output_names, dynamic_axes=dynamic_axes, dynamo=False)
+        else:
+            traced = torch.jit.trace(scorer, inputs, check_inputs=[example_inputs(model, 5)])
+            traced.save(file_path)
+
+    logging.info('Scorer for {} exported in {}'.format(', '.join(methods), file_path))
+    return scorer
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from utils.save_load import find_by_job_number, load_model
+
+    parser = argparse.ArgumentParser(description='Export scoring graphs of jobs')
+    parser.add_argument('jobs', nargs='+', type=int)
+    parser.add_argument('--job-dir', default='./jobs')
+    parser.add_argument('-m', '--methods', nargs='+', default=['iws-2s', 'zdist', 'kl'])
+    parser.add_argument('--format', choices=('torchscript', 'onnx'), default='torchscript')
+    parser.add_argument('--output-dir', help='default is the directory of the job')
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    ext = {'torchscript': 'pt', 'onnx': 'onnx'}[args.format]
+    for job, d in find_by_job_number(*args.jobs, job_dir=args.job_dir, force_dict=True).items():
+        model = load_model(d['dir'], build_module=True, load_state=True)
+        model.to('cpu')
+        f = os.path.join(args.output_dir or d['dir'], 'scorer-{}.{}'.format('-'.join(args.methods), ext))
+        export(model, args.methods, f)
+        print(job, f)
+        sys.stdout.flush()
@@ -27,24 +27,82 @@ def mse_loss(x_output, x_target, ndim=3, batch_mean=True):
     # return (x_target - x_output).pow(2).mean(mean_dims)
 
 
+MAX_NUMEL = 2**26
+
+
+class CategoricalCrossEntropy(torch.autograd.Function):
+    """Per pixel cross entropy computed by chunks of the first dim, without
+    expanding target nor storing log probabilities
+
+    - x_output of shape (N1,...,Ng, 256, D1,...,Dt)
+    - target (long) of shape (M1,...,Mg, D1,...,Dt) broadcastable to
+      (N1,...,Ng, D1,...,Dt)
+
+    returns the cross entropy of shape (N1,...,Ng, D1,...,Dt)
+
+    """
+
+    @staticmethod
+    def _chunks(x_output, target, class_dim):
+
+        n = x_output.shape[0]
+        chunk = max(1, MAX_NUMEL * n // max(x_output.numel(), 1))
+        for i in range(0, n, chunk):
+            o = x_output[i:i + chunk]
+            t = target if target.shape[0] == 1 else target[i:i + chunk]
+            yield slice(i, i + chunk), o, t.expand(*o.shape[:class_dim], 1, *o.shape[class_dim + 1:])
+
+    @staticmethod
+    def forward(ctx, x_output, target, ndim):
+
+        class_dim = x_output.dim() - ndim - 1
+        target = target.view(*(1 for _ in range(class_dim + ndim - target.dim())), *target.shape)
+        target = target.unsqueeze(class_dim)
+
+        lse = x_output.new_empty(*x_output.shape[:class_dim], *x_output.shape[class_dim + 1:])
+        ce = torch.empty_like(lse)
+
+        for i, o, t in CategoricalCrossEntropy._chunks(x_output, target, class_dim):
+            torch.logsumexp(o, class_dim, out=lse[i])
+            torch.sub(lse[i], o.gather(class_dim, t).squeeze(class_dim), out=ce[i])
+
+        ctx.save_for_backward(x_output, target, lse)
+        ctx.class_dim = class_dim
+
+        return ce
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_ce):
+
+        x_output, target, lse = ctx.saved_tensors
+        class_dim = ctx.class_dim
+
+        grad = torch.empty_like(x_output)
+
+        # d ce / d output = softmax(output) - onehot(target)
+        for i, o, t in CategoricalCrossEntropy._chunks(x_output, target, class_dim):
+            g = grad[i]
+            torch.sub(o, lse[i].unsqueeze(class_dim), out=g)
+            g.exp_()
+            g.scatter_(class_dim, t, g.gather(class_dim, t) - 1)
+            g.mul_(grad_ce[i].unsqueeze(class_dim))
+
+        return grad, None, None
+
+
 def categorical_loss(x_output, x_target, ndim=3, batch_mean=True):
     """
     x_target of shape (N1,...,Ng, D1,...,Dt)
-    x_output of shape (N1,...,Ng, D1,...,Dt, 256)
+    x_output of shape (N1,...,Ng, 256, D1,...,Dt)
 
     """
-    expanded_shape = (*x_output.shape[:-ndim - 1], *x_target.shape[-ndim:])
-    x_target = x_target.expand(*expanded_shape)
-    batch_shape = x_target.shape[:-ndim]
-    image_shape = x_target.shape[-ndim:]
-    output_flatten_shape = (256, *image_shape)
-
-    x_target = (x_target * 255).long().view(-1, *image_shape)
-    x_output = x_output.view(-1, *output_flatten_shape)
-
-    # print('*** output', *x_output.shape, '*** target', *x_target.shape, '*** batch', *batch_shape)
+    x_target = (x_target * 255).long()
 
-    ce = F.cross_entropy(x_output, x_target, reduction='none').view(*batch_shape, -1).sum(-1)
+    if x_output.dim() == ndim + 1:
+        ce = CategoricalCrossEntropy.apply(x_output.unsqueeze(0), x_target, ndim)[0].sum()
+    else:
+        ce = CategoricalCrossEntropy.apply(x_output, x_target, ndim).flatten(-ndim).sum(-1)
 
     return ce.mean() if batch_mean else ce
 
@@ -0,0 +1,227 @@
+"""Int8 copies of networks for cpu inference
+
+-- Linear layers (encoder dense projections, decoder, classifier and
+   linear imager) are dynamically quantized.
+
+-- Conv stacks built by build_de_conv_layers (features and conv
+   imager) are statically quantized, ranges of activations being
+   calibrated on batches of the training set.
+
+Quantized states are saved in the directory of the model, next to
+state.pth, with the hash of the float state they were made from.
+
+"""
+import os
+import sys
+import time
+import logging
+import warnings
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+from utils.save_load import atomic_write
+
+STATE_FILE = 'quantized.pth'
+
+_fusable = [(nn.Conv2d, nn.BatchNorm2d, nn.ReLU), (nn.Conv2d, nn.BatchNorm2d), (nn.Conv2d, nn.ReLU),
+            (nn.ConvTranspose2d, nn.BatchNorm2d)]
+
+
+class QuantizedConvStack(nn.Module):
+    """Float in, float out, int8 in between
+
+    """
+
+    def __init__(self, conv):
+
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+        for k in ('name', 'input_shape', 'output_shape', 'shapes'):
+            if hasattr(conv, k):
+                setattr(self, k, getattr(conv, k))
+
+    def forward(self, x):
+        # quantized convs output channels last tensors
+        return self.dequant(self.conv(self.quant(x))).contiguous()
+
+
+def _fuse(conv):
+
+    layers = list(conv)
+    names = [str(_) for _ in range(len(layers))]
+    to_be_fused = []
+    i = 0
+    while i < len(layers):
+        for pattern in _fusable:
+            types = tuple(type(_) for _ in layers[i: i + len(pattern)])
+            if types == pattern:
+                to_be_fused.append(names[i: i + len(pattern)])
+                i += len(pattern) - 1
+                break
+        i += 1
+
+    if to_be_fused:
+        tq.fuse_modules(conv, to_be_fused, inplace=True)
+
+
+def is_quantizable_stack(conv):
+    """Conv stacks of build_de_conv_layers, pretrained resnets are left
+    as they are
+
+    """
+    return isinstance(conv, nn.Sequential) and any(isinstance(_, (nn.Conv2d, nn.ConvTranspose2d))
+                                                    for _ in conv)
+
+
+def _prepare(model, engine):
+
+    torch.backends.quantized.engine = engine
+    qconfig = tq.get_default_qconfig(engine)
+    for name in ('features', 'imager'):
+        conv = getattr(model, name, None)
+        if not is_quantizable_stack(conv):
+            continue
+        _fuse(conv)
+        stack = QuantizedConvStack(conv)
+        stack.qconfig = qconfig
+        for m in conv.modules():
+            # per channel observers are not available for transposed convs
+            if isinstance(m, nn.ConvTranspose2d):
+                m.qconfig = tq.default_qconfig
+        tq.prepare(stack, inplace=True)
+        setattr(model, name, stack)
+        logging.debug('{} prepared for static quantization'.format(name))
+
+
+def _convert(model):
+
+    for name in ('features', 'imager'):
+        stack = getattr(model, name, None)
+        if isinstance(stack, QuantizedConvStack):
+            tq.convert(stack, inplace=True)
+
+    tq.quantize_dynamic(model, {nn.Linear: tq.default_dynamic_qconfig}, dtype=torch.qint8, inplace=True)
+
+
+def quantize(model, calibration_set=None, num_batch=10, batch_size=100, engine=None):
+    """Returns an int8 copy of model (that is put on cpu)
+
+    -- calibration_set: dataset (e.g. training set) for static quantization of conv stacks
+
+    """
+    engine = engine or torch.backends.quantized.engine
+
+    q = model.copy()
+    q.to('cpu')
+    q.eval()
+    _prepare(q, engine)
+
+    if calibration_set is not None and any(isinstance(getattr(q, _, None), QuantizedConvStack)
+                                           for _ in ('features', 'imager')):
+        loader = torch.utils.data.DataLoader(calibration_set, batch_size=batch_size, shuffle=True)
+        logging.info('Calibrating with {} batches of {}'.format(num_batch, calibration_set.name))
+        with torch.no_grad():
+            for i, (x, y) in enumerate(loader):
+                if i >= num_batch:
+                    break
+                q.evaluate(x, y)
+
+    _convert(q)
+    q.quantization_engine = engine
+    return q
+
+
+def save(q, dir_name, source=None):
+    """source: key of the float state q was made from (see load)
+
+    """
+    with atomic_write(os.path.join(dir_name, STATE_FILE), 'wb') as f:
+        torch.save({'engine': q.quantization_engine, 'state': q.state_dict(), 'source': source}, f)
+
+
+def load(model, dir_name, source=None):
+    """Int8 copy of model with quantized state saved in dir_name, None
+    if source is given and the state was saved from another source
+
+    """
+    saved = torch.load(os.path.join(dir_name, STATE_FILE), map_location='cpu', weights_only=False)
+    if source is not None and saved.get('source') != source:
+        return None
+    with warnings.catch_warnings():
+        # observers are not run, parameters are in the saved state
+        warnings.simplefilter('ignore')
+        q = quantize(model, engine=saved['engine'])
+    q.load_state_dict(saved['state'])
+    return q
+
+
+def regression_report(model, testset=None, oodsets=None, batch_size=100, num_batch='all',
+                      calibration_set=None, print_report=True):
+    """Accuracies, AUCs and timings of the float model and of its int8
+    copy, both on cpu (odin methods that need gradients are left out)
+
+    """
+    model.to('cpu')
+    ind = testset.name if testset else model.training_parameters['set']
+    ood_methods = [_ for _ in model.ood_methods if not _.startswith('odin')]
+    report = {}
+    for which, m in (('float', model), ('int8', model.quantized(calibration_set=calibration_set))):
+        t0 = time.time()
+        with torch.no_grad():
+            acc = m.accuracy(testset, batch_size=batch_size, num_batch=num_batch,
+                             update_self_testing=False, from_where=['compute'])
+            ood = m.ood_detection_rates(oodsets=oodsets, testset=testset, batch_size=batch_size,
+                                        num_batch=num_batch, method=ood_methods,
+                                        update_self_ood=False, from_where=['compute'])
+        report[which] = {'accuracy': acc,
+                         'auc': {s: {_: ood[s][_]['auc'] for _ in ood[s]} for s in ood if s != ind},
+                         'time': time.time() - t0}
+
+    report['speedup'] = report['float']['time'] / report['int8']['time']
+
+    if print_report:
+        f, q = report['float'], report['int8']
+        _s = '{:32.32} {:8.2%} {:8.2%} {:+8.2%}'
+        print('{:32} {:>8} {:>8} {:>8}'.format('', 'float', 'int8', 'diff'))
+        for m in f['accuracy']:
+            print(_s.format('acc ' + m, f['accuracy'][m], q['accuracy'][m], q['accuracy'][m] - f['accuracy'][m]))
+        for s in f['auc']:
+            for m in f['auc'][s]:
+                if m in q['auc'].get(s, {}):
+                    print(_s.format('auc {} {}'.format(s, m), f['auc'][s][m], q['auc'][s][m],
+                                    q['auc'][s][m] - f['auc'][s][m]))
+        print('{:32} {:7.2f}s {:7.2f}s {:7.2f}x'.format('time', f['time'], q['time'], report['speedup']))
+
+    return report
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from utils.save_load import find_by_job_number, load_model
+    import utils.torch_load as torchdl
+
+    parser = argparse.ArgumentParser(description='Accuracy/AUC regression of int8 models')
+    parser.add_argument('jobs', nargs='+', type=int)
+    parser.add_argument('--job-dir', default='./jobs')
+    parser.add_argument('--batch-size', default=100, type=int)
+    parser.add_argument('--num-batch', default='all', type=lambda s: s if s == 'all' else int(s))
+    parser.add_argument('--recalibrate', action='store_true',
+                        help='calibrate again even if a quantized state is saved')
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for job, d in find_by_job_number(*args.jobs, job_dir=args.job_dir, force_dict=True).items():
+        model = load_model(d['dir'], build_module=True, load_state=True)
+        print('Job {}'.format(job))
+        calibration_set = None
+        if args.recalibrate:
+            calibration_set, _ = torchdl.get_dataset(model.training_parameters['set'],
+                                                     transformer=model.training_parameters['transformer'],
+                                                     splits=['train'])
+        regression_report(model, batch_size=args.batch_size, num_batch=args.num_batch,
+                          calibration_set=calibration_set)
+        sys.stdout.flush()
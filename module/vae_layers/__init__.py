@@ -1,3 +1,3 @@
 from .layers import Encoder, Sampling, Classifier, Sigma
-from .conv import build_de_conv_layers, find_input_shape
+from .conv import build_de_conv_layers, find_input_shape, fused_for_eval
 from .misc import activation_layers, onehot_encoding
@@ -1,12 +1,16 @@
 import os
+import copy
 import configparser
 import numpy as np
+import torch
 from torch import nn
-from torchvision import models
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from .misc import activation_layers, Reshape
+from utils.misc import lazy_import
 import re
 import logging
 
+models = lazy_import('torchvision.models')
 
 conv_config = configparser.ConfigParser()
 
@@ -244,6 +248,55 @@ def build_de_conv_layers(input_shape, layers_name, batch_norm=False,
     return conv
 
 
+class EvalConvStack(nn.Sequential):
+    """Copy of a conv stack for inference, run in channels last format
+
+    """
+
+    def forward(self, x):
+
+        x = x.contiguous(memory_format=torch.channels_last)
+        for layer in self:
+            if isinstance(layer, Reshape):
+                x = x.contiguous()
+            x = layer(x)
+
+        return x.contiguous()
+
+
+def fused_for_eval(conv, channels_last=True):
+    """Copy of conv stack built by build_de_conv_layers with batch norms
+    folded in the (de)conv layers before them, to be used in eval mode
+    only. Other modules (e.g. pretrained resnets or linear imagers) are
+    returned as is.
+
+    """
+    if type(conv) is not nn.Sequential or not any(isinstance(_, (nn.Conv2d, nn.ConvTranspose2d)) for _ in conv):
+        return conv
+
+    layers = []
+    for layer in conv:
+        if (isinstance(layer, nn.BatchNorm2d) and layer.track_running_stats
+           and layers and type(layers[-1]) in (nn.Conv2d, nn.ConvTranspose2d)):
+            layers[-1] = fuse_conv_bn_eval(layers[-1], layer,
+                                           transpose=isinstance(layers[-1], nn.ConvTranspose2d))
+        elif isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d, nn.BatchNorm2d)):
+            layers.append(copy.deepcopy(layer))
+        else:
+            layers.append(layer)
+
+    fused = (EvalConvStack if channels_last else nn.Sequential)(*layers).eval()
+    if channels_last:
+        fused.to(memory_format=torch.channels_last)
+    for p in fused.parameters():
+        p.requires_grad_(False)
+    for k in ('name', 'input_shape', 'output_shape', 'shapes'):
+        if hasattr(conv, k):
+            setattr(fused, k, getattr(conv, k))
+
+    return fused
+
+
 class ResOrDenseNetFeatures(nn.Sequential):
 
     def __init__(self, model_name='resnet152', input_shape=(3, 32, 32), pretrained=True):
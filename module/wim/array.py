@@ -72,12 +72,16 @@ class WIMArray(WIMJob):
         a = available_results(self, where=('recorders',), min_samples_by_class=0)
         epoch = max(a)
         a = a[epoch]
+
+        # recorders to be concatenated, per set, array ones first
+        recorders_to_concatenate = {}
+
         if not a['all_sets']['recorders']:
             epoch = None
-            array_recorders = {}
         else:
             rec_dir = a['rec_dir']
-            array_recorders = LossRecorder.loadall(rec_dir)
+            for _, r in LossRecorder.loadall(rec_dir, output='paths').items():
+                recorders_to_concatenate[_] = [LossRecorder.load_mapped(r)]
 
         for j in jobs_to_add:
 
@@ -104,7 +108,7 @@ class WIMArray(WIMJob):
             else:
                 logging.debug('Recorders found')
             try:
-                job_recorders = LossRecorder.loadall(a['rec_dir'])
+                job_recorders = LossRecorder.loadall(a['rec_dir'], output='paths')
             except KeyError:
                 logging.error('Will CRASH!')
                 return a
@@ -115,13 +119,17 @@ class WIMArray(WIMJob):
                 self.wim_params['array_size'] = 1
 
             for _ in job_recorders:
-                if not all(c in job_recorders[_] for c in self.wanted_components):
+                # memory mapped, tensors are read only when concatenated
+                job_recorder = LossRecorder.load_mapped(job_recorders[_])
+                if not all(c in job_recorder for c in self.wanted_components):
                     continue
 
-                if _ in array_recorders:
-                    array_recorders[_].merge(job_recorders[_])
-                else:
-                    array_recorders[_] = job_recorders[_].copy()
+                recorders_to_concatenate.setdefault(_, []).append(job_recorder)
+
+        array_recorders = {}
+        for s, recorders in recorders_to_concatenate.items():
+            array_recorders[s] = LossRecorder.concatenate(*recorders,
+                                                          file_path=os.path.join(rec_dir, 'record-{}.pth'.format(s)))
 
         created_rec_str = ' -- '.join('{} of size {} for {}'.format(_,
                                                                     array_recorders[_].recorded_samples,
@@ -132,11 +140,9 @@ class WIMArray(WIMJob):
                                                                self.saved_dir[:20],
                                                                self.saved_dir[-20:]))
 
-        for s, r in array_recorders.items():
-            r.save(os.path.join(rec_dir, 'record-{}.pth'.format(s)))
         self.ood_detection_rates(
-            #  batch_size=test_batch_size,
-            #  testset=testset,
+            #  batch_size=test_batch_size,
+            #  testset=testset,
             # oodsets=oodsets,
             # num_batch='all',
             # outputs=outputs,
@@ -152,19 +158,17 @@ class WIMArray(WIMJob):
         for sdir in sample_subdirs:
             array_sdir = model_subdir(self, sdir)
             os.makedirs(array_sdir, exist_ok=True)
-            array_sample_rec = {}
+
+            # samples already in array first, then jobs
+            sample_rec_paths = {_: [p] for _, p in SampleRecorder.loadall(array_sdir, output='paths').items()}
             for j in jobs:
                 job_sdir = model_subdir(j, sdir)
-                job_sample_rec = SampleRecorder.loadall(job_sdir)
-                if not array_sample_rec:
-                    array_sample_rec = job_sample_rec
-                else:
-                    for _ in array_sample_rec:
-                        array_sample_rec[_].merge(job_sample_rec[_])
-
-            for _ in array_sample_rec:
+                for _, p in SampleRecorder.loadall(job_sdir, output='paths').items():
+                    sample_rec_paths.setdefault(_, []).append(p)
+
+            for _, paths in sample_rec_paths.items():
                 spth = os.path.join(array_sdir, 'samples-{}.pth'.format(_))
-                array_sample_rec[_].save(spth, append=True)
+                SampleRecorder.concatenate(*paths, file_path=spth)
 
     @ classmethod
     def collect_processed_jobs(cls, job_dir, flash=False):
@@ -255,43 +259,39 @@ if __name__ == '__main__':
 
     logging.info('{} jobs remaining'.format(len(wim_jobs)))
 
+    """
+    Group jobs and arrays alike in one pass each
+
+    """
+    wim_jobs_alike = WIMJob.group_jobs_alike(wim_jobs)
+    wim_arrays_alike = WIMJob.group_jobs_alike(wim_arrays)
+
+    logging.info('{} groups of jobs alike for {} groups of arrays'.format(len(wim_jobs_alike),
+                                                                         len(wim_arrays_alike)))
+
     processed_jobs = []
 
-    for i, array in enumerate(wim_arrays):
+    for i, (k, jobs_alike) in enumerate(wim_jobs_alike.items()):
 
-        if not wim_jobs:
-            logging.info('No more wim jobs left for processing')
-            break
-        with turnoff_debug():
-            wim_array = WIMArray.load(model_subdir(array), load_state=False)
-        wim_jobs_alike = wim_array.fetch_jobs_alike(models=wim_jobs)
-        if not wim_jobs_alike:
-            logging.info('Skipping wim array {}, no jobs alike (among {})'.format(i, len(wim_jobs)))
+        if k not in wim_arrays_alike:
+            logging.info('Skipping {} jobs alike (group {}), no wim array'.format(len(jobs_alike), i))
             continue
 
         """
         Process one wim array among sames (smallest job number)
         """
-        wim_arrays_alike = wim_array.fetch_jobs_alike(models=wim_arrays)
-        kept_wim_array = min(wim_arrays_alike, key=lambda j: j['job'])
+        kept_wim_array = min(wim_arrays_alike[k], key=lambda j: j['job'])
         with turnoff_debug():
             wim_array = WIMArray.load(kept_wim_array['dir'], load_state=False)
 
-        logging.info('Processing {} jobs alike (array {})'.format(len(wim_jobs_alike), i))
-        wim_array.update_records(*[WIMJob.load(_['dir'], build_module=False) for _ in wim_jobs_alike])
+        logging.info('Processing {} jobs alike (array {})'.format(len(jobs_alike), kept_wim_array['job']))
+        wim_array.update_records(*[WIMJob.load(_['dir'], build_module=False) for _ in jobs_alike])
         wim_array.save(model_subdir(wim_array))
 
-        """
-        Cleaning
-
-        """
-        for _ in wim_jobs_alike:
-            processed_jobs.append(_)
-            wim_jobs.remove(_)
+        processed_jobs += jobs_alike
 
-        for _ in wim_arrays_alike:
-            if _['job'] != array['job']:
-                wim_arrays.remove(_)
+    processed_dirs = set(_['dir'] for _ in processed_jobs)
+    wim_jobs = [_ for _ in wim_jobs if _['dir'] not in processed_dirs]
 
     logging.warning('{} processed and {} unprocessed jobs'.format(len(processed_jobs), len(wim_jobs)))
 
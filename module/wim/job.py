@@ -161,15 +161,95 @@ class WIMJob(M):
 
         else:
             logging.debug('Will evaluate on both prior')
-            self._evaluate_on_both_priors = False
+            if self.y_is_coded:
+                return self._evaluate_on_both_priors_in_two_passes(x, *a, **kw)
+            return self._evaluate_on_both_priors_in_one_pass(x, *a, **kw)
+
+    def _evaluate_on_both_priors_in_two_passes(self, x, *a, **kw):
+        """Network is computed on each prior, alternate losses being
+        suffixed with @
+
+        """
+        self._evaluate_on_both_priors = False
+        try:
             with self.alternate_prior:
                 o = self.evaluate(x, *a, **kw)
                 alternate_loss = {k + '@': o[2][k] for k in o[2] if not k.endswith('~')}
             with self.original_prior:
                 o = self.evaluate(x, *a, **kw)
                 o[2].update(alternate_loss)
+        finally:
             self._evaluate_on_both_priors = True
-            return o
+        return o
+
+    def _evaluate_on_both_priors_in_one_pass(self, x, y=None, batch=0, **kw):
+        """Network is computed once (on original prior), and latents are
+        scored on both priors, alternate losses being suffixed with @
+
+        Outputs of the network (logits among them) are the ones of the
+        original prior: cross_y is thus shared by both priors, which is
+        right only if logits do not depend on the prior (they do with
+        the softmax classifier, built from prior means). Networks with
+        coded y (whose encoder depends on y) are computed on each prior
+        (see _evaluate_on_both_priors_in_two_passes).
+
+        """
+        if self._with_estimated_labels:
+            x, y_ = x
+
+        eval_kw = {k: kw.pop(k) for k in ('current_measures', 'with_beta', 'kl_var_weighting',
+                                          'gamma_weighting', 'z_output') if k in kw}
+
+        y_is_built = self.losses_might_be_computed_for_each_class and y is None
+
+        with self.original_prior:
+            y_original, f_o = self.forward_for_evaluation(x, y, **kw)
+            o = self.evaluate_from_forward(x, y_original, f_o, y_is_built=y_is_built, batch=batch, **eval_kw)
+
+        with self.alternate_prior:
+            y_alternate = y
+            if y_is_built:
+                y_alternate = self.labels_for_each_class(x.shape[:-len(self.input_shape)], device=x.device)
+            o_ = self.evaluate_from_forward(x, y_alternate, f_o, y_is_built=y_is_built, batch=batch, **eval_kw)
+
+        if self._with_estimated_labels and self.is_cvae:
+            o[2].update({'y_est_already': y_})
+            o_[2].update({'y_est_already': y_})
+
+        o[2].update({k + '@': o_[2][k] for k in o_[2] if not k.endswith('~')})
+
+        return o
+
+    @ staticmethod
+    def _split_forward_outputs(o, n):
+        """Split outputs of forward_for_evaluation of a concatenated batch
+        in outputs for the n first samples and the remaining ones
+
+        """
+        # batch dim of x_reco, y_est, mu, log_var, z, eps_norm, sigma
+        batch_dims = (1, 1, 0, 0, 1, 1, 0)
+        o_first, o_last = [], []
+        for t, d in zip(o, batch_dims):
+            if t is None:
+                o_first.append(None)
+                o_last.append(None)
+                continue
+            t_first, t_last = t.split([n, t.shape[d] - n], dim=d)
+            o_first.append(t_first.contiguous())
+            o_last.append(t_last.contiguous())
+
+        return tuple(o_first), tuple(o_last)
+
+    def _prior_distances(self, mu, log_var):
+        """zdist of latent means to current prior, for each class if prior
+        is conditional
+
+        """
+        y = None
+        if self.encoder.prior.conditional:
+            y = self.labels_for_each_class(mu.shape[:-1], device=mu.device)
+
+        return {'zdist': self.encoder.prior.kl(mu, log_var, y=y)['distance']}
 
     def batch_dist_measures(self, logits, losses, methods, to_cpu=False):
 
@@ -530,19 +610,31 @@ class WIMJob(M):
 
                 """
 
+                One forward of train and moving batches through the network
+
+                """
+
+                x_a, y_a = x_a.to(device), y_a.to(device)
+                x_u = x_u.to(device)
+                y_u_est = torch.zeros(batch_size, device=device, dtype=int)
+
+                self.train()
+                _, o = self.forward_for_evaluation(torch.cat([x_a, x_u]), torch.cat([y_a, y_u_est]))
+                o_a, o_u = self._split_forward_outputs(o, len(x_a))
+
+                """
+
                 On original prior
 
                 """
 
                 self.original_prior = True
-                self.train()
                 _s = 'Epoch {:2} Batch {:2} -- set {} --- prior {}'
                 logging.debug(_s.format(epoch + 1, batch + 1, 'train', 'original'))
 
-                with self.no_estimated_labels():
-                    (_, y_est, batch_losses, _) = self.evaluate(x_a.to(device), y_a.to(device),
-                                                                batch=batch,
-                                                                with_beta=True)
+                (_, y_est, batch_losses, _) = self.evaluate_from_forward(x_a, y_a, o_a,
+                                                                         batch=batch,
+                                                                         with_beta=True)
 
                 zdbg('finetune', epoch + 1, batch + 1, 'train', 'original', batch_losses['zdist'].mean())
 
@@ -550,28 +642,25 @@ class WIMJob(M):
 
                 L = batch_losses['total'].mean()
 
-                y_u_est = torch.zeros(batch_size, device=device, dtype=int)
-
-                if val_batch:  # or self.is_cvae:
-                    self.eval()
+                if val_batch:
                     with torch.no_grad():
 
-                        # Eval on unknown batch
-                        with self.no_estimated_labels():
+                        # latents of the training pass are the ones of an
+                        # eval pass unless dropout is on
+                        o_a_, o_u_ = o_a, o_u
+                        if self.dropout:
+                            self.eval()
+                            _, o_ = self.forward_for_evaluation(torch.cat([x_a, x_u]), torch.cat([y_a, y_u_est]))
+                            o_a_, o_u_ = self._split_forward_outputs(o_, len(x_a))
+                            self.train()
 
-                            (_, _, batch_losses, _) = self.evaluate(x_u.to(device),
-                                                                    batch=batch,
-                                                                    with_beta=True)
+                        # Eval on unknown batch
+                        batch_losses = self._prior_distances(*o_u_[2:4])
 
                         if self.is_cvae:
-                            y_u_est = torch.zeros(batch_size, device=device, dtype=int)
-                            # y_u_est = batch_losses['zdist'].min(0)[1]
                             logging.debug('zdist shape: {}'.format(batch_losses['zdist'].shape))
                             batch_losses = {k: batch_losses[k].min(0)[0] for k in printed_losses}
 
-                        else:
-                            y_u_est = torch.zeros(batch_size, device=device, dtype=int)
-
                         running_loss.update({_ + '_' + k: batch_losses[k][i_[_]].mean().item()
                                              for _, k in product(i_, printed_losses)})
 
@@ -579,24 +668,14 @@ class WIMJob(M):
                             zdbg('eval', epoch + 1, batch + 1, _, 'original', batch_losses['zdist'][i_[_]].mean())
 
                         # Eval on train batch
-                        with self.no_estimated_labels():
-                            (_, _, batch_losses, _) = self.evaluate(x_a.to(device),
-                                                                    batch=batch,
-                                                                    with_beta=True)
+                        batch_losses = self._prior_distances(*o_a_[2:4])
 
                         if self.is_cvae:
-                            # y_u_est = torch.zeros(batch_size, device=device, dtype=int)
                             y_a_est = batch_losses['zdist'].min(0)[1]
-                            acc = (y_a.to(device) == y_a_est).float().mean()
+                            acc = (y_a == y_a_est).float().mean()
                             logging.debug('Batch train acc: {:.1%}'.format(acc))
                             batch_losses = {k: batch_losses[k].min(0)[0] for k in printed_losses}
 
-                        else:
-                            y_a_est = torch.zeros(batch_size, device=device, dtype=int)
-
-                        # running_loss.update({_ + '_' + k: batch_losses[k][i_[_]].mean().item()
-                        #                      for _, k in product(i_, printed_losses)})
-
                         zdbg('eval', epoch + 1, batch + 1, 'train', 'original', batch_losses['zdist'].mean())
 
                 """
@@ -612,14 +691,11 @@ class WIMJob(M):
 
                 logging.debug('x_u shape: {} y_u_est shape {}'.format(x_u.shape, y_u_est.shape))
 
-                self.train()
-                with self.no_estimated_labels():
-                    assert not y_u_est.any()
-                    o = self.evaluate(x_u.to(device), y_u_est,
-                                      batch=batch,
-                                      with_beta=True)
+                assert not y_u_est.any()
+                _, _, batch_losses, _ = self.evaluate_from_forward(x_u, y_u_est, o_u,
+                                                                   batch=batch,
+                                                                   with_beta=True)
 
-                _, _, batch_losses, _ = o
                 L += alpha * batch_losses['total'].mean()
 
                 L.backward()
@@ -719,13 +795,51 @@ class WIMJob(M):
             self.misclassification_detection_rates(print_result='~')
             logging.info('Computing misclass detection rates: done')
 
-    def fetch_jobs_alike(self, job_dir=None, models=None, flash=False):
-
-        assert (job_dir is None) ^ (models is None), 'Either job_dir or models is None'
+    @ classmethod
+    def wim_filter_keys(cls):
+        """Keys of wim params that jobs alike share (wim_* in filters.ini,
+        except wim_array_size)
 
+        """
         wim_filter_keys = get_filter_keys()
         wim_filter_keys = {_: wim_filter_keys[_] for _ in wim_filter_keys if _.startswith('wim')}
         wim_filter_keys.pop('wim_array_size', None)
+        return wim_filter_keys
+
+    @ classmethod
+    def jobs_alike_key(cls, d, keys=None):
+        """Canonical (hashable) key of a model dict such that jobs alike have
+        the same key
+
+        """
+        if keys is None:
+            keys = sorted(cls.wim_filter_keys())
+
+        def hashable(v):
+            return tuple(hashable(_) for _ in v) if isinstance(v, (list, tuple)) else v
+
+        return tuple(hashable(d.get(k)) for k in keys)
+
+    @ classmethod
+    def group_jobs_alike(cls, models):
+        """Groups models dicts in one pass, returns a dict of lists of models
+        alike indexed by their jobs_alike_key
+
+        """
+        keys = sorted(cls.wim_filter_keys())
+        groups = {}
+        for m in models:
+            groups.setdefault(cls.jobs_alike_key(m, keys), []).append(m)
+
+        logging.debug('Grouped {} models in {} groups of jobs alike'.format(len(models), len(groups)))
+
+        return groups
+
+    def fetch_jobs_alike(self, job_dir=None, models=None, flash=False):
+
+        assert (job_dir is None) ^ (models is None), 'Either job_dir or models is None'
+
+        wim_filter_keys = self.wim_filter_keys()
 
         filter = DictOfListsOfParamFilters()
 
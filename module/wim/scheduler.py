@@ -1,15 +1,88 @@
-from filelock import FileLock
 import os
 import time
 import logging
+import select
+import socket
+import tempfile
+import fcntl
+import ctypes
+import ctypes.util
+
+
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+
+
+class DirectoryWatcher(object):
+    """Wake up on changes in a directory with inotify, or on a timeout
+    if inotify is not available (e.g. not on linux)
+
+    """
+
+    def __init__(self, directory):
+
+        self._fd = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1')
+            mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+            if libc.inotify_add_watch(fd, os.fsencode(directory or '.'), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+            self._fd = fd
+
+        except (OSError, AttributeError, TypeError) as e:
+            logging.debug('inotify not available ({}), will poll'.format(e))
+
+    def wait(self, timeout):
+
+        if self._fd is None:
+            time.sleep(timeout)
+            return
+
+        r, _, _ = select.select([self._fd], [], [], timeout)
+        if r:
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
 
 
 class Scheduler(object):
+    """Sentinel file {file_path}.{index} exists while job index is running
+
+    The running job holds an exclusive lock on its sentinel file, in
+    which it writes its host name. As locks of network file systems are
+    not seen from other hosts, only a sentinel written on the same host
+    and not locked is known to be left by a dead job (and is not waited
+    for); other sentinels are waited for until they are deleted.
+
+    """
+
+    poll_interval = 0.5
 
     def __init__(self, file_path=None, index=0):
 
         self.file_path = file_path
         self.index = index
+        self._fp = None
 
         if self.file_path:
             try:
@@ -25,32 +98,90 @@ class Scheduler(object):
             except FileNotFoundError:
                 logging.info('{} does not exist for scheduler'.format(self.file_path))
 
+    def sentinel(self, index=None):
+        return '{}.{}'.format(self.file_path, self.index if index is None else index)
+
+    @classmethod
+    def is_running(cls, sentinel):
+
+        try:
+            fp = open(sentinel, 'r')
+        except FileNotFoundError:
+            return False
+
+        with fp:
+            if fp.readline().strip() != socket.gethostname():
+                return True
+            try:
+                fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            except OSError:
+                # locks not supported by file system, rely on file existence
+                return True
+
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+        logging.debug('{} is not locked, its job is dead'.format(sentinel))
+        return False
+
+    def wait_for(self, *indices, timeout=None):
+        """Wait for jobs to stop, return True if they all did
+
+        """
+        blocking_files = [self.sentinel(_) for _ in indices if _ != self.index]
+
+        t0 = time.time()
+        with DirectoryWatcher(os.path.dirname(self.file_path)) as watcher:
+            while True:
+                blocking_files = [f for f in blocking_files if self.is_running(f)]
+                if not blocking_files:
+                    return True
+
+                remaining = self.poll_interval
+                if timeout is not None:
+                    remaining = min(remaining, t0 + timeout - time.time())
+                    if remaining <= 0:
+                        return False
+
+                watcher.wait(remaining)
+
     def start(self, block=False):
         if not self.file_path:
             return
 
-        current_idx = self.index
         if block:
             if block is True:
                 block = [*range(self.index - 6, self.index)]
-            blocking_files = ['{}.{}'.format(self.file_path, _) for _ in block]
+            blocking_files = [self.sentinel(_) for _ in block]
             logging.info('Waiting for {} to be deleted'.format(','.join(blocking_files)))
 
             t0 = time.time()
-            while any(os.path.exists(f) for f in blocking_files):
-                time.sleep(0.5)
-
-            time.sleep(1)
+            self.wait_for(*block)
             t1 = time.time()
             logging.info('{} deleted, going through (waited {:.1f}s)'.format(','.join(blocking_files), t1 - t0))
 
-        with open('{}.{}'.format(self.file_path, current_idx), 'w') as fp:
-            pass
+        # sentinel is locked before being visible
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.file_path) or '.',
+                                        prefix='.{}.'.format(os.path.basename(self.sentinel())))
+        fp = os.fdopen(fd, 'w')
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.write(socket.gethostname() + '\n')
+        fp.flush()
+        os.replace(tmp_file, self.sentinel())
+
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = fp
 
     def stop(self):
         if not self.file_path:
             return
         try:
-            os.remove('{}.{}'.format(self.file_path, self.index))
+            os.remove(self.sentinel())
         except FileNotFoundError:
             pass
+
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
@@ -7,7 +7,7 @@ import os
 import logging
 import pandas as pd
 import numpy as np
-from utils.save_load import fetch_models, make_dict_from_model
+from utils.save_load import fetch_models, make_row_from_model
 from utils.filters import DictOfListsOfParamFilters, ParamFilter, get_filter_keys, MetaFilter
 from utils.tables import agg_results, results_dataframe, format_df_index, auto_remove_index
 from pydoc import locate
@@ -30,7 +30,7 @@ tex_output = sys.stdout
 
 
 def process_config_file(config_file, filter_keys, which=['all'], keep_auc=True,
-                        root=root, show_dfs=True, flash=True):
+                        root=root, show_dfs=True, flash=True, row_cache=True):
 
     config_dir = os.path.dirname(config_file)
     config = configparser.ConfigParser()
@@ -88,7 +88,7 @@ def process_config_file(config_file, filter_keys, which=['all'], keep_auc=True,
 
     global_filters = MetaFilter(operator='or', **filters)
 
-    models = fetch_models(job_dir, registered_models_file, filter=global_filters, build_module=False,
+    models = fetch_models(job_dir, registered_models_file, filter=global_filters, light=True,
                           flash=flash)
 
     logging.info('Fetched {} models'.format(len(models)))
@@ -113,12 +113,12 @@ def process_config_file(config_file, filter_keys, which=['all'], keep_auc=True,
                 epoch_to_fetch = config[k].get('epoch', 'last')
                 if epoch_to_fetch == 'min-loss':
                     epoch_to_fetch = 'early-min-loss'
-                epoch = n['net'].training_parameters.get(epoch_to_fetch, 'last')
-                logging.debug('Epoch for %s: %s = %s', n['job'], epoch_to_fetch, epoch)
                 with turnoff_debug():
-                    n = make_dict_from_model(n['net'], n['dir'], wanted_epoch=epoch)
-                models_by_type[k].append(n)
-                archs_by_type[k].add(n['arch'])
+                    row = make_row_from_model(d, epoch_key=epoch_to_fetch,
+                                              cache_file='rows.pth' if row_cache else None)
+                logging.debug('Epoch for %s: %s = %s', n['job'], epoch_to_fetch, row['epoch'])
+                models_by_type[k].append(row)
+                archs_by_type[k].add(row['arch'])
 
     tpr_ = default_config['tpr']
     tpr = float(tpr_) / 100
@@ -430,6 +430,8 @@ if __name__ == '__main__':
     parser.add_argument('--tpr', default=95, type=int)
     parser.add_argument('--register', dest='flash', action='store_false')
     parser.add_argument('--auc', action='store_true')
+    parser.add_argument('--no-row-cache', dest='row_cache', action='store_false',
+                        help='do not cache rows of results in job directories')
     parser.add_argument('config_files', nargs='+', default=[file_ini])
     parser.add_argument('-q', action='store_false', dest='show_dfs')
 
@@ -459,5 +461,5 @@ if __name__ == '__main__':
         show_dfs = args.show_dfs
         for auc in keep_auc:
             process_config_file(config_file, filter_keys, keep_auc=auc, root=root,
-                                show_dfs=show_dfs, flash=args.flash)
+                                show_dfs=show_dfs, flash=args.flash, row_cache=args.row_cache)
             show_dfs = False
@@ -12,8 +12,8 @@ from utils.parameters import gethostname
 import pandas as pd
 import itertools
 import torch
-from torch.nn.functional import one_hot
-from module.aggregation import log_mean_exp, joint_posterior, mean_posterior, voting_posterior, posterior
+from module.aggregation import batched_aggregated_posterior, batched_log_p_x_y
+from module.aggregation import batched_thresholds, batched_rates
 
 agg_type_letter = {'vote': '&', 'joint': ',', 'mean': '+', 'mean~': '~', 'sumprod': '.'}
 
@@ -35,8 +35,6 @@ parser.add_argument('--combos', nargs='+', type=int)
 parser.add_argument('--compute', action='store_true')
 parser.add_argument('--min-models-to-keep-on', type=int, default=0)
 
-rmodels = load_json('jobs', 'models-{}.json'.format(gethostname()))
-
 col_width = 10
 str_col_width = '13.13'
 flt_col_width = '5.1f'
@@ -44,10 +42,141 @@ flt_col_width = '5.1f'
 _ = np.seterr(divide='ignore', invalid='ignore')
 
 
-def diff(t):
+def aggregate_combos(t, y_true, kept_names_by_set, testset, combo_lengths, wanted_aggs, agg_types, temps_,
+                     tpr=0.95, ind_balance=(1, 0), nan_temp=-1, cache=None):
+    """Accuracies and ood/misclassification rates of all combos of models
+    of given lengths, computed length by length on stacked tensors.
+
+    -- t: dict of dict of dict t[iws|zdist|kl][set][name] of C x N tensors
+
+    -- cache: dict of reduced posteriors indexed by (agg, length), that
+       is used if it was computed on same combos and updated otherwise
+
+    Returns accuracies[combo_name] and pr[ind|correct][combo_name][tpr|'vote'][set][T]
+
+    """
+    if cache is None:
+        cache = {}
+
+    names = sorted(kept_names_by_set[testset])
+    sets = [s for s in kept_names_by_set if any(m in kept_names_by_set[s] for m in names)]
+    names_by_set = {s: [m for m in names if m in kept_names_by_set[s]] for s in sets}
+
+    stack = {_: {s: torch.stack([t[_][s][m] for m in names_by_set[s]]) for s in sets} for _ in t}
+    y_classif = {s: stack['iws'][s].argmax(1) for s in sets}
+    y_true_ = y_true[names[0]][testset]
+    num_labels = stack['iws'][testset].shape[1]
 
-    # return t.diff()
-    return t[..., 1:] - t[..., :-1]
+    in_set = {'ind': 'ood', 'correct': 'misclass'}
+    thr_balance = {'ind': ind_balance, 'correct': (1, 0)}
+
+    accuracies = {}
+    pr = {'ind': {}, 'correct': {}}
+
+    # as_in[k][T][s]: M x N ind (or correct) values for single models
+    as_in = {'ind': {}, 'correct': {}}
+
+    for l in combo_lengths:
+
+        combos = [*itertools.combinations(names, l)]
+
+        # for each set, rows of available combos and indices of their models in stacks
+        rows = {s: [i for i, c in enumerate(combos) if all(m in names_by_set[s] for m in c)] for s in sets}
+        idx = {s: torch.tensor([[names_by_set[s].index(m) for m in combos[i]] for i in rows[s]],
+                               dtype=torch.long).view(-1, l)
+               for s in sets}
+        rows = {s: torch.tensor(rows[s], dtype=torch.long) for s in sets}
+
+        # tprs of vote (K tensors) for each k and T
+        vote_tprs = {}
+
+        for w in (wanted_aggs if l > 1 else ['mean']):
+
+            temps = temps_[w]
+            combo_names = [agg_type_letter[w].join(c) for c in combos]
+            logging.info('Working on {} combos of {} with {}'.format(len(combos), l, w))
+
+            cached = cache.get((w, l))
+            if not cached or cached['combos'] != combos:
+                logging.info('Computing y|x for {} combos of {}'.format(w, l))
+                cached = {'combos': combos}
+                for s in sets:
+                    y_pred, max_p = batched_aggregated_posterior(y_classif[s] if w == 'vote' else
+                                                                 stack[{'joint': 'zdist', 'mean': 'iws',
+                                                                        'mean~': 'kl'}[w]][s],
+                                                                 idx[s], agg=w, temps=temps, num_labels=num_labels)
+                    cached[s] = {'y_pred': y_pred, 'max_p': max_p}
+                    if w == 'mean':
+                        cached[s]['log_p_x_y'] = batched_log_p_x_y(stack['iws'][s], idx[s])
+                cache[(w, l)] = cached
+
+            i_true = cached[testset]['y_pred'] == y_true_
+            accuracies.update(zip(combo_names, i_true.float().mean(-1).tolist()))
+
+            if w == 'vote':
+
+                for k in ('ind', 'correct'):
+                    _temps = temps if k == 'correct' else [nan_temp]
+                    vote_tprs[k] = {}
+                    prs = {}
+                    for T in _temps:
+                        vote_in = {s: 2 * as_in[k][T][s][idx[s]].sum(1) >= l for s in sets}
+                        prs[T] = {s: (rows[s], vote_in[s].float().mean(-1)) for s in sets}
+                        for s, i_ in zip(('correct', 'incorrect'), (i_true, ~i_true)):
+                            prs[T][s] = (rows[testset], (vote_in[testset] & i_).sum(-1) / i_.sum(-1))
+                        vote_tprs[k][T] = prs[T][testset if k == 'ind' else 'correct'][1]
+
+                    for i, c in enumerate(combo_names):
+                        pr[k][c] = {'vote': {}}
+                    for T in _temps:
+                        for s in prs[T]:
+                            for i, p in zip(prs[T][s][0].tolist(), prs[T][s][1].tolist()):
+                                pr[k][combo_names[i]]['vote'].setdefault(s, {})[T] = p
+
+                continue
+
+            if not (w in agg_types['ood'] or w in agg_types['misclass'] or l == 1):
+                continue
+
+            tprs = {'ind': {tpr: tpr}, 'correct': {tpr: tpr}}
+
+            k_ = [_ for _ in ('ind', 'correct') if l == 1 or w in agg_types[in_set[_]]]
+
+            for k in k_:
+                _temps = temps if k == 'correct' else [nan_temp]
+                for c in combo_names:
+                    pr[k][c] = {}
+
+                for r in [*tprs[k], *(['vote'] if l > 1 else [])]:
+                    for T in _temps:
+                        if k == 'ind':
+                            t_in_out = {s: cached[s]['log_p_x_y'] for s in sets}
+                            mask = None
+                        else:
+                            t_in_out = {s: cached[s]['max_p'][T] for s in sets}
+                            mask = i_true
+
+                        tpr_ = tprs[k][r] if r != 'vote' else vote_tprs[k][T]
+                        tpr_l = thr_balance[k][0] * (1 - tpr_)
+                        tpr_r = 1 - thr_balance[k][1] * (1 - tpr_)
+
+                        thr = batched_thresholds(t_in_out[testset], tpr_l, tpr_r, mask=mask)
+
+                        prs = {}
+                        for s in sets:
+                            prs[s], as_in_ = batched_rates(t_in_out[s], *(_[rows[s]] for _ in thr))
+                            if l == 1 and r == tpr:
+                                as_in[k].setdefault(T, {})[s] = as_in_
+                            prs[s] = (rows[s], prs[s])
+
+                        for s, i_ in zip(('correct', 'incorrect'), (i_true, ~i_true)):
+                            prs[s] = (rows[testset], batched_rates(t_in_out[testset], *thr, mask=i_)[0])
+
+                        for s in prs:
+                            for i, p in zip(prs[s][0].tolist(), prs[s][1].tolist()):
+                                pr[k][combo_names[i]].setdefault(r, {}).setdefault(s, {})[T] = p
+
+    return accuracies, pr
 
 
 def kept_names_and_sets(y):
@@ -110,6 +239,8 @@ if __name__ == '__main__':
                       ).split()
 
     args, ra = parser.parse_known_args(None if len(sys.argv) > 1 else args_from_file)
+
+    rmodels = load_json('jobs', 'models-{}.json'.format(gethostname()))
     wanted = args.when
 
     args.agg_type.insert(0, 'vote')
@@ -171,20 +302,8 @@ if __name__ == '__main__':
     else:
         ind_balance = (1, 0)
 
-    p_y_x = {}
-
     t = {_: {} for _ in ('iws', 'zdist', 'kl')}
 
-    ind_thr = {}
-
-    as_in = {'ind': {}, 'correct': {}}
-    pr = {'ind': {}, 'correct': {}}
-
-    y_classif = {}
-    classif_acc = {}
-    agreement = {}
-    distribution = {}
-
     testset = None
     y_true = {}
 
@@ -279,190 +398,16 @@ if __name__ == '__main__':
     temps_ = {_: [nan_temp, 1, 2, 5, 10, 20, 50, 100, 200, 500] for _ in wanted_aggs}
     # temps_['vote'] = [nan_temp]
 
-    p_y_x = {}
-    log_p_x_y = {}
-    ind_thr = {}
-    correct_thr = {}
-    accuracies = {}
-
-    for combo in combos:
-
-        sets = [s for s in kept_names_by_set if all(m in kept_names_by_set[s] for m in combo)]
-        oodsets = [s for s in sets if s != testset]
-
-        all_sets = [testset, 'correct', 'incorrect', *oodsets]
-
-        logging.info('Working on {}'.format('--'.join(combo)))
-
-        for _ in t:
-            for s in sets:
-                if all(m in t[_][s] for m in combo):
-                    t[_][s][combo] = [t[_][s][m] for m in combo]
-
-        if len(combo) == 1:
-            combo_name = combo[0]
-            y_classif[combo_name] = {s: torch.argmax(t['iws'][s][combo_name], dim=0)
-                                     for s in sets}
-        for w in (wanted_aggs if len(combo) > 1 else ['mean']):
-
-            combo_name = agg_type_letter[w].join(combo)
-            saved_pth = os.path.join(saved_dir, '{}.pth'.format(combo_name))
-            is_saved = os.path.exists(saved_pth)
-            compute = args.compute or not is_saved
-
-            if compute:
-                t_pth = {}
-            else:
-                t_pth = torch.load(saved_pth)
-
-            temps = temps_[w]
-            logging.info(w)
-
-            if compute:
-                logging.info('Computing y|x for {}'.format(combo_name))
-                if w == 'joint':
-                    p_y_x[combo_name] = {s: joint_posterior(*[t['zdist'][s][_] for _ in combo], temps=temps)
-                                         for s in sets}
-                elif w == 'mean':
-                    p_y_x[combo_name] = {s: mean_posterior(*[t['iws'][s][_] for _ in combo], temps=temps)
-                                         for s in sets}
-
-                elif w == 'mean~':
-                    p_y_x_ = {s: [posterior(-t['kl'][s][_], temps=temps) for _ in combo] for s in sets}
-                    p_y_x[combo_name] = {s: {temp: torch.stack([_[temp] for _ in p_y_x_[s]]).mean(0)
-                                             for temp in temps}
-                                         for s in sets}
-
-                elif w == 'dist' or (w == 'vote'):  # and len(combo) == 1):
-                    p_y_x[combo_name] = {s: voting_posterior(*[y_classif[_][s] for _ in combo], temps=temps)
-                                         for s in sets}
-
-                t_pth['p_y_x'] = p_y_x[combo_name]
-
-            else:
-                p_y_x[combo_name] = t_pth['p_y_x']
-
-            y_classif[combo_name] = {s: p_y_x[combo_name][s][temps[0]].argmax(0) for s in sets}
-
-            i_true = (y_classif[combo_name][testset] == y_true[combo[0]][testset]).squeeze()
-            accuracies[combo_name] = i_true.float().mean().item()
-
-            for s, i_ in zip(('correct', 'incorrect'), (i_true, ~i_true)):
-                p_y_x[combo_name][s] = {t: p_y_x[combo_name][testset][t][:, i_]
-                                        for t in p_y_x[combo_name][testset]}
+    cache_pth = os.path.join(saved_dir, 'combos-{}.pth'.format(testset))
+    cache = {} if args.compute or not os.path.exists(cache_pth) else torch.load(cache_pth)
 
-            max_py = {s: {t: p_y_x[combo_name][s][t].max(0)[0] for t in
-                          p_y_x[combo_name][s]}
-                      for s in all_sets}
+    accuracies, pr = aggregate_combos(t, y_true, kept_names_by_set, testset, combo_lengths,
+                                      wanted_aggs, agg_types, temps_, tpr=tpr, ind_balance=ind_balance,
+                                      nan_temp=nan_temp, cache=cache)
 
-            in_set = {'ind': 'ood', 'correct': 'misclass'}
+    torch.save(cache, cache_pth)
 
-            if w != 'vote' and (w in agg_types['ood'] or w in agg_types['misclass']) or len(combo) == 1:
-
-                tprs = {_: {tpr: {t: tpr for t in temps}} for _ in ('ind', 'correct')}
-                thr_balance = {'ind': ind_balance, 'correct': (1, 0)}
-                if len(combo) > 1:
-                    vote_combo = combo_name.replace(agg_type_letter[w], agg_type_letter['vote'])
-                    for k in ('ind', 'correct'):
-                        tprs[k]['vote'] = pr[k][vote_combo]['vote'][testset if k == 'ind' else 'correct']
-
-                if w == 'mean' or len(combo) == 1:
-                    if compute:
-                        logging.info('Computing x|y for {}'.format(combo_name))
-
-                        log_p_x_y[combo_name] = {s: log_mean_exp(*[t['iws'][s][_] for _ in combo]).max(0)[0]
-                                                 for s in sets}
-                        t_pth['log_p_x_y'] = log_p_x_y[combo_name]
-
-                    else:
-                        log_p_x_y[combo_name] = t_pth['log_p_x_y']
-
-                    for s, i_ in zip(('correct', 'incorrect'), (i_true, ~i_true)):
-                        log_p_x_y[combo_name][s] = log_p_x_y[combo_name][testset][i_]
-
-                k_ = [_ for _ in ('ind', 'correct') if w in agg_types[in_set[_]]]
-
-                logging.debug('Computing prs')
-                for k in k_:
-                    if k == 'ind':
-                        t_in_out = {s: {nan_temp: log_p_x_y[combo_name][s]} for s in all_sets}
-                        t_in_out['ind'] = t_in_out[testset]
-                        _temps = [nan_temp]
-                    else:
-                        t_in_out = {s: max_py[s] for s in all_sets}
-                        _temps = temps
-
-                    n = {t: len(t_in_out[k][t]) for t in _temps}
-
-                    ind_thr[combo_name] = {}
-                    pr[k][combo_name] = {}
-                    as_in[k][combo_name] = {}
-                    for r in tprs[k]:
-                        tpr_l = {t: thr_balance[k][0] * (1 - tprs[k][r][t]) for t in _temps}
-                        tpr_r = {t: 1 - thr_balance[k][1] * (1 - tprs[k][r][t]) for t in _temps}
-                        i_l_r = {t: (int(n[t] * tpr_l[t]), int(n[t] * tpr_r[t]) - 1) for t in _temps}
-
-                        # print('**** {} {} {} {} {} ({}) {:.1%} {:.1%}'.format(w, k, combo_name,
-                        #                                                       *i_l_r[_temps[0]],
-                        #                                                       n[_temps[0]],
-                        #                                                       tpr_l[_temps[0]],
-                        #                                                       tpr_r[_temps[0]]))
-
-                        thr = {t: (sorted(t_in_out[k][t])[i_l_r[t][0]], sorted(t_in_out[k][t])[i_l_r[t][1]])
-                               for t in _temps}
-
-                        ind_thr[combo_name][r] = thr
-                        as_in[k][combo_name][r] = {}
-                        pr[k][combo_name][r] = {}
-
-                        for s in all_sets:
-
-                            t_ = t_in_out[s]
-                            as_in[k][combo_name][r][s] = {t: (t_[t] >= thr[t][0]) * (t_[t] <= thr[t][1])
-                                                          for t in _temps}
-                            pr[k][combo_name][r][s] = {t: as_in[k][combo_name][r][s][t].float().mean().item()
-                                                       for t in _temps}
-                logging.debug('Done computing prs')
-
-            elif w == 'vote':
-                for k in ('ind', 'correct'):
-
-                    _temps = temps if k == 'correct' else [nan_temp]
-                    as_in[k][combo_name] = {}
-                    pr[k][combo_name] = {}
-                    count_as_in = {s: {t: sum([one_hot(as_in[k][_][tpr][s][t].long(), num_classes=2)
-                                               for _ in combo])
-                                       for t in _temps}
-                                   for s in sets}
-
-                    as_in[k][combo_name]['vote'] = {s: {t: (diff(count_as_in[s][t]) >= 0).squeeze()
-                                                        for t in _temps}
-                                                    for s in sets}
-
-                    for s, i_ in zip(('correct', 'incorrect'), (i_true, ~i_true)):
-                        as_in[k][combo_name]['vote'][s] = {t: as_in[k][combo_name]['vote'][testset][t][i_]
-                                                           for t in _temps}
-
-                    pr[k][combo_name]['vote'] = {s: {t: as_in[k][combo_name]['vote'][s][t].float().mean().item()
-                                                     for t in _temps}
-                                                 for s in all_sets}
-
-                agreement[combo_name] = {s: (p_y_x[combo_name][s][temps[0]] > 0).sum(0)
-                                         for s in all_sets}
-
-                distribution[combo_name] = {s: {} for s in all_sets}
-                k_dist = [('=', _) for _ in range(1, len(combo) + 1)]
-                for _ in range(int(np.ceil(len(combo) / 2)), len(combo) + 1):
-                    k_dist.append(('>=', _))
-
-                for s in all_sets:
-                    c = (p_y_x[combo_name][s][temps[0]] * len(combo)).max(0)[0].long()
-
-                    for k in k_dist:
-                        freq = (c == k[1]).float().mean() if k[0] == '=' else (c >= k[1]).float().mean()
-                        distribution[combo_name][s][k] = freq.item()
-            if compute:
-                torch.save(t_pth, saved_pth)
+    temps = temps_[wanted_aggs[-1]]
 
     def make_dfs():
 
@@ -5,15 +5,18 @@ import os
 import sys
 import hashlib
 import logging
-import pandas as pd
 from utils.parameters import get_args, set_log, gethostname
 from utils.print_log import EpochOutput, turnoff_debug
 from utils.save_load import make_dict_from_model, available_results, save_json, load_model
-from utils.save_load import fetch_models
+from utils.save_load import fetch_models, flatten_model_dict
+from utils.save_load import eval_cache
 from utils.tables import export_losses
 from utils.texify import tex_architecture, texify_test_results, texify_test_results_df
 from utils.tables import results_dataframe, format_df_index, auto_remove_index
 from utils.testing import early_stopping
+from utils.misc import lazy_import
+
+pd = lazy_import('pandas')
 
 
 if __name__ == '__main__':
@@ -73,6 +76,10 @@ if __name__ == '__main__':
     for k, v in vars(args).items():
         logging.debug('%s: %s', k, str(v))
 
+    if args.eval_cache:
+        eval_cache.set_dir(args.eval_cache)
+    logging.debug('Evaluation cache: {}'.format(eval_cache.get_dir()))
+
     search_dir = load_dir if load_dir else job_dir
 
     registered_models_file = 'models-' + gethostname() + '.json'
@@ -323,6 +330,9 @@ if __name__ == '__main__':
         export_losses(n, which='all')
         # TK texify_test_results(n)
 
+    # nets are not needed anymore
+    models_to_be_kept = [flatten_model_dict(n) for n in models_to_be_kept]
+
     all_methods = 'all' if args.expand > 1 else 'first'
 
     tpr = [t / 100 for t in args.tpr]
@@ -0,0 +1,22 @@
+"""Random sets in place of torch_load.get_dataset, for tests to be run
+without any dataset, e.g.:
+
+    torchdl.get_dataset = lambda *a, **kw: random_sets((1, 8, 8), 3, 256)
+
+"""
+import torch
+from torch.utils.data import TensorDataset
+
+
+def random_sets(input_shape, num_labels, n, test_size=256):
+    """Training set of n samples and testing set of test_size samples,
+    always the same
+
+    """
+    g = torch.Generator().manual_seed(0)
+    sets = []
+    for n_ in (n, test_size):
+        s = TensorDataset(torch.rand(n_, *input_shape, generator=g), torch.randint(num_labels, (n_,), generator=g))
+        s.name, s.transformer = 'random', 'default'
+        sets.append(s)
+    return sets
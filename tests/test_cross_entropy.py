@@ -38,3 +38,15 @@ print(*x_.shape)
 ce = categorical_loss(x_, x, batch_mean=False)
 
 print('ce', *ce.shape)
+
+x_target = (x * 255).long().expand(*ce.shape, *image_shape)
+ce_ref = F.cross_entropy(x_.flatten(0, -5), x_target.flatten(0, -4), reduction='none').view(*ce.shape, -1).sum(-1)
+
+print('max relative diff with unfused cross entropy', ((ce - ce_ref) / ce_ref).abs().max().item())
+
+x_ = x_[0, 0, :1].detach().requires_grad_()
+g, = torch.autograd.grad(categorical_loss(x_, x[0, :1]), x_)
+ce_ref = F.cross_entropy(x_, (x[0, :1] * 255).long(), reduction='none').sum((-1, -2, -3)).mean()
+g_ref, = torch.autograd.grad(ce_ref, x_)
+
+print('max grad diff with unfused cross entropy', (g - g_ref).abs().max().item())
@@ -0,0 +1,168 @@
+"""Data parallel training with local processes (gloo, cpu): steps of n
+processes with batches of size m are compared to steps of one process
+with batches of size n x m.
+
+A small cvae with a sigma decaying towards the rmse is also trained by
+train_model with n processes and with one, on a random set of one
+batch: weights and sigma have to be the same in all processes and the
+same as with one process. With --dataset, it is trained on dataset
+(and only processes are compared).
+
+"""
+import os
+import sys
+import argparse
+import tempfile
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from utils import distributed
+from random_sets import random_sets
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', default=4, type=int, help='number of processes')
+parser.add_argument('-m', '--batch-size', default=16, type=int, help='batch size per process')
+parser.add_argument('--steps', default=10, type=int)
+parser.add_argument('--dataset', help='e.g. mnist, to test train_model')
+parser.add_argument('--epochs', default=2, type=int)
+
+args = parser.parse_args()
+
+
+def toy_model(seed):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Linear(10, 32), nn.Tanh(), nn.Linear(32, 3))
+
+
+def train(model, x, y, batch_size, rank=0, world_size=1):
+
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    losses = []
+    for i in range(args.steps):
+        # each process gets its slice of the full batch
+        start = i * batch_size * world_size + rank * batch_size
+        x_, y_ = x[start: start + batch_size], y[start: start + batch_size]
+        optimizer.zero_grad()
+        loss = nn.functional.cross_entropy(model(x_), y_)
+        loss.backward()
+        distributed.average_gradients(model.parameters())
+        optimizer.step()
+        losses.append(distributed.average_dict({'loss': loss.item()})['loss'])
+    return losses
+
+
+def launch(rank, world_size, port, x, y, q):
+
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                      RANK=str(rank), WORLD_SIZE=str(world_size))
+    distributed.init()
+
+    # different init in each process, rank 0 wins
+    model = toy_model(rank)
+    distributed.broadcast_module(model)
+
+    losses = train(model, x, y, args.batch_size, rank, world_size)
+    # numpy arrays, tensors would be shared with the dying process
+    q.put((rank, [p.detach().numpy() for p in model.parameters()], losses))
+
+    distributed.close()
+
+
+def train_cvae(rank, world_size, port, q):
+
+    import logging
+    from cvae import ClassificationVariationalNetwork as M
+    from utils.print_log import EpochOutput
+    import utils.torch_load as torchdl
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if world_size > 1:
+        os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                          RANK=str(rank), WORLD_SIZE=str(world_size))
+        distributed.init()
+
+    batch_size = args.batch_size * args.n
+    if args.dataset:
+        input_shape, num_labels = torchdl.get_shape_by_name(args.dataset)
+    else:
+        # one batch per epoch, whatever the order of samples
+        input_shape, num_labels = (1, 8, 8), 3
+        torchdl.get_dataset = lambda *a, **kw: random_sets(input_shape, num_labels, batch_size)
+
+    torch.manual_seed(rank)
+    model = M(input_shape, num_labels, type='cvae', encoder=[64], latent_dim=8, decoder=[64],
+              classifier=[16], latent_sampling=4, prior={}, sigma={'value': 0.5, 'decay': 0.1, 'reach': 1},
+              optimizer={'optim_type': 'sgd', 'momentum': 0.9})
+    model.encoder.sampling.is_sampled = False
+    trainset, testset = torchdl.get_dataset(args.dataset)
+
+    outputs = EpochOutput()
+    if not distributed.is_main() or not args.dataset:
+        outputs.streams = []
+
+    model.saved_dir = tempfile.mkdtemp()
+    model.train_model(trainset, testset=testset, oodsets=[], epochs=args.epochs, validation=0,
+                      batch_size=batch_size, test_batch_size=256,
+                      device='cpu', save_dir=model.saved_dir, outputs=outputs)
+
+    history = model.train_history
+    q.put((rank, [p.detach().numpy() for p in model.parameters()], model.sigma.value,
+           [history[e]['train_loss']['total'] for e in range(args.epochs)]))
+
+    distributed.close()
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+
+    n, m = args.n, args.batch_size
+
+    torch.manual_seed(0)
+    x = torch.randn(n * m * args.steps, 10)
+    y = torch.randint(0, 3, (n * m * args.steps,))
+
+    model = toy_model(0)
+    losses = train(model, x, y, n * m)
+    params = [p.detach().numpy() for p in model.parameters()]
+
+    q = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(launch, args=(n, free_port(), x, y, q), nprocs=n)
+
+    results = sorted([q.get() for _ in range(n)], key=lambda _: _[0])
+
+    errors = 0
+    for rank, params_, losses_ in results:
+        diff = max(abs(p - p_).max() for p, p_ in zip(params, params_))
+        loss_diff = max(abs(l - l_) for l, l_ in zip(losses, losses_))
+        ok = diff < 1e-5 and loss_diff < 1e-5
+        errors += not ok
+        print('Process {}: max param diff {:.2e}, loss diff {:.2e} {}'.format(rank, diff, loss_diff,
+                                                                              'ok' if ok else 'KO'))
+
+    cvae_results = {}
+    for world_size in (1, n):
+        q = mp.get_context('spawn').SimpleQueue()
+        # weights do not fit in the pipe, they are got before joining
+        context = mp.spawn(train_cvae, args=(world_size, free_port(), q), nprocs=world_size, join=False)
+        cvae_results[world_size] = sorted([q.get() for _ in range(world_size)], key=lambda _: _[0])
+        context.join()
+        print('{} process(es): train losses'.format(world_size),
+              ' '.join('{:.3e}'.format(_) for _ in cvae_results[world_size][0][-1]))
+
+    # processes are compared to the first one, or to the single process
+    _, params, sigma, _ = cvae_results[n if args.dataset else 1][0]
+    for rank, params_, sigma_, _ in cvae_results[n]:
+        diff = max(abs(p - p_).max() for p, p_ in zip(params, params_))
+        ok = diff < 1e-5 and abs(sigma - sigma_) < 1e-5
+        errors += not ok
+        print('cvae process {}: max param diff {:.2e}, sigma {:.4f} / {:.4f} {}'.format(rank, diff, sigma, sigma_,
+                                                                                        'ok' if ok else 'KO'))
+
+    sys.exit(errors)
@@ -0,0 +1,75 @@
+"""Evaluation cache: a model saved in two job directories is evaluated
+once, the second job getting its recorders (and thus same rates) from
+the cache.
+
+"""
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import torch
+import utils.torch_load as torchdl
+from cvae import ClassificationVariationalNetwork as M
+from utils.print_log import EpochOutput
+from utils.save_load import eval_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset', default='mnist')
+parser.add_argument('--batch-size', default=500, type=int)
+parser.add_argument('--cache', default=tempfile.mkdtemp())
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+eval_cache.set_dir(args.cache)
+
+_, testset = torchdl.get_dataset(args.dataset, splits=['test'])
+input_shape, num_labels = tuple(testset[0][0].shape), len(testset.classes)
+oodsets = [torchdl.get_dataset(_, transformer=testset.transformer, splits=['test'])[1]
+           for _ in testset.same_size[:1]]
+
+torch.manual_seed(0)
+model = M(input_shape, num_labels, type='cvae', encoder=[64], latent_dim=8, decoder=[64],
+          classifier=[16], latent_sampling=4, prior={})
+model.training_parameters.update(set=args.dataset, transformer=testset.transformer)
+# state is saved for trained models only
+model.trained = model.train_history['epochs'] = 1
+
+job_dirs = [tempfile.mkdtemp() for _ in range(2)]
+for d in job_dirs:
+    model.job_number = os.path.basename(d)
+    model.save(d)
+
+outputs = EpochOutput()
+outputs.streams = []
+
+n_evaluations = 0
+_evaluate = M.evaluate
+
+
+def evaluate(self, *a, **kw):
+    global n_evaluations
+    n_evaluations += 1
+    return _evaluate(self, *a, **kw)
+
+
+M.evaluate = evaluate
+
+results = []
+for d in job_dirs:
+    m = M.load(d)
+    sample_dirs = [os.path.join(d, 'samples', '{:04d}'.format(m.trained))]
+    os.makedirs(sample_dirs[0])
+    n_evaluations = 0
+    ood = m.ood_detection_rates(testset=testset, oodsets=oodsets, batch_size=args.batch_size,
+                                sample_dirs=sample_dirs, outputs=outputs)
+    acc = m.accuracy(testset, batch_size=args.batch_size, sample_dirs=sample_dirs, outputs=outputs)
+    print('{}: {} batches evaluated, recorders {}'.format(d, n_evaluations, ' '.join(os.listdir(sample_dirs[0]))))
+    results.append((n_evaluations, acc, {s: {_: ood[s][_]['auc'] for _ in ood[s]} for s in ood}))
+
+errors = (results[1][0] > 0) + (results[0][1:] != results[1][1:])
+print('Same results from cache' if not errors else 'KO')
+
+sys.exit(errors)
@@ -0,0 +1,76 @@
+"""Exported scorer: same scores as batch_dist_measures on the outputs of
+evaluate (with the same sampling noise), and the TorchScript file runs
+in a python without this project.
+
+"""
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import subprocess
+import torch
+from cvae import ClassificationVariationalNetwork as M
+from module import export
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--type', default='cvae', choices=list(export.EXPORTABLE_METHODS))
+parser.add_argument('--features', default='conv32')
+parser.add_argument('--upsampler', default='deconv32')
+parser.add_argument('--var-dim', default='diag')
+parser.add_argument('--batch-size', default=10, type=int)
+parser.add_argument('-m', '--methods', nargs='+')
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+input_shape, num_labels, latent_dim = (3, 32, 32), 10, 16
+
+torch.manual_seed(0)
+model = M(input_shape, num_labels, type=args.type, features=args.features, upsampler=args.upsampler,
+          encoder=[64], latent_dim=latent_dim, decoder=[64], classifier=[16], latent_sampling=4,
+          prior={'var_dim': args.var_dim})
+model.eval()
+
+methods = args.methods or [_ for _ in export.EXPORTABLE_METHODS[model.type] if _ != 'softzdist'] + ['iws-2s']
+L = model._latent_samplings['eval']
+
+x = torch.randn(args.batch_size, *input_shape)
+torch.manual_seed(1)
+# evaluate samples eps[0] and then sets it to zero
+eps = torch.randn(L + 1, args.batch_size, latent_dim)[1:]
+
+f = os.path.join(tempfile.mkdtemp(), 'scorer.pt')
+scorer = export.export(model, methods, f)
+
+with torch.no_grad():
+    scores = scorer(x, eps)
+    torch.manual_seed(1)
+    _, logits, losses, _ = model.evaluate(x)
+    measures = model.batch_dist_measures(logits, losses, methods)
+
+errors = 0
+for m, s in zip(methods, scores):
+    diff = (s - measures[m]).abs().max().item()
+    errors += diff > 1e-4
+    print('{:10} {:.2e} {}'.format(m, diff, 'KO' if diff > 1e-4 else 'ok'))
+
+torch.save({'x': x, 'eps': eps, 'scores': scores}, f + '.in')
+
+run = """
+import sys
+import torch
+scorer = torch.jit.load(sys.argv[1])
+d = torch.load(sys.argv[1] + '.in')
+print(max((a - b).abs().max().item() for a, b in zip(scorer(d['x'], d['eps']), d['scores'])))
+"""
+
+# no project on the path
+p = subprocess.run([sys.executable, '-c', run, f], cwd=tempfile.gettempdir(), capture_output=True, text=True,
+                   env={'PATH': os.environ.get('PATH', '')})
+ok = not p.returncode and float(p.stdout) < 1e-4
+errors += not ok
+print('Standalone TorchScript', 'ok' if ok else 'KO\n' + p.stderr)
+
+sys.exit(errors)
@@ -0,0 +1,78 @@
+"""Features and imager with batch norms folded in convs (in channels
+last format) give the same outputs as the original layers in eval
+mode, and are made again when weights change.
+
+"""
+import sys
+import time
+import argparse
+import logging
+import torch
+from cvae import ClassificationVariationalNetwork as M
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--features', nargs='+', default=['conv32', 'vgg11'])
+parser.add_argument('--upsampler', nargs='+', default=['deconv32', 'ivgg11'])
+parser.add_argument('--batch-size', default=128, type=int)
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+errors = 0
+x = torch.randn(args.batch_size, 3, 32, 32)
+
+for features, upsampler in zip(args.features, args.upsampler):
+    torch.manual_seed(0)
+    model = M((3, 32, 32), 10, type='cvae', features=features, upsampler=upsampler, encoder=[256], latent_dim=32,
+              decoder=[256], classifier=[], latent_sampling=4, prior={}, batch_norm='both')
+
+    # running stats of batch norms
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model.evaluate(2 * torch.randn(64, 3, 32, 32) + 1)
+
+    model.eval()
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+
+    with torch.no_grad():
+        t0 = time.time()
+        torch.manual_seed(1)
+        out = model.evaluate(x)
+        t1 = time.time()
+        with model.layers_fused_for_eval():
+            model.evaluate(x)
+            t2 = time.time()
+            torch.manual_seed(1)
+            out_ = model.evaluate(x)
+            t3 = time.time()
+            fused = model._fused_layers['features'][1]
+
+            # weights changed within the context
+            model.features[0].weight.mul_(2)
+            torch.manual_seed(1)
+            out_2 = model.evaluate(x)
+            model.features[0].weight.div_(2)
+
+            model.train()
+            # original layers when training
+            training_layer = model.layer_for_eval('features')
+            model.eval()
+
+    diff = max((out[0] - out_[0]).abs().max().item(), (out[1] - out_[1]).abs().max().item())
+    errors += diff > 1e-4
+    print('{}/{}: max diff {:.2e} {}, speedup {:.2f}'.format(features, upsampler, diff, 'KO' if diff > 1e-4 else 'ok',
+                                                          (t1 - t0) / (t3 - t2)))
+
+    ok = (out_2[1] - out_[1]).abs().max() > 0
+    errors += not ok
+    print('Fused layers made again after update', 'ok' if ok else 'KO')
+
+    ok = (all((v == state[k]).all() for k, v in model.state_dict().items())
+          and training_layer is model.features and model._fused_layers is None
+          and not any(isinstance(_, torch.nn.BatchNorm2d) for _ in fused))
+    errors += not ok
+    print('Original layers untouched', 'ok' if ok else 'KO')
+
+sys.exit(errors)
@@ -0,0 +1,70 @@
+"""GroupedStats against np.histogram / np.quantile on random groups,
+values being streamed by chunks
+
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from utils.inspection import GroupedStats
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-N', default=1000000, type=int)
+parser.add_argument('-C', default=10, type=int, help='number of classes')
+parser.add_argument('--chunk', default=100000, type=int)
+parser.add_argument('--bins', default=20, type=int)
+
+args = parser.parse_args()
+
+torch.manual_seed(0)
+
+N, C = args.N, args.C
+y = torch.randint(0, C, (N,))
+correct = torch.rand(N) > 0.2
+values = {'total': torch.randn(N) * (1 + y) + 3 * correct, 'kl': torch.rand(N).log()}
+
+stats = GroupedStats(bins=args.bins)
+set_id = stats.group_ids('set')
+class_ids = stats.group_ids(*range(C))
+hit_ids = stats.group_ids('missed', 'correct')
+
+
+def stream():
+    for start in range(0, N, args.chunk):
+        i = slice(start, start + args.chunk)
+        ids = torch.stack([set_id.expand(len(y[i])), class_ids[y[i]], hit_ids[correct[i].long()]])
+        yield {k: v[i] for k, v in values.items()}, ids
+
+
+t0 = time.time()
+stats.fit(stream)
+t_stats = time.time() - t0
+
+masks = {'set': torch.ones(N, dtype=bool), 'correct': correct, 'missed': ~correct}
+masks.update({c: y == c for c in range(C)})
+
+alpha = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+t0 = time.time()
+errors = 0
+for k, v in values.items():
+    for g, mask in masks.items():
+        v_ = v[mask].double().numpy()
+        h, e = np.histogram(v_, bins=args.bins, density=True)
+        h_, e_ = stats.histogram(g, k)
+        q = np.quantile(v_, alpha)
+        q_ = stats.quantiles(g, k, alpha)
+        n_ok = stats.count(g, k) == mask.sum().item()
+        h_ok = np.allclose(e, e_) and np.allclose(h, h_, rtol=1e-3)
+        # quantiles are exact up to the width of a fine bin
+        q_ok = np.abs(q - q_).max() < 2 * (v_.max() - v_.min()) / stats.quantile_bins
+        if not (n_ok and h_ok and q_ok):
+            errors += 1
+            print('KO', k, g, 'count' * (not n_ok), 'hist' * (not h_ok), 'quantiles' * (not q_ok))
+t_np = time.time() - t0
+
+print('{} groups x {} keys, {} errors. {:.2f}s vs {:.2f}s for numpy'.format(len(stats), len(values),
+                                                                          errors, t_stats, t_np))
+
+sys.exit(errors)
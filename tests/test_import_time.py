@@ -0,0 +1,57 @@
+"""Import time of entry points, checked against a budget on top of torch
+(whose import is not ours to cut) and against a list of heavy modules
+that must only be imported when used
+
+"""
+import sys
+import subprocess
+import argparse
+
+entry_points = {'train.py': 'train', 'test.py': 'test', 'python -m module.wim': 'module.wim.__main__'}
+
+heavy_modules = ('torchvision', 'matplotlib', 'pandas', 'sklearn', 'scipy')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--budget', default=0.5, type=float, help='seconds on top of torch')
+parser.add_argument('--repeat', default=3, type=int)
+
+args = parser.parse_args()
+
+
+def import_times(module):
+    """Returns cumulative import times (in s) of all imported modules
+
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                       capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+
+    return times
+
+
+if __name__ == '__main__':
+
+    failed = False
+
+    for entry_point, module in entry_points.items():
+
+        runs = [import_times(module) for _ in range(args.repeat)]
+        total = min(_[module] for _ in runs)
+        torch_time = min(_.get('torch', 0) for _ in runs)
+        imported_heavy = [_ for _ in heavy_modules if _ in runs[0]]
+
+        ok = total - torch_time <= args.budget and not imported_heavy
+        failed = failed or not ok
+
+        print('{:24} {:.2f}s ({:.2f}s without torch) {}'.format(entry_point, total, total - torch_time,
+                                                                  'ok' if ok else 'FAILED'))
+        if imported_heavy:
+            print('  imports {}'.format(', '.join(imported_heavy)))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,61 @@
+"""Batches of several sets interleaved in one stream of full batches:
+samples of each set are found back in order, with x being tensors or
+lists of tensors (as with estimated labels of wim).
+
+"""
+import sys
+import argparse
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+from utils.torch_load import EstimatedLabelsDataset, ListofTensors, collate, interleaved_batches
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch-size', default=32, type=int)
+
+args = parser.parse_args()
+
+lengths = {'a': 100, 'b': 37, 'c': 64}
+sets = {}
+for n, l_ in lengths.items():
+    s = EstimatedLabelsDataset(TensorDataset(torch.randn(l_, 3, 4, 4), torch.randint(10, (l_,))))
+    s.append_estimated(torch.randint(10, (l_,)))
+    sets[n] = s
+
+errors = 0
+for return_estimated in (False, True):
+
+    for s in sets.values():
+        s.return_estimated = return_estimated
+
+    iterators = {n: iter(DataLoader(s, batch_size=b, collate_fn=collate))
+                 for (n, s), b in zip(sets.items(), (16, 10, 64))}
+
+    got = {n: [] for n in sets}
+    sizes = []
+    lasts = []
+    for x, y, segments in interleaved_batches(iterators, args.batch_size):
+        ok = isinstance(x, ListofTensors) == return_estimated
+        errors += not ok
+        x_ = x[0] if return_estimated else x
+        sizes.append(len(x_))
+        for n, start, end, last in segments:
+            got[n].append((x_[start:end], y[start:end], x[1][start:end] if return_estimated else None))
+            lasts += [n] if last else []
+
+    for n, s in sets.items():
+        x = torch.cat([_[0] for _ in got[n]])
+        y = torch.cat([_[1] for _ in got[n]])
+        x_ref = torch.stack([s._dataset[i][0] for i in range(len(s))])
+        y_ref = torch.stack([s._dataset[i][1] for i in range(len(s))])
+        ok = x.equal(x_ref) and y.equal(y_ref)
+        if return_estimated:
+            ok = ok and torch.cat([_[2] for _ in got[n]]).equal(torch.as_tensor(s._estimated_labels))
+        errors += not ok
+        print('{} set {}: {} samples {}'.format('List' if return_estimated else 'Tensor', n, len(x),
+                                                'ok' if ok else 'KO'))
+
+    ok = all(_ == args.batch_size for _ in sizes[:-1]) and sorted(lasts) == sorted(sets)
+    errors += not ok
+    print('Full batches and last segments', 'ok' if ok else 'KO')
+
+sys.exit(errors)
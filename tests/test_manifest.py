@@ -0,0 +1,103 @@
+"""Missing remote files listed from manifests (or, for models saved
+without, by loading them) are the ones listed by loading every model as
+before manifests, ood sets of same size added after saving included.
+
+"""
+import os
+import sys
+import logging
+import tempfile
+import torch
+from cvae import ClassificationVariationalNetwork as M
+from utils.save_load import needed_remote_files, find_model_dirs, load_manifest
+import utils.save_load.fetch as fetch
+from utils.torch_load import get_same_size_by_name
+
+logging.getLogger().setLevel(logging.ERROR)
+
+
+def baseline_needed_remote_files(*mdirs, epoch='last', which_rec='all', state=False, optimizer=False):
+    """As before manifests, for models other than wim jobs"""
+
+    for d in mdirs:
+        m = M.load(d, build_module=False)
+        epoch_ = epoch
+        if epoch_ == 'min-loss':
+            epoch_ = m.training_parameters.get('early-min-loss', 'last')
+        if epoch_ == 'last':
+            epoch_ = max(m.testing) if m.predict_methods else max(m.ood_results or [0])
+        if isinstance(epoch_, int):
+            epoch_ = '{:04d}'.format(epoch_)
+
+        testset = m.training_parameters['set']
+        sets = []
+        recs_to_exclude = which_rec.split('-')[1:]
+        which_rec_ = which_rec.split('-')[0]
+        if which_rec_ in ('all', 'ind'):
+            sets.append(testset)
+            if which_rec_ == 'all':
+                sets += fetch.get_same_size_by_name(testset)
+                for _ in [_ for _ in recs_to_exclude if _ in sets]:
+                    sets.remove(_)
+        for s in sets:
+            sfile = os.path.join(d, 'samples', epoch_, 'record-{}.pth'.format(s))
+            if not os.path.exists(sfile):
+                yield d, sfile
+
+        for f, wanted in (('state.pth', state), ('optimizer.pth', optimizer)):
+            if wanted and not os.path.exists(os.path.join(d, f)):
+                yield d, os.path.join(d, f)
+
+
+root = tempfile.mkdtemp()
+dirs = [os.path.join(root, *_) for _ in (('cifar10', 'a', '000001'), ('cifar10', 'b', '000002'),
+                                         ('mnist', '000003'))]
+
+for job, d in enumerate(dirs, 1):
+    testset = 'mnist' if 'mnist' in d else 'cifar10'
+    model = M((1, 8, 8), 3, type='cvae', encoder=[16], latent_dim=4, decoder=[16], classifier=[8], prior={})
+    model.training_parameters.update(set=testset, transformer='default', epochs=2, validation=0,
+                                     full_test_every=10, batch_size=64, max_batch_sizes={'train': 64, 'test': 64},
+                                     warmup=[0, 0], warmup_gamma=[0, 0])
+    model.trained = model.train_history['epochs'] = 2
+    model.job_number = job
+    model.save(d)
+    sdir = os.path.join(d, 'samples', '0000')
+    os.makedirs(sdir, exist_ok=True)
+    for s in [testset, *get_same_size_by_name(testset)][::job + 1]:
+        torch.save({}, os.path.join(sdir, 'record-{}.pth'.format(s)))
+
+# saved before manifests
+os.remove(os.path.join(dirs[1], 'manifest.json'))
+os.remove(os.path.join(dirs[2], 'state.pth'))
+
+errors = 0
+
+found = sorted(find_model_dirs(root))
+walked = sorted(d for d, _, files in os.walk(root) if 'params.json' in files)
+ok = found == walked == sorted(dirs)
+errors += not ok
+print('Model dirs: {} found {}'.format(len(found), 'ok' if ok else 'KO'))
+
+manifests = [load_manifest(d) for d in dirs[:2]]
+ok = manifests[0] == manifests[1] and manifests[0]['sets'] == ['cifar10', *get_same_size_by_name('cifar10')]
+errors += not ok
+print('Manifest of model saved without manifest', 'ok' if ok else 'KO')
+
+# an ood set of same size added after saving
+_get_same_size_by_name = fetch.get_same_size_by_name
+fetch.get_same_size_by_name = lambda s: [*_get_same_size_by_name(s), s + '-new']
+
+for which_rec in ('all', 'ind', 'none', 'all-svhn-fashion'):
+    for state in (False, True):
+        kw = dict(which_rec=which_rec, state=state, optimizer=not state)
+        new = sorted(needed_remote_files(*dirs, **kw))
+        ref = sorted(baseline_needed_remote_files(*dirs, **kw))
+        ok = new == ref
+        if which_rec == 'all':
+            ok = ok and all(any(f.endswith('{}-new.pth'.format(s)) for _, f in new) for s in ('cifar10', 'mnist'))
+        errors += not ok
+        print('which_rec={:16} state={:d}: {:3} missing files {}'.format(which_rec, state, len(new),
+                                                                         'ok' if ok else 'KO'))
+
+sys.exit(errors)
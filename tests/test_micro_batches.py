@@ -0,0 +1,63 @@
+"""Training with gradients accumulated over micro batches is the same
+as training with full batches, with a sigma that decays towards the
+rmse (updated once per batch) and with a constant sigma.
+
+"""
+import sys
+import argparse
+import logging
+import tempfile
+import torch
+from cvae import ClassificationVariationalNetwork as M
+from utils.print_log import EpochOutput
+import utils.torch_load as torchdl
+from random_sets import random_sets
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch-size', default=256, type=int)
+parser.add_argument('--micro-batch-size', default=32, type=int)
+parser.add_argument('--epochs', default=5, type=int)
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.ERROR)
+
+input_shape, num_labels = (1, 8, 8), 3
+
+# one batch per epoch: the order of the training set (drawn at random
+# with the validation split) does not matter
+torchdl.get_dataset = lambda *a, **kw: random_sets(input_shape, num_labels, args.batch_size)
+
+
+def train(sigma, micro_batch_size):
+
+    torch.manual_seed(0)
+    model = M(input_shape, num_labels, type='cvae', encoder=[64], latent_dim=8, decoder=[64],
+              classifier=[16], latent_sampling=4, prior={}, sigma=sigma,
+              # adam would magnify rounding errors of small gradients
+              optimizer={'optim_type': 'sgd', 'momentum': 0.9})
+    # without sampling, the losses of a micro batch do not depend on the others
+    model.encoder.sampling.is_sampled = False
+
+    trainset, testset = torchdl.get_dataset('random')
+    outputs = EpochOutput()
+    outputs.streams = []
+    model.saved_dir = tempfile.mkdtemp()
+    model.train_model(trainset, testset=testset, oodsets=[], epochs=args.epochs, validation=0,
+                      batch_size=args.batch_size, micro_batch_size=micro_batch_size, test_batch_size=256,
+                      device='cpu', save_dir=model.saved_dir, outputs=outputs)
+
+    return model
+
+
+errors = 0
+for sigma in ({'value': 0.5, 'decay': 0.1, 'reach': 1}, {'value': 0.5}):
+    models = [train(sigma, m) for m in (args.batch_size, args.micro_batch_size)]
+    diff = max((p - p_).abs().max().item() for p, p_ in zip(*(m.parameters() for m in models)))
+    s, s_ = (m.sigma.value for m in models)
+    ok = diff < 1e-4 and abs(s - s_) < 1e-5
+    errors += not ok
+    print('sigma {}: max param diff {:.2e}, sigma {:.4f} / {:.4f} {}'.format(
+        ', '.join('{}={}'.format(*_) for _ in sigma.items()), diff, s, s_, 'ok' if ok else 'KO'))
+
+sys.exit(errors)
@@ -16,10 +16,10 @@ mix_ind = 1
 s = {_: [('{}_{:05}_{}'.format(_, i, i % 10), i % 10) for i in range(n)] for _, n in zip(names, sizes)}
 
 
-ood = MixtureDataset(ood_a=s['ood_a'], ood_b=s['ood_b'], mix=mix_ood, shift_key=94)
+ood = MixtureDataset(ood_a=s['ood_a'], ood_b=s['ood_b'], mix=mix_ood)
 
 mix = MixtureDataset(ind=s['ind__'], ood=ood, mix={'ind': mix_ind,
-                                                   'ood': 1 - mix_ind}, length=wanted_length, shift_key=67)
+                                                   'ood': 1 - mix_ind}, length=wanted_length)
 
 
 print('=== mix')
@@ -91,3 +91,10 @@ try:
     d = next(iter(loader))
 except StopIteration:
     print('Empty dataset')
+
+print('=== ZERO LENGTH')
+
+empty = MixtureDataset(ood_a=s['ood_a'], ood_b=s['ood_b'], length=0)
+print('Empty mixture of length', len(empty), 'with', len(list(torch.utils.data.DataLoader(empty, batch_size=16))),
+      'batches')
+assert len(empty) == 0
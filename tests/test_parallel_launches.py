@@ -0,0 +1,67 @@
+"""Stress test of job number allocation and atomic json writes by
+processes launched at once
+
+"""
+import os
+import sys
+import json
+import tempfile
+import argparse
+import multiprocessing as mp
+from utils.parameters import next_jobnumber
+from utils.save_load import save_json, load_json
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', default=64, type=int, help='number of processes')
+parser.add_argument('--jobs', default=5, type=int, help='job numbers per process')
+parser.add_argument('--writes', default=20, type=int, help='json writes per process')
+
+args = parser.parse_args()
+
+
+def launch(i, barrier, q):
+
+    barrier.wait()
+
+    job_numbers = [next_jobnumber(block=2 if i % 2 else None) for _ in range(args.jobs)]
+
+    torn = 0
+    for w in range(args.writes):
+        # big enough not to be written in one chunk
+        save_json({str(k): [i] * 100 for k in range(200)}, 'registry', 'models.json')
+        try:
+            d = load_json('registry', 'models.json')
+            if len(set(d['0'])) != 1:
+                torn += 1
+        except json.JSONDecodeError:
+            torn += 1
+
+    q.put((job_numbers, torn))
+
+
+if __name__ == '__main__':
+
+    os.chdir(tempfile.mkdtemp())
+
+    barrier = mp.Barrier(args.n)
+    q = mp.Queue()
+    processes = [mp.Process(target=launch, args=(i, barrier, q)) for i in range(args.n)]
+    for p in processes:
+        p.start()
+
+    results = [q.get() for _ in processes]
+    for p in processes:
+        p.join()
+
+    job_numbers = sum((_[0] for _ in results), [])
+    torn = sum(_[1] for _ in results)
+
+    duplicates = len(job_numbers) - len(set(job_numbers))
+    print('{} job numbers from {} to {}, {} duplicates'.format(len(job_numbers), min(job_numbers),
+                                                                max(job_numbers), duplicates))
+    print('{} torn json reads'.format(torn))
+
+    leftovers = [_ for _ in os.listdir('registry') if _ != 'models.json']
+    print('{} temporary files left'.format(len(leftovers)))
+
+    sys.exit(1 if duplicates or torn or leftovers else 0)
@@ -0,0 +1,71 @@
+"""Int8 copy of a model: the quantized state reloaded from the job
+directory gives the same outputs, it is made again when the weights
+have changed, and the accuracy/AUC regression report against the float
+model is printed.
+
+"""
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import torch
+import utils.torch_load as torchdl
+from cvae import ClassificationVariationalNetwork as M
+from module import quantization
+from utils.save_load import eval_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset', default='cifar10')
+parser.add_argument('--features', default='conv32')
+parser.add_argument('--upsampler', default='deconv32')
+parser.add_argument('--batch-size', default=100, type=int)
+parser.add_argument('--num-batch', default=10, type=int)
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+trainset, testset = torchdl.get_dataset(args.dataset)
+input_shape, num_labels = tuple(testset[0][0].shape), len(testset.classes)
+
+torch.manual_seed(0)
+model = M(input_shape, num_labels, type='cvae', features=args.features, upsampler=args.upsampler,
+          encoder=[256], latent_dim=32, decoder=[256], classifier=[], latent_sampling=4, prior={},
+          batch_norm='both')
+model.training_parameters.update(set=args.dataset, transformer=testset.transformer)
+# state is saved for trained models only
+model.trained = model.train_history['epochs'] = 1
+model.job_number = 0
+model.saved_dir = tempfile.mkdtemp()
+model.save(model.saved_dir)
+
+q = model.quantized(calibration_set=trainset)
+q_ = model.quantized()
+
+x, y = next(iter(torch.utils.data.DataLoader(testset, batch_size=args.batch_size)))
+with torch.no_grad():
+    torch.manual_seed(0)
+    logits = q.evaluate(x)[1]
+    torch.manual_seed(0)
+    logits_ = q_.evaluate(x)[1]
+
+errors = int((logits - logits_).abs().max() > 0)
+print('Reloaded quantized model', 'KO' if errors else 'ok')
+
+with torch.no_grad():
+    model.features[0].weight.mul_(2)
+q_2 = model.quantized()
+saved = torch.load(os.path.join(model.saved_dir, quantization.STATE_FILE), weights_only=False)
+with torch.no_grad():
+    torch.manual_seed(0)
+    logits_2 = q_2.evaluate(x)[1]
+ok = saved['source'] == eval_cache.state_hash(model) and (logits_2 - logits_).abs().max() > 0
+errors += not ok
+print('Quantized model made again after update', 'ok' if ok else 'KO')
+with torch.no_grad():
+    model.features[0].weight.div_(2)
+
+quantization.regression_report(model, testset=testset, batch_size=args.batch_size, num_batch=args.num_batch)
+
+sys.exit(errors)
@@ -0,0 +1,55 @@
+"""Accuracies and in/out rates of results tables, built from flat rows
+of model dicts, are the same as the ones unfolded from the dicts by
+unfold_df_from_dict.
+
+"""
+import sys
+import numpy as np
+import pandas as pd
+from utils.save_load import flatten_model_dict
+from utils.tables import unfold_df_from_dict, _results_cells
+
+nan = np.nan
+
+
+def rates(*values, metrics=('auc', 'fpr@95', 'P@95')):
+    return dict(zip(metrics, values))
+
+
+models = [
+    {'job': 1, 'set': 'cifar10', 'net': object(),
+     'accuracies': {'iws': 0.9, 'zdist': 0.85, 'first': 0.9},
+     'in_out_rates': {'svhn': {'iws': rates(0.8, 0.4, 0.5), 'iws*': rates(0.85, 0.3, 0.4),
+                               'kl': rates(0.7, 0.5, nan)},
+                      'lsunr': {'iws': rates(0.9, 0.2, 0.3), 'kl': {}},
+                      'errors-iws': {'msp': rates(0.7, 0.6, 0.7, metrics=('auc', 'fpr@95', 'n'))}}},
+    {'job': 2, 'set': 'cifar10', 'net': object(),
+     'accuracies': {'iws': 0.8, 'zdist': nan, 'first': 0.8, 'softkl': None},
+     'in_out_rates': {'svhn': {'iws': rates(0.75, 0.45, 0.55), 'zdist': rates(nan, nan, nan)},
+                      'cifar100': {'iws': rates(0.6, 0.7, 0.8), 'iws*': {}}}},
+    {'job': 3, 'set': 'cifar10', 'net': object(),
+     'accuracies': {'iws': 0.7},
+     'in_out_rates': {}},
+]
+
+index = pd.Index([n['job'] for n in models], name='job')
+col_names = ['set', 'method', 'metrics']
+
+# as in results_dataframe before flat rows
+df = pd.DataFrame.from_records(models, columns=['job', 'accuracies', 'in_out_rates']).set_index('job')
+acc_df = unfold_df_from_dict(df['accuracies'], depth=1, names=['method'])
+acc_df.columns = pd.MultiIndex.from_product([['cifar10'], acc_df.columns, ['acc']], names=col_names)
+in_out_df = unfold_df_from_dict(df['in_out_rates'], depth=3, names=col_names, keep={'method': ['starred']})
+
+acc_df_, in_out_df_ = _results_cells([flatten_model_dict(n) for n in models], 'cifar10', index)
+
+errors = 0
+for which, ref, new in (('accuracies', acc_df, acc_df_), ('in/out rates', in_out_df, in_out_df_)):
+    try:
+        pd.testing.assert_frame_equal(new, ref)
+        print(which, 'ok')
+    except AssertionError as e:
+        errors += 1
+        print(which, 'KO\n', e)
+
+sys.exit(errors)
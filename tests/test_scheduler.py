@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import multiprocessing as mp
+from module.wim.scheduler import Scheduler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', default=8, type=int)
+parser.add_argument('--work', default=0.2, type=float)
+
+args = parser.parse_args()
+
+
+def job(file_path, index, q, barrier):
+
+    # as in wim: start, then wait for other jobs
+    sch = Scheduler(file_path, index=index)
+    sch.start()
+    barrier.wait()
+    sch.start(block=[index - 2, index - 1] if index else False)
+    q.put(('start', index, time.time()))
+    time.sleep(args.work)
+    q.put(('stop', index, time.time()))
+    sch.stop()
+
+
+if __name__ == '__main__':
+
+    grid_dir = tempfile.mkdtemp()
+    file_path = os.path.join(grid_dir, 'grid')
+    with open(file_path, 'w') as fp:
+        fp.write('\n'.join('--job {}'.format(_) for _ in range(args.n)))
+
+    # sentinel of a dead job of this host: file exists but is not locked
+    with open('{}.{}'.format(file_path, -1), 'w') as fp:
+        fp.write(socket.gethostname() + '\n')
+
+    # sentinels of jobs of other hosts (or of older jobs) are waited for
+    # until deleted, locks of other hosts being unseen
+    for host in ('other-host', ''):
+        with open('{}.{}'.format(file_path, -2), 'w') as fp:
+            fp.write(host)
+        if not Scheduler.is_running('{}.{}'.format(file_path, -2)):
+            print('Sentinel of', host or 'unknown host', 'taken as dead')
+            sys.exit(1)
+    os.remove('{}.{}'.format(file_path, -2))
+
+    q = mp.Queue()
+    barrier = mp.Barrier(args.n)
+    jobs = [mp.Process(target=job, args=(file_path, i, q, barrier)) for i in reversed(range(args.n))]
+    for p in jobs:
+        p.start()
+    for p in jobs:
+        p.join()
+
+    events = {}
+    while not q.empty():
+        e, i, t = q.get()
+        events[e, i] = t
+
+    order = sorted(range(args.n), key=lambda i: events['start', i])
+    print('Order:', *order)
+
+    handoffs = [events['start', i] - events['stop', i - 1] for i in range(1, args.n)]
+    print('Hand-off latency: max {:.1f}ms mean {:.1f}ms'.format(1e3 * max(handoffs),
+                                                                 1e3 * sum(handoffs) / len(handoffs)))
+
+    remaining = [_ for _ in os.listdir(grid_dir) if _ != 'grid.-1' and _.startswith('grid.')]
+    print('Remaining sentinels:', *remaining)
+
+    if order != list(range(args.n)) or remaining:
+        sys.exit(1)
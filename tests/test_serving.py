@@ -0,0 +1,94 @@
+"""Scoring server: images sent one by one by concurrent clients (on
+localhost http and on a unix socket) are scored in micro batches, with
+the same scores as a direct evaluation.
+
+"""
+import os
+import sys
+import argparse
+import logging
+import tempfile
+import threading
+import torch
+from cvae import ClassificationVariationalNetwork as M
+from utils import serving
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--clients', default=16, type=int)
+parser.add_argument('--images', default=8, type=int, help='per client')
+parser.add_argument('--max-batch-size', default=32, type=int)
+parser.add_argument('--max-delay', default=20., type=float, help='in ms')
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+input_shape, num_labels = (1, 28, 28), 10
+
+torch.manual_seed(0)
+models = {'cvae': M(input_shape, num_labels, type='cvae', encoder=[64], latent_dim=8, decoder=[64],
+                    classifier=[16], latent_sampling=4, prior={}),
+          'vae': M(input_shape, num_labels, type='vae', encoder=[64], latent_dim=8, decoder=[64],
+                   latent_sampling=4, prior={})}
+
+for m in models.values():
+    # without sampling, scores of an image do not depend on its batch
+    m.encoder.sampling.is_sampled = False
+
+# iws depends on the sampling noise even without sampling
+scoring = serving.ScoringServer(models, methods=['elbo', 'kl', 'zdist'], max_batch_size=args.max_batch_size,
+                                max_delay=args.max_delay / 1000)
+
+addresses = ['localhost:0', os.path.join(tempfile.mkdtemp(), 'scoring.sock')]
+servers = [serving.serve(scoring, a) for a in addresses]
+addresses[0] = 'localhost:{}'.format(servers[0].server_address[1])
+for s in servers:
+    threading.Thread(target=s.serve_forever, daemon=True).start()
+
+x = torch.randn(args.clients, args.images, *input_shape)
+results = {}
+
+
+def client(i):
+    c = serving.Client(addresses[i % 2])
+    name = list(models)[i % len(models)]
+    results[i] = name, [c.score(name, _) for _ in x[i]]
+
+
+threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+errors = 0
+for name, model in models.items():
+    clients = [i for i in results if results[i][0] == name]
+    with torch.no_grad():
+        _, logits, losses, _ = model.evaluate(x[clients].flatten(0, 1))
+        scores = model.batch_dist_measures(logits, losses, scoring.batchers[name].methods)
+    served = {m: torch.cat([r['scores'][m] for i in clients for r in results[i][1]]) for m in scores}
+    diff = max(((served[m] - scores[m]).abs() / (1 + scores[m].abs())).max().item() for m in scores)
+    errors += diff > 1e-5
+    print('{}: max relative diff of scores {:.2e} {}'.format(name, diff, 'KO' if diff > 1e-5 else 'ok'))
+
+stats = serving.Client(addresses[1]).stats()
+for name, s in stats.items():
+    print('{}: {} images in {} batches, latency p50 {:.1f}ms p99 {:.1f}ms'.format(
+        name, s['images'], s['batches'], s['latency_ms']['p50'], s['latency_ms']['p99']))
+    errors += s['images'] != args.clients * args.images // len(models)
+    # images are gathered
+    errors += s['mean_batch_size'] <= 1
+
+try:
+    serving.Client(addresses[0]).score('foo', x[0, 0])
+    errors += 1
+except RuntimeError as e:
+    print('Unknown model:', e)
+
+for s in servers:
+    s.shutdown()
+    s.server_close()
+scoring.close()
+
+sys.exit(errors)
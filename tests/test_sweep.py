@@ -0,0 +1,113 @@
+"""Sweep of a grid section with a fake train.py (that saves untrained
+models): runs left unfinished are resumed when the sweep is started
+again, finished ones are not run again, neither when the state file of
+the sweep is lost nor when they have been run by hand.
+
+"""
+import os
+import sys
+import argparse
+import subprocess
+import logging
+import tempfile
+import configparser
+from utils import sweep
+from utils.parameters import gethostname
+from utils.save_load import fetch_models
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--threads', type=int, default=1)
+
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+
+fake_train = """
+import os
+import sys
+import argparse
+import subprocess
+import torch
+from cvae import ClassificationVariationalNetwork as M
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--job-dir')
+parser.add_argument('--job-number', type=int)
+parser.add_argument('--resume', type=int)
+parser.add_argument('--sigma', type=float)
+parser.add_argument('--num-threads', type=int)
+parser.add_argument('--epochs', type=int)
+args = parser.parse_args()
+
+torch.set_num_threads(args.num_threads)
+assert len(os.sched_getaffinity(0)) == args.num_threads
+
+model = M((1, 8, 8), 3, type='cvae', encoder=[16], latent_dim=4, decoder=[16], classifier=[8], prior={},
+          sigma=args.sigma)
+model.training_parameters.update(set='mnist', transformer='default', epochs=args.epochs, validation=0,
+                                 full_test_every=10, batch_size=64, max_batch_sizes={'train': 64, 'test': 64},
+                                 warmup=[0, 0], warmup_gamma=[0, 0])
+# runs of sigma 0.1 are interrupted the first time
+unfinished = args.sigma == 0.1 and not args.resume
+model.trained = model.train_history['epochs'] = 1 if unfinished else args.epochs
+model.job_number = args.job_number
+model.save(os.path.join(args.job_dir, '{:06d}'.format(args.job_number)))
+print('resumed' if args.resume else 'new', args.sigma)
+"""
+
+number_file = 'number-{}'.format(gethostname())
+number_file_content = open(number_file).read() if os.path.exists(number_file) else None
+
+work_dir = tempfile.mkdtemp()
+job_dir = os.path.join(work_dir, 'jobs')
+train_script = os.path.join(work_dir, 'train.py')
+with open(train_script, 'w') as f:
+    f.write(fake_train)
+os.environ['PYTHONPATH'] = os.pathsep.join([os.getcwd(), os.environ.get('PYTHONPATH', '')])
+
+config = configparser.ConfigParser()
+config.read_string('[DEFAULT]\nsigma = 1\n[grid]\nrepeat = 2\nsigma = 0.5 0.1\n[hand]\nrepeat = 2\nsigma = 0.2\n')
+
+state_file = os.path.join(job_dir, sweep.STATE_DIR, 'grid.json')
+
+
+def lose_state():
+    os.remove(state_file)
+
+
+def run_by_hand():
+    subprocess.run([sys.executable, train_script, '--job-dir', job_dir, '--job-number', '999999',
+                    '--sigma', '0.2', '--num-threads', '1', '--epochs', '2'],
+                   stdout=subprocess.DEVNULL, check=True)
+    # registered with --register
+    fetch_models(job_dir, flash=False, light=True)
+
+
+errors = 0
+# section, before the sweep, expected number of runs, of resumed runs
+expected = [('grid', None, 4, 0), ('grid', None, 2, 2), ('grid', None, 0, 0), ('grid', lose_state, 0, 0),
+            ('hand', run_by_hand, 1, 0)]
+try:
+    for i, (section, before, n_todo, n_resumed) in enumerate(expected):
+        if before:
+            before()
+        runs = sweep.expand_section(config, section)
+        s = sweep.Sweep(runs, name=section, job_dir=job_dir, train_script=train_script,
+                        common_args=['--epochs', '2'], threads=args.threads)
+        todo = s.plan()
+        n = sum(bool(_.resumed) for _ in todo)
+        ok = len(todo) == n_todo and n == n_resumed
+        failed = s.run()
+        errors += failed + (not ok)
+        print('Sweep {} of {}{}: {} runs ({} resumed), {} failed {}'.format(
+            i + 1, section, ' after ' + before.__name__.replace('_', ' ') if before else '',
+            len(todo), n, failed, 'ok' if ok else 'KO'))
+
+finally:
+    if number_file_content is None:
+        os.remove(number_file)
+    else:
+        with open(number_file, 'w') as f:
+            f.write(number_file_content)
+
+sys.exit(errors)
@@ -13,6 +13,7 @@ from utils.parameters import alphanum, list_of_alphanums, get_args, set_log, get
 from utils.save_load import find_by_job_number, NoModelError, get_submodule
 from utils.print_log import EpochOutput
 from utils.signaling import SIGHandler
+from utils import distributed
 import setproctitle
 
 if __name__ == '__main__':
@@ -34,10 +35,22 @@ if __name__ == '__main__':
     if not job_number:
         job_number = next_jobnumber()
 
+    processes = []
+    if args.processes > 1 and 'RANK' not in os.environ and not (args.show or args.where or args.dry_run):
+        processes = distributed.launch_local_processes(args.processes,
+                                                       [*sys.argv, '--job-number', str(job_number)])
+
+    if distributed.init():
+        args.force_cpu = True
+
+    is_main = distributed.is_main()
+
     log_dir = os.path.join(args.output_dir, 'log')
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    log = set_log(verbose, debug, log_dir, job_number=job_number)
+    log = set_log(verbose, debug, log_dir,
+                  name='train' if is_main else 'train-{}'.format(distributed.rank()),
+                  job_number=job_number)
 
     log.debug('$ ' + ' '.join(sys.argv))
 
@@ -47,6 +60,10 @@ if __name__ == '__main__':
     if job_number:
         log.info(f'Job number {job_number} started')
 
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+        log.debug('Using {} threads'.format(args.num_threads))
+
     if args.force_cpu:
         wanted_device = 'cpu'
     else:
@@ -272,7 +289,10 @@ if __name__ == '__main__':
 
     log.debug(f'Outputs registered in {output_file}')
     outputs = EpochOutput()
-    outputs.add_file(output_file)
+    if is_main:
+        outputs.add_file(output_file)
+    else:
+        outputs.streams = []
 
     while os.path.exists(save_dir):
         log.debug(f'{save_dir} exists')
@@ -282,15 +302,16 @@ if __name__ == '__main__':
     model.job_number = job_number
     model.saved_dir = save_dir
 
-    if args.resume:
+    if args.resume and is_main:
         with open(os.path.join(resumed_from, 'RESUMED'), 'w') as f:
             f.write(str(job_number) + '\n')
 
     if not os.path.exists(job_dir):
         os.makedirs(job_dir)
 
-    with open(os.path.join(job_dir, f'number-{hostname}'), 'w') as f:
-        f.write(str(job_number + 1) + '\n')
+    if is_main:
+        with open(os.path.join(job_dir, f'number-{hostname}'), 'w') as f:
+            f.write(str(job_number + 1) + '\n')
 
     log.info('Network built, will be saved in')
     log.info(save_dir)
@@ -334,6 +355,7 @@ if __name__ == '__main__':
                               transformer=transformer,
                               epochs=args.epochs,
                               batch_size=batch_size,
+                              micro_batch_size=args.micro_batch_size,
                               test_batch_size=test_batch_size,
                               full_test_every=2 if debug else args.full_test_every,
                               ood_detection_every=2 if debug else args.full_test_every,
@@ -355,3 +377,7 @@ if __name__ == '__main__':
             log.info('No need to train %s', model.print_architecture())
     else:
         log.info('Dry-run %s', model.print_training(epochs=epochs, set=trainset.name))
+
+    distributed.close()
+    for p in processes:
+        p.wait()
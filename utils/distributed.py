@@ -0,0 +1,173 @@
+"""Data parallel training over several processes with torch.distributed
+(gloo backend, cpu)
+
+Processes find each other with the env variables MASTER_ADDR,
+MASTER_PORT, RANK and WORLD_SIZE, as set by torchrun or by
+launch_local_processes. Without them, everything falls back to one
+process.
+
+"""
+import os
+import sys
+import socket
+import logging
+import datetime
+import subprocess
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+# rank 0 alone runs tests and ood detection while others wait
+TIMEOUT = datetime.timedelta(hours=12)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return rank() == 0
+
+
+def launch_local_processes(n, argv=None):
+    """Launch ranks 1...n-1 as copies of this script (with argv), the
+    current process will be rank 0. Returns the list of processes.
+
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                      WORLD_SIZE=str(n), RANK='0')
+
+    logging.info('Launching {} processes on port {}'.format(n - 1, port))
+    return [subprocess.Popen([sys.executable, *argv], env=dict(os.environ, RANK=str(r)))
+            for r in range(1, n)]
+
+
+def init(backend='gloo'):
+    """Join the process group if there is one, returns True if so
+
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) < 2:
+        return False
+
+    if not is_distributed():
+        dist.init_process_group(backend, timeout=TIMEOUT)
+
+    # one process per core share is better than several processes
+    # fighting for all cores
+    threads = max(1, (os.cpu_count() or 1) // world_size())
+    torch.set_num_threads(threads)
+    logging.debug('Process {} of {} with {} threads'.format(rank(), world_size(), threads))
+
+    return True
+
+
+def close():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_object(o, src=0):
+
+    if not is_distributed():
+        return o
+    objects = [o]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def broadcast_module(module, src=0):
+    """Copy parameters and buffers of src into all processes
+
+    """
+    if not is_distributed():
+        return
+
+    with torch.no_grad():
+        for t in [*module.parameters(), *module.buffers()]:
+            dist.broadcast(t.data, src=src)
+
+
+def _all_reduce_mean(tensors):
+
+    if not tensors:
+        return
+    flat = _flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    flat /= world_size()
+    for t, t_ in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        t.copy_(t_)
+
+
+def average_gradients(parameters):
+    """All reduce gradients in one flat buffer: with same-size batches in
+    each process, the step is the one of a single process with a
+    world_size times bigger batch.
+
+    """
+    if not is_distributed():
+        return
+
+    grads = [p.grad for p in parameters if p.grad is not None]
+    by_dtype = {}
+    for g in grads:
+        by_dtype.setdefault(g.dtype, []).append(g)
+
+    for g in by_dtype.values():
+        _all_reduce_mean(g)
+
+
+def average_buffers(module):
+    """Batch norm statistics are averaged over processes
+
+    """
+    if not is_distributed():
+        return
+
+    with torch.no_grad():
+        _all_reduce_mean([b for b in module.buffers() if b.is_floating_point()])
+
+
+def average_dict(d):
+    """Mean over processes of a dict of numbers (or one-element tensors),
+    keys have to be the same in all processes
+
+    """
+    if not is_distributed():
+        return d
+
+    t = torch.tensor([float(v) for v in d.values()], dtype=torch.float64)
+    dist.all_reduce(t)
+    t /= world_size()
+    return dict(zip(d, t.tolist()))
+
+
+def reduce_max(i):
+
+    if not is_distributed():
+        return i
+
+    t = torch.tensor(i)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return t.item()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
@@ -128,7 +128,220 @@ def output_latent_distribution(mu_z, var_z, *outputs, result_type='hist_of_var',
         close()
 
 
-def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses'), plot=False, **kw):
+class GroupedStats:
+    r"""Counts, means, histograms and quantiles of values (e.g. losses)
+    for all groups of samples at once, with bincount and scatter_reduce
+
+    -- bins: number of bins of histograms
+
+    -- quantile_bins: quantiles are interpolated in histograms with
+       that many bins, hence values do not have to be kept
+
+    Groups are named (any hashable, see group_ids) and a sample can be
+    in several groups: ids are given as a (G, N) tensor for N samples
+    and G groupings, -1 meaning no group.
+
+    Values are seen twice (see fit): once for the range of values per
+    group, once for histograms on these ranges. Only one chunk of
+    values has to be in memory at once.
+
+    """
+
+    def __init__(self, bins=10, quantile_bins=4096):
+
+        self.bins = bins
+        self.quantile_bins = quantile_bins
+
+        self.groups = []
+        self._ids = {}
+
+        self._count = {}
+        self._sum = {}
+        self._min = {}
+        self._max = {}
+        self._hist = {}
+        self._fine_hist = {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def group_ids(self, *names):
+
+        for n in names:
+            if n not in self._ids:
+                self._ids[n] = len(self.groups)
+                self.groups.append(n)
+
+        return torch.tensor([self._ids[n] for n in names])
+
+    def _flatten(self, values, ids):
+
+        ids = ids.view(-1, ids.shape[-1])
+        in_group = ids >= 0
+        if in_group.all():
+            i = None
+            ids = ids.reshape(-1)
+        else:
+            i = in_group.nonzero()[:, 1]
+            ids = ids[in_group]
+
+        for k, v in values.items():
+            v = v.reshape(-1).double()
+            v = v.repeat(len(in_group)) if i is None else v[i]
+            finite = v.isfinite()
+            if finite.all():
+                yield k, v, ids
+            else:
+                yield k, v[finite], ids[finite]
+
+    def _grow(self, d, k, fill, shape=()):
+
+        t = d.get(k)
+        n = 0 if t is None else len(t)
+        if n < len(self):
+            t_ = torch.full((len(self) - n, *shape), fill,
+                            dtype=torch.double if isinstance(fill, float) else torch.long)
+            d[k] = t_ if t is None else torch.cat([t, t_])
+
+        return d[k]
+
+    def update_range(self, values, ids):
+        """First pass
+
+        """
+
+        for k, v, g in self._flatten(values, ids):
+            count = self._grow(self._count, k, 0)
+            count += torch.bincount(g, minlength=len(self))
+            self._grow(self._sum, k, 0.).index_add_(0, g, v)
+            self._grow(self._min, k, np.inf).scatter_reduce_(0, g, v, 'amin')
+            self._grow(self._max, k, -np.inf).scatter_reduce_(0, g, v, 'amax')
+
+    def _edges(self, k):
+        """as np.histogram, empty ranges are widened by 1
+
+        """
+        lo, hi = self._min[k].clone(), self._max[k].clone()
+        empty = hi <= lo
+        lo[empty] -= 0.5
+        hi[empty] += 0.5
+        return lo, hi
+
+    def update_hist(self, values, ids):
+        """Second pass, ranges of values are the ones of the first pass
+
+        """
+
+        for k, v, g in self._flatten(values, ids):
+            lo, hi = self._edges(k)
+            x = (v - lo[g]) / (hi[g] - lo[g])
+            for bins, hist in ((self.bins, self._hist), (self.quantile_bins, self._fine_hist)):
+                b = (x * bins).long().clamp_(0, bins - 1)
+                h = self._grow(hist, k, 0, (bins,))
+                h += torch.bincount(g * bins + b, minlength=len(h) * bins).view(-1, bins)
+
+    def fit(self, stream):
+        """stream: function returning an iterable of (values, ids) where
+        values is a dict of tensors of N samples (as many as ids)
+
+        """
+        for values, ids in stream():
+            self.update_range(values, ids)
+
+        for values, ids in stream():
+            self.update_hist(values, ids)
+
+        return self
+
+    def count(self, name, k=None):
+
+        if k is None:
+            k = next(iter(self._count))
+        i = self._ids.get(name)
+        count = self._count[k]
+        return 0 if i is None or i >= len(count) else count[i].item()
+
+    def mean(self, name, k):
+
+        return self._sum[k][self._ids[name]].item() / self.count(name, k)
+
+    def histogram(self, name, k, density=True):
+        """As np.histogram: returns values per bin and bin edges
+
+        """
+        i = self._ids[name]
+        lo, hi = self._edges(k)
+        edges = np.linspace(lo[i].item(), hi[i].item(), self.bins + 1)
+        h = self._hist[k][i].numpy()
+
+        if density:
+            return h / h.sum() / np.diff(edges), edges
+
+        return h, edges
+
+    def quantiles(self, name, k, alpha):
+
+        i = self._ids[name]
+        lo, hi = self._edges(k)
+        lo, hi = lo[i].item(), hi[i].item()
+        h = self._fine_hist[k][i].numpy()
+        cdf = np.concatenate([[0], np.cumsum(h)])
+
+        # linear interpolation of the inverse cdf inside bins
+        positions = np.asarray(alpha) * cdf[-1]
+        b = np.clip(np.searchsorted(cdf, positions, side='left') - 1, 0, len(h) - 1)
+        within = (positions - cdf[b]) / np.maximum(h[b], 1)
+
+        q = lo + (b + within) * (hi - lo) / len(h)
+        return np.clip(q, self._min[k][i].item(), self._max[k][i].item())
+
+    def boxplot_stats(self, name, k, whis=1.5):
+
+        q1, med, q3 = self.quantiles(name, k, [0.25, 0.5, 0.75])
+        lo, hi = self._min[k][self._ids[name]].item(), self._max[k][self._ids[name]].item()
+        iqr = q3 - q1
+
+        return dict(med=med, q1=q1, q3=q3, fliers=[],
+                    whislo=max(lo, q1 - whis * iqr),
+                    whishi=min(hi, q3 + whis * iqr))
+
+
+def _recorder_stream(net, recorders, testset, stats, keys, chunk=2 ** 16):
+    """Per chunk of samples, ids of groups set, (set, predicted class),
+    and correct / missed (for testset)
+
+    """
+
+    C = net.num_labels
+
+    def stream():
+        for s, path in recorders.items():
+            r = LossRecorder.load_mapped(path)
+            n = r.recorded_samples
+            set_id = stats.group_ids(s)
+            class_ids = stats.group_ids(*((s, c) for c in range(C)))
+            hit_ids = stats.group_ids('missed', 'correct')
+
+            for start in range(0, n, chunk):
+                t = {k: v.narrow(-1, start, min(chunk, n - start)) for k, v in r._tensors.items()}
+
+                logits = t.pop('logits').T
+                y_true = t.pop('y_true', None)
+                y_pred = net.predict_after_evaluate(logits, t)
+                losses = {k: t[k].gather(0, y_pred.unsqueeze(0)).squeeze(0) if t[k].dim() == 2 else t[k]
+                          for k in keys if k in t}
+
+                ids = [set_id.expand(len(y_pred)), class_ids[y_pred]]
+                if s == testset:
+                    ids.append(hit_ids[(y_pred == y_true).long()])
+
+                yield losses, torch.stack(ids)
+
+    return stream
+
+
+def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses'), plot=False,
+                     bins=10, **kw):
 
     if plot == True:
         plot = 'all'
@@ -145,33 +358,17 @@ def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses')
     testset = net.training_parameters['set']
     datasets = [testset] + list(net.ood_results.keys())
 
-    losses = {}
-    logits = {}
-    y_pred = {}
-
-    recorders = LossRecorder.loadall(sample_directory, *datasets)
-
-    for s in recorders:
-        r = recorders[s]
-        r.to('cpu')
-        losses[s] = r._tensors
-        logits[s] = losses[s].pop('logits').T
-        y_pred[s] = net.predict_after_evaluate(logits[s], losses[s])
-
-    y_true = losses[testset].pop('y_true')
-    i_miss = np.where(y_true != y_pred[testset])[0]
-    i_true = np.where(y_true == y_pred[testset])[0]
-
-    for s in losses:
-        for k in losses[s]:
-            if len(losses[s][k].shape) == 2:
-                losses[s][k] = losses[s][k].gather(0, y_pred[s].unsqueeze(0)).squeeze()
+    recorders = LossRecorder.loadall(sample_directory, *datasets, output='paths')
 
-    for w, i in zip(('correct', 'missed'), (i_true, i_miss)):
+    stats = GroupedStats(bins=bins)
+    stats.group_ids(*recorders, 'correct', 'missed')
+    stats.fit(_recorder_stream(net, recorders, testset, stats, ('total', 'cross_x', 'kl')))
 
-        losses[w] = {k: losses[testset][k][i] for k in losses[testset]}
+    keys = [k for k in ('total', 'cross_x', 'kl') if k in stats._count]
+    groups_per_set = {s: s for s in (*recorders, 'correct', 'missed') if stats.count(s)}
+    groups_per_class = {f'{c}': (testset, c) for c in range(net.num_labels)}
 
-    for k in ('total', 'cross_x', 'kl'):
+    for k in keys:
         logging.info('Distribution of %s', k)
         for graph in ('hist', 'boxp'):
             f_ = f'losses-{k}-per-set'
@@ -180,17 +377,13 @@ def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses')
             if plot and (plot == 'all' or plot.startswith(graph)):
                 a = plt.figure(f_ + str(net.job_number)).subplots(1)
 
-            losses_distribution_graphs({s: losses[s][k] for s in losses},
+            losses_distribution_graphs(stats, k, groups_per_set,
                                        f, sys.stdout, a,
                                        graph=graph,
                                        **kw)
 
-    for k in ('total', 'cross_x', 'kl'):  # losses[testset]:
+    for k in keys:  # losses[testset]:
         logging.info('Distribution of %s per class', k)
-        losses_per_class = {}
-        for c in range(net.num_labels):
-            pred_is_c = torch.where(y_pred[testset] == c)[0]
-            losses_per_class[f'{c}'] = losses[testset][k][pred_is_c]
         for graph in ('hist', 'boxp'):
             f_ = f'losses-{k}-per-class.tab'
             f = os.path.join(root, f_ + f'-{graph}.tab')
@@ -198,13 +391,11 @@ def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses')
             if plot and (plot == 'all' or plot.startswith(graph)):
                 a = plt.figure(f_ + str(net.job_number)).subplots(1)
 
-            losses_distribution_graphs(losses_per_class,
+            losses_distribution_graphs(stats, k, groups_per_class,
                                        f, sys.stdout, a,
                                        graph=graph, **kw)
 
-    n_pred = {}
-    for s in y_pred:
-        n_pred[s] = [sum(y_pred[s] == c) for c in range(net.num_labels)]
+    n_pred = {s: [stats.count((s, c)) for c in range(net.num_labels)] for s in recorders}
 
     f = os.path.join(root, 'predicted-classes-per-set.tab')
     with open(f, 'w') as f:
@@ -214,51 +405,61 @@ def loss_comparisons(net, root=os.path.join(DEFAULT_RESULTS_DIR, '%j', 'losses')
             f.write(' '.join([f'{n_pred[s][c]:6}' for s in n_pred]) + '\n')
 
 
-def losses_distribution_graphs(dict_of_losses,
+def losses_distribution_graphs(stats, key, groups,
                                *outputs,
                                graph='histogram',  # or boxplot
                                **opt,):
+    r"""Distributions of key in stats (GroupedStats) for groups, a dict
+    of label: group name
+
+    """
 
-    bins = opt.pop('bins', 10)
     whis = opt.pop('whis', 1.5)
 
     alpha = opt.pop('quantiles', [0.05, 0.25, 0.5, 0.75, 0.95])
 
+    bins = stats.bins
+
+    groups = {k: g for k, g in groups.items() if stats.count(g, key)}
+
     if graph.startswith('hist'):
         plot, write, close = _create_output_plot(*outputs,
                                                  pltf='plot',)
         # pltf='plot',)
 
-        hist = {k: np.histogram(dict_of_losses[k], bins=bins, density=True)
-                for k in dict_of_losses}
+        hist = {k: stats.histogram(g, key) for k, g in groups.items()}
 
-        write(' '.join(['edge-{k:<8} num-{k:<7}'.format(k=k) for k in dict_of_losses]))
+        write(' '.join(['edge-{k:<8} num-{k:<7}'.format(k=k) for k in groups]))
         write('\n')
 
         for b in range(bins - 1):
             write(' '.join(['{e:-13.6e} {v:-12g}'.format(e=hist[k][1][b],
                                                          v=hist[k][0][b])
-                            for k in dict_of_losses]))
+                            for k in groups]))
             write('\n')
 
         write(' '.join(['{e:-13.6e} {v:-12g}'.format(e=hist[k][1][-1],
                                                      v=0)
-                        for k in dict_of_losses]))
+                        for k in groups]))
         write('\n')
 
-        for k in dict_of_losses:
+        for k in groups:
             plot(hist[k][1][:-1], hist[k][0], label=k, legend=True)  # , align='edge')
 
+        close()
+
     if graph.startswith('box'):
-        plot, write, close = _create_output_plot(*outputs, pltf='boxplot')
+        plot, write, close = _create_output_plot(*outputs, pltf='bxp')
 
-        quantiles = {k: np.quantile(dict_of_losses[k], alpha) for k in dict_of_losses}
+        quantiles = {k: stats.quantiles(g, key, alpha) for k, g in groups.items()}
 
         write('{:20} '.format('which') + ' '.join([f'{a:14}' for a in alpha]) + '\n')
         for k in quantiles:
             write(f'{k:20} ' + ' '.join([f'{q:-14.7e}' for q in quantiles[k]]) + '\n')
 
-        plot([l.numpy() for l in dict_of_losses.values()], labels=dict_of_losses.keys())
+        plot([dict(label=k, **stats.boxplot_stats(g, key, whis=whis)) for k, g in groups.items()])
+
+        close()
 
 
 if __name__ == '__main__':
@@ -1,3 +1,6 @@
+import importlib
+
+
 def make_list(o, default_for_all):
 
     if isinstance(o, str):
@@ -11,3 +14,24 @@ def make_list(o, default_for_all):
         return [next(iter(default_for_all))]
 
     return o
+
+
+class lazy_import(object):
+    """Module imported at first attribute access, to keep heavy imports
+    (torchvision, matplotlib, pandas, sklearn...) off startup
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, a):
+        if a.startswith('__'):
+            raise AttributeError(a)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, a)
+
+    def __repr__(self):
+        return '<lazy module {}{}>'.format(self._name, '' if self._module is None else ' (imported)')
@@ -9,6 +9,8 @@ import numpy as np
 from socket import gethostname as getrawhostname
 from utils.filters import ParamFilter, FilterAction, DictOfListsOfParamFilters, MetaFilter, get_filter_keys
 import os
+import fcntl
+from contextlib import contextmanager
 
 DEFAULT_JOBS_DIR = 'jobs'
 DEFAULT_RESULTS_DIR = 'jobs/results'
@@ -30,33 +32,71 @@ def gethostname():
     return raw_host.split('.')[0].lower()
 
 
-def next_jobnumber():
+JOBNUMBER_BLOCK = 1
 
-    j = get_last_jobnumber()
-    register_last_jobnumber(j + 1)
-    return j + 1
+_reserved_jobnumbers = []
 
 
-def get_last_jobnumber():
+def next_jobnumber(block=None):
+    """Job numbers are taken from a block reserved for the process, a new
+    block of JOBNUMBER_BLOCK numbers being allocated when exhausted
+
+    """
+    if not _reserved_jobnumbers:
+        _reserved_jobnumbers.extend(allocate_jobnumbers(block or JOBNUMBER_BLOCK))
+
+    return _reserved_jobnumbers.pop(0)
+
+
+@contextmanager
+def _locked_number_file(exclusive=True):
 
     hostname = gethostname()
+    fd = os.open(f'number-{hostname}', os.O_RDWR | os.O_CREAT, 0o666)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield f
 
-    try:
-        with open(f'number-{hostname}') as f:
-            return int(f.read())
 
-    except FileNotFoundError:
-        logging.warning(f'File number-{hostname} not found.')
+def _read_number_file(f):
 
-    return 0
+    content = f.read()
+    if not content.strip():
+        logging.warning(f'File number-{gethostname()} not found.')
+        return 0
+    return int(content)
 
 
-def register_last_jobnumber(job_number):
+def _write_number_file(f, job_number):
 
-    hostname = gethostname()
+    f.seek(0)
+    f.truncate()
+    f.write(str(job_number) + '\n')
+    f.flush()
+
+
+def allocate_jobnumbers(n=1):
+    """Atomically allocate n successive job numbers, the number file
+    being locked while read and rewritten
 
-    with open(os.path.join(f'number-{hostname}'), 'w') as f:
-        f.write(str(job_number) + '\n')
+    """
+    with _locked_number_file() as f:
+        j = _read_number_file(f)
+        _write_number_file(f, j + n)
+
+    return list(range(j + 1, j + n + 1))
+
+
+def get_last_jobnumber():
+
+    with _locked_number_file(exclusive=False) as f:
+        return _read_number_file(f)
+
+
+def register_last_jobnumber(job_number):
+
+    with _locked_number_file() as f:
+        _write_number_file(f, job_number)
 
 
 def in_list_with_starred(k, list_with_starred):
@@ -230,6 +270,8 @@ def get_args_for_train(argv=None):
     parser.add_argument('--epochs', type=int, help=help)
 
     parser.add_argument('-M', '--batch-size', type=int, metavar='m')
+    parser.add_argument('--micro-batch-size', type=int, metavar='m',
+                        help='Gradients accumulated over micro batches (default: max batch size)')
     parser.add_argument('-m', '--test-batch-size', type=int, metavar='M', default=1024)
 
     help = 'Num of samples to compute test accuracy at each epoch'
@@ -242,6 +284,10 @@ def get_args_for_train(argv=None):
 
     parser.add_argument('--device', default='cuda')
     parser.add_argument('--force-cpu', action='store_true')
+    parser.add_argument('--processes', type=int, default=1, metavar='N',
+                        help='Data parallel training on cpu with N local processes')
+    parser.add_argument('--num-threads', type=int, metavar='N',
+                        help='Threads of torch (default is one per core)')
     parser.add_argument('--dry-run', action='store_true',
                         help='will show you what it would do')
 
@@ -444,6 +490,9 @@ def get_args_for_results(argv=None):
 
     parser.add_argument('--register', dest='flash', action='store_false')
 
+    help = 'Directory of recorders shared by models with same weights (default: $EVAL_CACHE_DIR)'
+    parser.add_argument('--eval-cache', metavar='DIR', help=help)
+
     parser.add_argument('--dry-run', action='store_true',
                         help='will show you what it would do')
 
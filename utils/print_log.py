@@ -2,12 +2,14 @@ import time
 import numpy as np
 import logging
 import torch
-import pandas as pd
 import sys
 import re
 import functools
 from contextlib import contextmanager
 import os
+import threading
+import queue
+import atexit
 
 
 def harddebug(*a):
@@ -48,11 +50,19 @@ def turnoff_debug(turnoff=True, logger=None, type_of_stream=os.sys.stderr):
 
 
 class EpochOutput:
+    """Rows of results are formatted and written by a background thread,
+    per batch rows being throttled to one every REFRESH seconds. When
+    stdout is not a tty, only headers and end of epoch/set rows are
+    written on it.
+
+    """
 
     EVERY_BATCH = 20
     END_OF_EPOCH = 10
     END_OF_SET = 0
 
+    REFRESH = 0.2
+
     CELL_WIDTH = 9
 
     unix_tags = [('%B', '\033[1m'),
@@ -74,13 +84,70 @@ class EpochOutput:
                     }
     cell_formats['fpr'] = cell_formats['accuracy']
 
-    def __init__(self):
+    def __init__(self, refresh=REFRESH, asynchronous=True):
 
-        stdout = {'stream': sys.stdout, 'when': self.EVERY_BATCH, 'tags': self.unix_tags}
+        when = self.EVERY_BATCH if sys.stdout.isatty() else self.END_OF_EPOCH
+        stdout = {'stream': sys.stdout, 'when': when, 'tags': self.unix_tags}
         self.streams = [stdout]
         self.files = []
         self.last_row = []
 
+        self.refresh = refresh
+        self._last_refresh = 0.
+
+        self.asynchronous = asynchronous
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._flushed_at_exit = False
+
+    def _enqueue(self, func, *a, **kw):
+
+        if not self.asynchronous:
+            func(*a, **kw)
+            return
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            if not self._flushed_at_exit:
+                atexit.register(self.flush)
+                self._flushed_at_exit = True
+
+        self._queue.put((func, a, kw))
+
+    def _run(self):
+
+        while True:
+            func, a, kw = self._queue.get()
+            try:
+                func(*a, **kw)
+            except Exception as e:
+                logging.error('Output failed: {}'.format(e))
+
+    def flush(self):
+        """Wait for all queued rows to be written
+
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put((done.set, (), {}))
+        done.wait()
+
+    def __getstate__(self):
+
+        self.flush()
+        state = self.__dict__.copy()
+        state.pop('_queue')
+        state['_thread'] = None
+        state['_flushed_at_exit'] = False
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._queue = queue.SimpleQueue()
+
     def format_encoding(self, string, tags=no_style_tags):
 
         s = string
@@ -95,6 +162,10 @@ class EpochOutput:
 
     def write(self, string, when=END_OF_EPOCH):
 
+        self._enqueue(self._write, string, when=when)
+
+    def _write(self, string, when=END_OF_EPOCH):
+
         for stream in self.streams:
             if stream['when'] >= when:
                 stream['stream'].write(self.format_encoding(string, stream['tags']))
@@ -150,6 +221,35 @@ class EpochOutput:
                 **kvs,
                 ):
 
+        if batch and batch < batches - 1:
+            t = time.time()
+            if t - self._last_refresh < self.refresh:
+                return
+            self._last_refresh = t
+
+        # tensors are detached, not to sync until formatted
+        kvs = {title: {k: v.detach() if isinstance(v, torch.Tensor) else v for k, v in kvs[title].items()}
+               for title in kvs}
+
+        self._enqueue(self._results, batch, batches, epoch, epochs,
+                      masked_components=masked_components,
+                      best_of=best_of,
+                      time_per_i=time_per_i,
+                      batch_size=batch_size,
+                      preambule=preambule,
+                      end_of_epoch=end_of_epoch,
+                      **kvs)
+
+    def _results(self, batch, batches, epoch, epochs,
+                 masked_components=['z_logdet', 'z_mahala', 'z_tr_inv_cov'],
+                 best_of={'odin': -1},
+                 time_per_i=0,
+                 batch_size=100,
+                 preambule='',
+                 end_of_epoch='\n',
+                 **kvs,
+                 ):
+
         if preambule == 'train' and batch and False:
             preambule = '%I' + preambule
             end_of_format = '%i'
@@ -198,17 +298,17 @@ class EpochOutput:
         if not batch:
             if self.last_row != [*kept_kvs]:
                 line = '\r' + self.result_row(header=3, sep=sep, double_sep=double_sep, **kept_kvs)
-                self.write(line + '\n', when=self.END_OF_EPOCH)
+                self._write(line + '\n', when=self.END_OF_EPOCH)
                 line = '\r' + self.result_row(header=2, sep=sep, double_sep=double_sep, **kept_kvs)
-                self.write(line + '\n', when=self.END_OF_EPOCH)
+                self._write(line + '\n', when=self.END_OF_EPOCH)
                 line = '\r' + self.result_row(header=1, sep=sep, double_sep=double_sep, **kept_kvs)
-                self.write(line + '\n', when=self.END_OF_EPOCH)
+                self._write(line + '\n', when=self.END_OF_EPOCH)
 
         line = '\r' + self.result_row(header=False, sep=sep, double_sep=double_sep, **kept_kvs)
-        self.write(line, when=self.EVERY_BATCH)
+        self._write(line, when=self.EVERY_BATCH)
 
         if batch == batches - 1:
-            self.write(line + '\n', when=self.END_OF_EPOCH)
+            self._write(line + '\n', when=self.END_OF_EPOCH)
 
 
 def texify_str(s, num=False, space=None, underscore=None, verbatim=False):
@@ -1,8 +1,10 @@
 from time import time
 import numpy as np
-from sklearn.metrics import auc, roc_curve as fast_roc_curve
 import logging
-from scipy.interpolate import UnivariateSpline
+from utils.misc import lazy_import
+
+metrics = lazy_import('sklearn.metrics')
+interpolate = lazy_import('scipy.interpolate')
 
 
 def fpr_at_tpr(fpr, tpr, a, thresholds=None,
@@ -35,6 +37,43 @@ def tpr_at_fpr(fpr, tpr, a):
     return as_tpr[i_fpr].max()
 
 
+def count_in(sorted_values, low, up):
+    """Number of sorted values (nans at the end) in [low, up] for each of
+    thresholds low and up
+
+    """
+    return (np.searchsorted(sorted_values, up, side='right')
+            - np.searchsorted(sorted_values, low, side='left'))
+
+
+def precision_recall_curve(ins, outs):
+    """Precision and recall of ins (positives, higher than outs) for all
+    thresholds, computed with one sort and cumulated sums.
+
+    Returns precisions, recalls and thresholds (in decreasing order), and
+    area under the curve (average precision)
+
+    """
+    scores = np.concatenate([ins, outs])
+    positives = np.concatenate([np.ones(len(ins)), np.zeros(len(outs))])
+
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    positives = positives[order]
+
+    last_of_thresholds = np.append(np.nonzero(np.diff(scores))[0], len(scores) - 1)
+
+    tp = np.cumsum(positives)[last_of_thresholds]
+    fp = 1 + last_of_thresholds - tp
+
+    precision = tp / (tp + fp)
+    recall = tp / len(ins)
+
+    aupr = np.sum(np.diff(recall, prepend=0) * precision)
+
+    return precision, recall, scores[last_of_thresholds], aupr
+
+
 def roc_curve(ins, outs, *kept_tpr, two_sided=False, validation=0, debug=False, ins_are_higher=True):
 
     sign = 1 if ins_are_higher else -1
@@ -76,7 +115,7 @@ def roc_curve(ins, outs, *kept_tpr, two_sided=False, validation=0, debug=False,
         old_indices = np.arange(0, len(ins_validation))
         new_length = len(ins)
         new_indices = np.linspace(0, len(ins_validation) - 1, new_length)
-        spl = UnivariateSpline(old_indices, ins_validation, k=3, s=0)
+        spl = interpolate.UnivariateSpline(old_indices, ins_validation, k=3, s=0)
         interpolated_ins_validation = spl(new_indices)
         for f, k in zip(two_sided, ('low', 'up')):
             t = ins_validation[::f]
@@ -87,122 +126,62 @@ def roc_curve(ins, outs, *kept_tpr, two_sided=False, validation=0, debug=False,
         all_thresholds['low'] = np.concatenate([[-np.inf], np.sort(ins[test_ins_idx])])
         all_thresholds['up'] = np.ones_like(all_thresholds['low']) * np.inf
 
-    relevant_thresholds = []
-    relevant_fpr = []
-    relevant_tpr = []
-    relevant_prec = []
-
-    last_fpr = -.01
-
     original_kept_tpr = sorted(kept_tpr)
     kept_tpr = np.zeros(len(kept_tpr))
     kept_fpr = np.ones_like(kept_tpr)
     kept_thresholds = {'low': -np.inf * np.ones_like(kept_tpr), 'up': +np.inf * np.ones_like(kept_tpr)}
-    kept_precisions = np.zeros_like(kept_tpr)
-
-    if debug == 'time':
-        t0 = time()
-        if debug:
-            print('*** Going through thresholds')
 
     n = {'in': len(sorted_ins),
          'out': len(sorted_outs)}
 
     scores = {'in': sorted_ins, 'out': sorted_outs}
 
-    idx = {'in': {'low': 0, 'up': -1},
-           'out': {'low': 0, 'up': -1},
-           'thr': {'low': 0, 'up': -1}}
-
-    t = {_: all_thresholds[_][idx['thr'][_]] for _ in ('low', 'up')}
-
-    last_fpr = 1.1
-    last_tpr = 1.1
-
-    kept_tpr_i = -1
-
-    num_print = 500
-    every_print = max(len(all_thresholds['low']) // num_print, 1)
-
-    it = 0
     nt = min(len(all_thresholds[_]) for _ in ('up', 'low'))
 
-    if debug:
-        if two_sided == 'around-mean':
-            print('mean: {:.6g} ({}) real: {:.6g} ({:.5g})'.format(center,
-                                                                   len(ins_validation),
-                                                                   ins.mean(),
-                                                                   ins.std()
-                                                                   ))
-
-    while t['low'] < t['up'] and it < nt - 1:
-
-        for w in ('out', 'in'):
-            while idx[w]['low'] < n[w] - 1 and scores[w][idx[w]['low']] < t['low']:
-                idx[w]['low'] += 1
-            while idx[w]['up'] > -n[w] and scores[w][idx[w]['up']] > t['up']:
-                idx[w]['up'] -= 1
-
-        # neg = {w: max(0, idx[w]['low'] - 1) - idx[w]['up'] - 1 for w in ('out', 'in')}
-        neg = {w: idx[w]['low'] - (idx[w]['up'] + 1) for w in ('out', 'in')}
-
-        tpr = 1 - neg['in'] / n['in']
-        fpr = 1 - neg['out'] / n['out']
-
-        _s = ' <= '.join(['{:-13.7g}'] * 4)
-
-        if not it % every_print:
-
-            if debug:
-                for w in ('in', 'out'):
-                    print('{:3}:'.format(w), end=' ')
-                    print(_s.format(t['low'],
-                                    scores[w][idx[w]['low']],
-                                    scores[w][idx[w]['up']],
-                                    t['up']),
-                          end=' | ')
-                    print(idx[w]['low'], idx[w]['up'], '[', len(scores[w]), ']')
-
-                print('|_FPR={:6.2%} TPR={:6.2%}'.format(fpr, tpr))
-
-        it += 1
-        idx['thr']['low'] += 1
-        idx['thr']['up'] -= 1
-
-        t = {_: all_thresholds[_][idx['thr'][_]] for _ in ('low', 'up')}
-
-        if fpr >= 0 and tpr >= 0:
-            relevant_thresholds.append((t['low'], t['up']))
-            relevant_tpr.append(tpr)
-            relevant_fpr.append(fpr)
-            last_fpr = fpr
-            last_tpr = tpr
-
-        if kept_tpr_i >= - len(kept_tpr):
-            if tpr < original_kept_tpr[kept_tpr_i]:
-                kept_tpr_i -= 1
-            else:
-                # print('  {:6.2%} {:6.2%}>={:6.2%}'.format(fpr, tpr, original_kept_tpr[kept_tpr_i]))
-                kept_fpr[kept_tpr_i] = fpr
-                kept_tpr[kept_tpr_i] = tpr
-                for _ in t:
-                    kept_thresholds[lowup[_]][kept_tpr_i] = sign * t[_]
+    # thresholds at each step: low ones are going up, up ones are going down
+    t = {'low': all_thresholds['low'][:nt], 'up': all_thresholds['up'][::-1][:nt]}
+
+    running = t['low'][:nt - 1] < t['up'][:nt - 1]
+    n_steps = nt - 1 if running.all() else running.argmin()
+
+    # thresholds are crossed once (not gone back over)
+    t_low = np.maximum.accumulate(t['low'][:n_steps])
+    t_up = np.minimum.accumulate(t['up'][:n_steps])
+
+    neg = {}
+    for w in ('out', 'in'):
+        below = np.minimum(np.searchsorted(scores[w], t_low, side='left'), n[w] - 1)
+        above = np.minimum(n[w] - np.searchsorted(scores[w], t_up, side='right'), n[w] - 1)
+        if n[w] and np.isnan(scores[w][-1]):
+            above[:] = 0
+        neg[w] = below + above
+
+    tpr = 1 - neg['in'] / n['in']
+    fpr = 1 - neg['out'] / n['out']
+
+    # tpr is non increasing: for each kept tpr (from the highest), last
+    # step before tpr goes under it (then the next kept tpr is looked
+    # for from the following step). Thresholds are the ones of the step after.
+    step = 0
+    for i in range(len(kept_tpr) - 1, -1, -1):
+        if step >= n_steps:
+            break
+        under = max(step, np.searchsorted(-tpr, -original_kept_tpr[i], side='right'))
+        if under > step:
+            kept_fpr[i] = fpr[under - 1]
+            kept_tpr[i] = tpr[under - 1]
+            for _ in t:
+                kept_thresholds[lowup[_]][i] = sign * t[_][under]
+        step = under + 1
 
-    # print('*** iterations:', it)
     if debug:
-        for w in ('in', 'out'):
-            print('{:3}:'.format(w), end=' ')
-            print(_s.format(t['low'],
-                            scores[w][idx[w]['low']],
-                            scores[w][idx[w]['up']], t['up']), end=' | ')
-            print(idx[w]['low'], idx[w]['up'])
-
-            print('FPR={:6.2%} TPR={:6.2%}'.format(fpr, tpr))
+        logging.debug('{} steps, last: FPR={:6.2%} TPR={:6.2%}'.format(n_steps, fpr[-1], tpr[-1]))
 
-    relevant_fpr.append(0.0)
-    relevant_tpr.append(0.0)
+    relevant = (fpr >= 0) & (tpr >= 0)
+    relevant_fpr = np.append(fpr[relevant], 0.0)
+    relevant_tpr = np.append(tpr[relevant], 0.0)
 
-    auroc = auc(relevant_fpr, relevant_tpr)
+    auroc = metrics.auc(relevant_fpr, relevant_tpr)
 
     # return relevant_fpr, relevant_tpr
     # print('*** rc', len(ins), len(outs), time() - t0)
@@ -5,9 +5,9 @@ import logging
 import torch
 
 from .fetch import find_by_job_number, fetch_models, make_dict_from_model, get_submodule
-from .fetch import needed_remote_files, load_model
+from .fetch import needed_remote_files, load_model, make_row_from_model, load_manifest, find_model_dirs
 from .exceptions import MissingKeys, DeletedModelError, NoModelError, StateFileNotFoundError
 from .recorders import LossRecorder, SampleRecorder
-from .misc import load_json, get_path, save_json, create_file_for_job
+from .misc import load_json, get_path, save_json, create_file_for_job, atomic_write, job_to_str
 from .dictify import make_dict_from_model, available_results, develop_starred_methods, model_subdir
-from .dictify import print_architecture, option_vector, Shell
+from .dictify import print_architecture, option_vector, Shell, flatten_model_dict, manifest
@@ -1,5 +1,5 @@
 import logging
-from . import find_by_job_number, needed_remote_files
+from . import find_by_job_number, needed_remote_files, find_model_dirs
 import tempfile
 import argparse
 import os
@@ -10,6 +10,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('jobs', nargs='+')
+    parser.add_argument('--tree', action='store_true', help='jobs are directories of trees of jobs')
     parser.add_argument('--job-dir', default='./jobs')
     parser.add_argument('--state', action='store_true')
     parser.add_argument('--optimizer', action='store_true')
@@ -23,11 +24,16 @@ if __name__ == '__main__':
 
     output_file = args.output
 
-    job_dict = find_by_job_number(*args.jobs, job_dir=args.job_dir, force_dict=True, flash=args.flash)
+    if args.tree:
+        mdirs = list(find_model_dirs(*args.jobs))
+        logging.info('Will recover {} jobs'.format(len(mdirs)))
 
-    logging.info('Will recover jobs {}'.format(', '.join(str(_) for _ in job_dict)))
+    else:
+        job_dict = find_by_job_number(*args.jobs, job_dir=args.job_dir, force_dict=True, flash=args.flash)
 
-    mdirs = [job_dict[_]['dir'] for _ in job_dict]
+        logging.info('Will recover jobs {}'.format(', '.join(str(_) for _ in job_dict)))
+
+        mdirs = [job_dict[_]['dir'] for _ in job_dict]
 
     with open(output_file, 'w') as f:
         for _ in needed_remote_files(*mdirs, which_rec=args.rec_files,
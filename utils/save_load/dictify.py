@@ -154,10 +154,42 @@ def option_vector(o, empty=' ', space=' '):
     return space.join(v_)
 
 
+def manifest(model):
+    """What is expected in the directory of the model, written in
+    manifest.json at save time for remote files to be listed without
+    loading models (see needed_remote_files)
+
+    ood sets are only kept for wim jobs: for other models, they are the
+    sets of same size as the test set when the manifest is read (see
+    load_manifest), sets added since being thus listed
+
+    """
+    testset = model.training_parameters['set']
+    if model.predict_methods:
+        last = max(model.testing or [0])
+    else:
+        last = max(model.ood_results or [0])
+
+    wim_params = getattr(model, 'wim_params', None)
+    if wim_params is None:
+        oodsets = None
+        sub_dirs = ['']
+    else:
+        oodsets = wim_params.get('sets', [])
+        sub_dirs = ['', 'init']
+
+    return {'set': testset,
+            'oodsets': oodsets,
+            'sub_dirs': sub_dirs,
+            'epochs': {'last': int(last),
+                       'min-loss': model.training_parameters.get('early-min-loss', 'last')}}
+
+
 class Shell:
 
     print_architecture = print_architecture
     option_vector = option_vector
+    manifest = manifest
 
 
 def model_subdir(model, *subdirs):
@@ -868,3 +900,44 @@ def make_dict_from_model(model, directory, tpr=0.95, wanted_epoch='last', miscla
             'lr': empty_optimizer.init_lr,
             'version': architecture.version
             }
+
+
+def _flatten_results(d, depth, prefix=()):
+
+    if not depth:
+        return {prefix: d}
+
+    if not isinstance(d, dict):
+        if d is None or d != d:
+            return {}
+        d = {'val': d}
+
+    if not d:
+        # keeps track of (empty) key
+        return {prefix + (None,) * depth: None}
+
+    flat = {}
+    for k, v in d.items():
+        flat.update(_flatten_results(v, depth - 1, prefix + (k,)))
+
+    return flat
+
+
+def flatten_model_dict(mdict):
+    """Make a flat row of a dict made by make_dict_from_model: the net and
+    recorders are dropped, accuracies and in_out_rates are flattened in
+    cells of keys ('accuracies', method) and ('in_out_rates', set,
+    method, metrics)
+
+    """
+    if 'accuracies' not in mdict and 'in_out_rates' not in mdict:
+        return mdict
+
+    row = {k: v for k, v in mdict.items() if k not in ('net', 'recorders', 'accuracies', 'in_out_rates')}
+
+    for k, depth in (('accuracies', 1), ('in_out_rates', 3)):
+        if isinstance(mdict.get(k), dict):
+            for prefix, v in mdict[k].items():
+                row.update(_flatten_results(v, depth - 1, (k, prefix)))
+
+    return row
@@ -0,0 +1,130 @@
+"""Recorders of evaluations shared by models with the same weights
+
+A recorder of a test set is stored under a key that hashes the
+contents of the state of the model, the definition of the set and the
+test parameters (latent sampling, methods, transformer). A copy of a
+model, a reloaded base model or the same state in two job directories
+are thus evaluated once, rates being then computed from the
+recorders.
+
+The cache is a directory, that can be shared by hosts, given by the
+env variable EVAL_CACHE_DIR or by set_dir(). Without it, nothing is
+cached.
+
+"""
+import os
+import json
+import shutil
+import logging
+import hashlib
+import torch
+from utils.torch_load import dataset_properties, get_heldout_classes_by_name
+from .recorders import LossRecorder
+from .misc import atomic_write
+
+
+ENV_VARIABLE = 'EVAL_CACHE_DIR'
+
+_cache_dir = os.environ.get(ENV_VARIABLE) or None
+
+
+def set_dir(directory):
+    global _cache_dir
+    _cache_dir = directory
+
+
+def get_dir():
+    return _cache_dir
+
+
+def state_hash(model):
+    """Hash of names, types, shapes and contents of tensors of the state
+    dict, independent of where (and if) the state was saved
+
+    """
+    h = hashlib.sha256()
+    for k, t in model.state_dict().items():
+        t = t.detach().cpu().contiguous()
+        h.update(bytes('{} {} {}'.format(k, t.dtype, tuple(t.shape)), 'utf-8'))
+        h.update(t.reshape(-1).view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+def set_definition(dataset):
+
+    name = dataset.name
+    parent_set, heldout = get_heldout_classes_by_name(name[:-2] if name.endswith('90') else name)
+    return {'name': name,
+            'length': len(dataset),
+            'transformer': getattr(dataset, 'transformer', None),
+            'properties': dataset_properties().get(parent_set)}
+
+
+def keys(model, *datasets):
+    """Returns a dict of keys by set names, the state being hashed once
+
+    """
+    test_params = {'state': state_hash(model),
+                   'type': model.type,
+                   'loss': {k: model.training_parameters.get(k) for k in ('sigma', 'beta', 'gamma')},
+                   'test_latent_sampling': model._latent_samplings['eval'],
+                   'methods': sorted(set(model.predict_methods + model.ood_methods))}
+
+    k_ = {}
+    for d in datasets:
+        definition = dict(test_params, set=set_definition(d))
+        k_[d.name] = hashlib.sha256(bytes(json.dumps(definition, sort_keys=True, default=str),
+                                          'utf-8')).hexdigest()
+    return k_
+
+
+def _entry(key, set_name):
+    return os.path.join(_cache_dir, key[:2], key, LossRecorder._file_pattern.format(w=set_name))
+
+
+def _link(src, dest):
+    """Hard link (recorders are replaced, never rewritten in place) or
+    copy if src and dest are on different devices
+
+    """
+    tmp = os.path.join(os.path.dirname(dest), '.{}.{}'.format(os.path.basename(dest), os.getpid()))
+    try:
+        os.link(src, tmp)
+        os.replace(tmp, dest)
+    except OSError:
+        with atomic_write(dest, 'wb') as f, open(src, 'rb') as f_:
+            shutil.copyfileobj(f_, f)
+
+
+def restore(cache_keys, rec_dir):
+    """Put in rec_dir the cached recorders of sets that are not there,
+    returns the list of restored sets
+
+    """
+    restored = []
+    if not _cache_dir:
+        return restored
+
+    for s, key in cache_keys.items():
+        dest = os.path.join(rec_dir, LossRecorder._file_pattern.format(w=s))
+        src = _entry(key, s)
+        if os.path.exists(dest) or not os.path.exists(src):
+            continue
+        os.makedirs(rec_dir, exist_ok=True)
+        _link(src, dest)
+        restored.append(s)
+
+    if restored:
+        logging.info('Recorders of {} restored from cache in {}'.format(', '.join(restored), rec_dir))
+    return restored
+
+
+def store(key, set_name, file_path):
+
+    if not _cache_dir:
+        return
+
+    dest = _entry(key, set_name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    _link(file_path, dest)
+    logging.debug('Recorder of {} cached in {}'.format(set_name, dest))
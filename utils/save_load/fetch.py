@@ -3,14 +3,15 @@ from filelock import FileLock
 import logging
 import torch
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from utils.print_log import turnoff_debug
 from utils.filters import get_filter_keys, ParamFilter, DictOfListsOfParamFilters
 from utils.parameters import gethostname
 from utils.torch_load import get_same_size_by_name
 
-from .misc import load_json, save_json
+from .misc import load_json, save_json, atomic_write
 from .exceptions import NoModelError, StateFileNotFoundError
-from .dictify import make_dict_from_model
+from .dictify import make_dict_from_model, flatten_model_dict, manifest as make_manifest
 
 
 class NoLock(object):
@@ -122,6 +123,71 @@ def load_model(d, **kw):
     return M.load(d, **kw)
 
 
+def make_row_from_model(directory, epoch_key='last', cache_file='rows.pth', **kw):
+    """Make a flat row of results of model in directory (see
+    flatten_model_dict).
+
+    Rows are cached in directory, in cache_file that is written there
+    (hence reading results writes in job directories), and recomputed
+    if any json file of directory has been modified since. With
+    cache_file None, rows are neither read from nor written to a cache.
+
+    -- epoch_key: key of training parameters of wanted epoch (eg
+       'early-min-loss'), 'last' if not found
+
+    -- kw: args pushed to make_dict_from_model (eg oodsets)
+
+    """
+    json_mtime = max((os.path.getmtime(os.path.join(directory, _))
+                      for _ in os.listdir(directory) if _.endswith('.json')), default=0)
+
+    cache_pth = os.path.join(directory, cache_file) if cache_file else None
+    row_key = (epoch_key, *sorted((k, str(v)) for k, v in kw.items()))
+
+    cache = {}
+    if cache_pth and os.path.exists(cache_pth):
+        try:
+            cache = torch.load(cache_pth, weights_only=False)
+        except (RuntimeError, EOFError) as e:
+            logging.warning('Cache of rows in {} could not be loaded ({})'.format(directory, e))
+
+    if cache.get('json_mtime') != json_mtime:
+        cache = {'json_mtime': json_mtime, 'rows': {}}
+
+    if row_key not in cache['rows']:
+        logging.debug('Making row for {}'.format(directory[-30:]))
+        model = load_model(directory, build_module=False)
+        epoch = model.training_parameters.get(epoch_key, 'last')
+        cache['rows'][row_key] = flatten_model_dict(make_dict_from_model(model, directory,
+                                                                         wanted_epoch=epoch, **kw))
+        if not cache_pth:
+            return cache['rows'][row_key]
+        try:
+            with atomic_write(cache_pth, 'wb') as f:
+                torch.save(cache, f)
+        except OSError as e:
+            logging.warning('Cache of rows could not be saved in {} ({})'.format(directory, e))
+
+    return cache['rows'][row_key]
+
+
+@lock_models_file_in(0)
+def _update_registered_models(search_dir, registered_models_file, rmodels):
+    """Merge rmodels in the registered models file, under lock
+
+    """
+    try:
+        registered = load_json(search_dir, registered_models_file)
+    except FileNotFoundError:
+        registered = {}
+
+    registered.update(rmodels)
+    save_json(registered, search_dir, registered_models_file)
+
+    return registered
+
+
+@lock_models_file_in(0)
 def _collect_models(search_dir, registered_models_file=None):
     from cvae import ClassificationVariationalNetwork as M
     from module.wim import WIMJob as W
@@ -173,7 +239,6 @@ def _collect_models(search_dir, registered_models_file=None):
     return rmodels
 
 
-@lock_models_file_in(0)
 def fetch_models(search_dir, registered_models_file=None, filter=None, flash=True,
                  light=False,
                  tpr=0.95,
@@ -206,8 +271,10 @@ def fetch_models(search_dir, registered_models_file=None, filter=None, flash=Tru
                                                   tpr=tpr, build_module=build_module,
                                                   light=light, **kw)
             logging.debug('Gathered {} models'.format(len(mlist)))
-            rmodels.update(_register_models(mlist, *get_filter_keys()))
-            save_json(rmodels, search_dir, registered_models_file)
+            # registered models file is written atomically, lock is
+            # only needed to merge
+            _update_registered_models(search_dir, registered_models_file,
+                                      _register_models(mlist, *get_filter_keys()))
             return mlist
 
         except StateFileNotFoundError as e:
@@ -298,10 +365,105 @@ def find_by_job_number(*job_numbers, job_dir='jobs',
     return d if len(job_numbers) > 1 or force_dict else d.get(job_numbers[0])
 
 
+def load_manifest(d):
+    r""" What is expected in model directory d, as written at save time
+    in manifest.json or, for models saved before, by loading the model
+
+    sets (test set first) are completed with the sets of same size as
+    the test set if ood sets were not kept in the manifest
+
+    """
+    try:
+        manifest = load_json(d, 'manifest.json')
+    except FileNotFoundError:
+        from cvae import ClassificationVariationalNetwork as M
+        from module.wim import WIMJob as W
+
+        logging.debug('No manifest in {}, loading model'.format(d))
+        manifest = make_manifest((W if W.is_wim(d) else M).load(d, build_module=False))
+
+    oodsets = manifest['oodsets']
+    if oodsets is None:
+        oodsets = get_same_size_by_name(manifest['set'])
+    manifest['sets'] = [manifest['set'], *oodsets]
+
+    return manifest
+
+
+def find_model_dirs(*roots):
+    r""" directories with a params.json file under roots, found with
+    scandir only (not descending into model directories)
+
+    """
+    for root in roots:
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+        if any(_.name == 'params.json' for _ in entries):
+            yield root
+            continue
+
+        yield from find_model_dirs(*(_.path for _ in entries if _.is_dir()))
+
+
+def _listdir(d):
+    try:
+        with os.scandir(d) as it:
+            return {_.name for _ in it}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def _missing_files(d, epoch, which_rec, state, optimizer):
+
+    logging.debug('Inspecting {}'.format(d))
+
+    manifest = load_manifest(d)
+
+    epoch_ = epoch
+    if epoch_ == 'min-loss':
+        epoch_ = manifest['epochs']['min-loss']
+    if epoch_ == 'last':
+        epoch_ = manifest['epochs']['last']
+
+    if isinstance(epoch_, int):
+        epoch_ = '{:04d}'.format(epoch_)
+
+    sets = []
+
+    recs_to_exclude = which_rec.split('-')[1:]
+    which_rec_ = which_rec.split('-')[0]
+
+    if which_rec_ == 'ind':
+        sets.append(manifest['set'])
+    elif which_rec_ == 'all':
+        sets = [_ for _ in manifest['sets'] if _ not in recs_to_exclude]
+        if manifest['set'] not in sets:
+            sets.insert(0, manifest['set'])
+
+    missing = []
+    for sub in manifest['sub_dirs'] if sets else []:
+        sdir = os.path.join(d, 'samples', epoch_, sub)
+        present = _listdir(sdir)
+        missing += [os.path.join(sdir, 'record-{}.pth'.format(s)) for s in sets
+                    if 'record-{}.pth'.format(s) not in present]
+
+    if state or optimizer:
+        present = _listdir(d)
+        missing += [os.path.join(d, f) for f, wanted in (('state.pth', state), ('optimizer.pth', optimizer))
+                    if wanted and f not in present]
+
+    return missing
+
+
 def needed_remote_files(*mdirs, epoch='last', which_rec='all',
                         state=False,
                         optimizer=False,
-                        missing_file_stream=None):
+                        missing_file_stream=None,
+                        max_workers=32):
     r""" list missing recorders to be fetched on a remote
 
     -- mdirs: list of directories
@@ -312,74 +474,28 @@ def needed_remote_files(*mdirs, epoch='last', which_rec='all',
 
     -- state: wehter to include state.pth
 
-    returns generator of needed files paths
-
-    """
+    -- missing_file_stream: where paths are written, one per line (as
+       for rsync --files-from)
 
-    assert not state or epoch == 'last'
-
-    from cvae import ClassificationVariationalNetwork as M
-    from module.wim import WIMJob as W
+    Directories are inspected in parallel from their manifest.json,
+    with one scandir per directory of files.
 
-    for d in mdirs:
+    returns generator of (directory, needed file path)
 
-        logging.debug('Inspecting {}'.format(d))
-
-        is_wim = W.is_wim(d)
-        m = (W if is_wim else M).load(d, build_module=False)
-        epoch_ = epoch
-        if epoch_ == 'min-loss':
-            epoch_ = m.training_parameters.get('early-min-loss', 'last')
-        if epoch_ == 'last':
-            epoch_ = max(m.testing) if m.predict_methods else max(m.ood_results or [0])
-
-        if isinstance(epoch_, int):
-            epoch_ = '{:04d}'.format(epoch_)
-
-        testset = m.training_parameters['set']
-
-        sets = []
+    """
 
-        recs_to_exclude = which_rec.split('-')[1:]
-        which_rec_ = which_rec.split('-')[0]
+    assert not state or epoch == 'last'
 
-        if which_rec_ in ('all', 'ind'):
-            sets.append(testset)
-            if which_rec_ == 'all':
-                if is_wim:
-                    for s in m.wim_params['sets']:
-                        sets.append(s)
-                else:
-                    sets += get_same_size_by_name(testset)
-                    for _ in [_ for _ in recs_to_exclude if _ in sets]:
-                        sets.remove(_)
-        sub_dirs = ['']
-        if is_wim:
-            sub_dirs.append('init')
-        for s in sets:
-            for sub in sub_dirs:
-                sfile = os.path.join(d, 'samples', epoch_, sub, 'record-{}.pth'.format(s))
-                logging.debug('Looking for {}'.format(sfile))
-                if not os.path.exists(sfile):
-                    if missing_file_stream:
-                        missing_file_stream.write(sfile + '\n')
-                        yield d, sfile
-
-        if state:
-            sfile = os.path.join(d, 'state.pth')
-            logging.debug('Looking for {}'.format(sfile))
-            if not os.path.exists(sfile):
-                if missing_file_stream:
-                    missing_file_stream.write(sfile + '\n')
-                yield d, sfile
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        missing = executor.map(functools.partial(_missing_files, epoch=epoch, which_rec=which_rec,
+                                                 state=state, optimizer=optimizer), mdirs)
 
-        if optimizer:
-            sfile = os.path.join(d, 'optimizer.pth')
-            logging.debug('Looking for {}'.format(sfile))
-            if not os.path.exists(sfile):
+        for d, files in zip(mdirs, missing):
+            for f in files:
+                logging.debug('Missing {}'.format(f))
                 if missing_file_stream:
-                    missing_file_stream.write(sfile + '\n')
-                yield d, sfile
+                    missing_file_stream.write(f + '\n')
+                yield d, f
 
 
 def get_submodule(model, sub='features', job_dir='jobs', name=None, **kw):
@@ -1,6 +1,8 @@
 import os
 import json
 import logging
+import tempfile
+from contextlib import contextmanager
 
 
 def get_path(dir_name, file_name, create_dir=True):
@@ -28,11 +30,43 @@ def create_file_for_job(number, directory, filename, mode='w'):
     return open(filepath, mode)
 
 
+@contextmanager
+def atomic_write(file_path, mode='w'):
+    """Open a temporary file in the directory of file_path, renamed to
+    file_path when closed without error, so that concurrent readers see
+    either the old file or the new one, never a torn one.
+
+    The file keeps the permissions of the file it replaces, new files
+    get the ones of open (mkstemp creates them for the owner only).
+
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                    prefix='.{}.'.format(os.path.basename(file_path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            try:
+                file_mode = os.stat(file_path).st_mode & 0o777
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                file_mode = 0o666 & ~umask
+            os.fchmod(f.fileno(), file_mode)
+        os.replace(tmp_path, file_path)
+
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def save_json(d, dir_name, file_name, create_dir=True):
 
     p = get_path(dir_name, file_name, create_dir)
 
-    with open(p, 'w') as f:
+    with atomic_write(p) as f:
         json.dump(d, f)
 
 
@@ -6,8 +6,8 @@ import numpy as np
 
 import torch
 import re
+from .misc import atomic_write
 
-import scipy
 
 
 class LossRecorder:
@@ -64,6 +64,7 @@ class LossRecorder:
     def reset(self, seed=False):
 
         self._recorded_batches = 0
+        self._pending = []
         if self._seed is None or seed:
             self._seed = np.random.randint(1, int(1e8))
         self.last_batch_size = self.batch_size
@@ -128,14 +129,15 @@ class LossRecorder:
 
         end = (len(self) - 1) * self.batch_size + self.last_batch_size
         i_ = torch.tensor(range(end), device=self.device)
-        if cut:
+        if cut and any(t.shape[self._sample_dim] != end for t in self._tensors.values()):
             self.num_batch = len(self)
             t = self._tensors
             for k in t:
                 # print('***', *t[k].shape, self._sample_dim, max(i_))
                 t[k] = t[k].index_select(self._sample_dim, i_)
 
-        torch.save(self.__dict__, file_path)
+        with atomic_write(file_path, 'wb') as f:
+            torch.save(self.__dict__, f)
 
     @classmethod
     def load(cls, file_path, device=None, **kw):
@@ -149,7 +151,12 @@ class LossRecorder:
         batch_size = dict_of_params['batch_size']
         tensors = dict_of_params['_tensors']
 
-        r = cls(batch_size, num_batch, **tensors)
+        # tensors are not allocated since they are replaced by loaded ones
+        r = cls(batch_size)
+        r._num_batch = num_batch
+        r._samples = num_batch * batch_size
+        if tensors:
+            r.device = next(iter(tensors.values())).device
 
         for k in ('_seed', '_tensors', '_recorded_batches', '_aux'):
             try:
@@ -251,6 +258,97 @@ class LossRecorder:
 
             self._tensors.update(other._tensors)
 
+    @classmethod
+    def load_mapped(cls, file_path):
+        r"""Load recorder with its tensors memory mapped to the file, so
+        that they are read only when used
+
+        """
+        try:
+            return cls.load(file_path, mmap=True, map_location='cpu')
+        except RuntimeError:
+            logging.debug('{} can not be memory mapped, will be loaded'.format(file_path))
+            return cls.load(file_path, map_location='cpu')
+
+    @classmethod
+    def concatenate(cls, *recorders, keys=None, file_path=None):
+        r"""concatenate recorders along samples in one pass
+
+        -- recorders: recorders or paths of saved recorders (memory mapped)
+
+        -- keys: keys to keep, default to keys common to all recorders
+           (as with merge)
+
+        -- file_path: if not None, concatenated recorder is saved in
+           file_path, its tensors being backed by a file instead of
+           memory
+
+        Sizes of all recorders are computed first, tensors are allocated
+        once and each recorder is copied in place, which is linear in the
+        number of samples whereas successive merges are quadratic.
+
+        """
+
+        recorders = [cls.load_mapped(r) if isinstance(r, str) else r for r in recorders]
+
+        if not recorders:
+            raise ValueError('No recorder to concatenate')
+
+        if keys is None:
+            keys = set.intersection(*(set(r) for r in recorders))
+        keys = [k for k in recorders[0] if k in keys]
+
+        samples = [r.recorded_samples for r in recorders]
+        n = sum(samples)
+        batch_size = recorders[0].batch_size
+
+        logging.debug('Concatenating {} recorders in one of {} samples'.format(len(recorders), n))
+
+        tensors = {}
+        backing_files = []
+        if file_path:
+            # hidden temporary files, not to be found by loadall
+            tmp_path = os.path.join(os.path.dirname(file_path), '.' + os.path.basename(file_path))
+        for k in keys:
+            t = recorders[0]._tensors[k]
+            shape = list(t.shape)
+            shape[cls._sample_dim] = n
+            if file_path:
+                backing_files.append('{}.{}.tmp'.format(tmp_path, len(backing_files)))
+                tensors[k] = torch.from_file(backing_files[-1], shared=True,
+                                             size=int(np.prod(shape)), dtype=t.dtype).view(shape)
+            else:
+                tensors[k] = torch.empty(shape, dtype=t.dtype, device=t.device)
+
+        start = 0
+        for r, n_r in zip(recorders, samples):
+            for k in keys:
+                tensors[k].narrow(cls._sample_dim, start, n_r).copy_(r._tensors[k].narrow(cls._sample_dim, 0, n_r))
+            start += n_r
+
+        concatenated = cls(batch_size)
+        concatenated._seed = recorders[0]._seed
+        concatenated._tensors = tensors
+        concatenated.device = next(iter(tensors.values())).device if tensors else recorders[0].device
+
+        num_batch = (n - 1) // batch_size + 1 if n else 0
+        concatenated._num_batch = num_batch
+        concatenated._samples = num_batch * batch_size
+        concatenated._recorded_batches = num_batch
+        concatenated.last_batch_size = (n - 1) % batch_size + 1 if n else batch_size
+
+        # auxiliary data of sample recorders
+        if hasattr(recorders[0], '_aux'):
+            concatenated._aux = recorders[0]._aux.copy()
+
+        if file_path:
+            concatenated.save(tmp_path + '.tmp')
+            os.replace(tmp_path + '.tmp', file_path)
+            for f in backing_files:
+                os.remove(f)
+
+        return concatenated
+
     def split(self, *keys, keep=False):
 
         copy = self.copy()
@@ -368,6 +466,36 @@ class LossRecorder:
 
         self._recorded_batches += 1
 
+    def append_samples(self, **tensors):
+        """Append any number of samples, recorded by batches of batch_size,
+        remaining samples being recorded at flush()
+
+        """
+        pending = getattr(self, '_pending', [])
+        pending.append(tensors)
+        self._pending = pending
+
+        n = sum(_[k].shape[self._sample_dim] for _ in pending for k in list(_)[:1])
+        if n < self.batch_size:
+            return
+
+        tensors = {k: torch.cat([_[k] for _ in pending], dim=self._sample_dim) for k in tensors}
+        full = n // self.batch_size * self.batch_size
+        for start in range(0, full, self.batch_size):
+            self.append_batch(**{k: t.narrow(self._sample_dim, start, self.batch_size)
+                                 for k, t in tensors.items()})
+
+        self._pending = []
+        if n > full:
+            self._pending.append({k: t.narrow(self._sample_dim, full, n - full) for k, t in tensors.items()})
+
+    def flush(self):
+
+        pending = getattr(self, '_pending', [])
+        if pending:
+            self.append_batch(**{k: torch.cat([_[k] for _ in pending], dim=self._sample_dim) for k in pending[0]})
+        self._pending = []
+
 
 class SampleRecorder(LossRecorder):
 
@@ -392,6 +520,7 @@ class SampleRecorder(LossRecorder):
         t = self._tensors
 
         t.update(self._aux)
+        import scipy.io
         scipy.io.savemat(matfile, t, **kw)
 
     def add_auxiliary(self, **t):
@@ -0,0 +1,411 @@
+"""Scoring server: networks are kept loaded and requests sent to a
+network (batches of images, possibly of one image) are gathered in
+micro batches, each micro batch being evaluated once.
+
+A micro batch is run as soon as it holds max_batch_size images or when
+its first request has waited for max_delay seconds.
+
+The server answers json on localhost http or on a unix socket (if the
+address is a path):
+
+-- POST /score {"model": name, "x": N x D1 x ... x Dt (or D1 x ... x Dt) list}
+
+   -> {"scores": {method: N list}, "predictions": {method: N list}}
+
+-- GET /models
+
+-- GET /stats: number of requests, of images, of batches, throughput
+   (images/s) and latencies (ms) by model
+
+"""
+import os
+import sys
+import time
+import json
+import queue
+import socket
+import logging
+import threading
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+import numpy as np
+import torch
+
+
+LATENCY_WINDOW = 1000
+
+
+class _Request:
+
+    def __init__(self, x):
+
+        self.x = x
+        self.t0 = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class Batcher(threading.Thread):
+    """Evaluates the requests to one model by micro batches
+
+    """
+
+    def __init__(self, model, methods=None, predict_methods=None,
+                 max_batch_size=64, max_delay=0.005, device='cpu'):
+
+        super().__init__(daemon=True)
+
+        self.model = model
+        if methods is None:
+            # odin methods need gradients
+            methods = [_ for _ in model.ood_methods if not _.startswith('odin') and '*' not in _]
+        self.methods = methods
+        self.predict_methods = model.predict_methods if predict_methods is None else predict_methods
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.device = device
+
+        self._queue = queue.Queue()
+
+        self._t0 = time.time()
+        self._requests = 0
+        self._images = 0
+        self._batches = 0
+        self._busy = 0.
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def submit(self, x):
+
+        request = _Request(x)
+        self._queue.put(request)
+        return request
+
+    def close(self):
+        self._queue.put(None)
+
+    def run(self):
+
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            n = len(request.x)
+            deadline = request.t0 + self.max_delay
+            closing = False
+            while n < self.max_batch_size:
+                # requests queued while the previous batch was evaluated
+                # are taken even if past the deadline
+                timeout = deadline - time.time()
+                try:
+                    request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                n += len(request.x)
+
+            self._process(batch)
+            if closing:
+                return
+
+    def _process(self, batch):
+
+        t0 = time.time()
+        try:
+            x = torch.cat([_.x for _ in batch]).to(self.device)
+            with torch.no_grad():
+                _, logits, losses, _ = self.model.evaluate(x)
+                scores = self.model.batch_dist_measures(logits, losses, self.methods, to_cpu=True)
+                predictions = {m: self.model.predict_after_evaluate(logits, losses, method=m).cpu()
+                               for m in self.predict_methods}
+        except Exception as e:
+            logging.error('Error while evaluating a batch of {}: {}'.format(len(batch), e))
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        t1 = time.time()
+        i = 0
+        for request in batch:
+            n = len(request.x)
+            request.result = {'scores': {m: scores[m][i: i + n] for m in scores},
+                              'predictions': {m: predictions[m][i: i + n] for m in predictions}}
+            i += n
+            self._latencies.append(t1 - request.t0)
+            request.done.set()
+
+        self._requests += len(batch)
+        self._images += i
+        self._batches += 1
+        self._busy += t1 - t0
+
+    def stats(self):
+
+        uptime = time.time() - self._t0
+        latencies = np.array(self._latencies) * 1000
+        s = {'requests': self._requests,
+             'images': self._images,
+             'batches': self._batches,
+             'mean_batch_size': self._images / self._batches if self._batches else 0.,
+             'images_per_second': self._images / uptime,
+             'busy': self._busy / uptime,
+             'queued': self._queue.qsize()}
+        if len(latencies):
+            s['latency_ms'] = {'mean': latencies.mean(), 'max': latencies.max(),
+                               **{'p{}'.format(p): np.percentile(latencies, p) for p in (50, 95, 99)}}
+
+        return s
+
+
+class ScoringServer:
+    """models: dict of (warm) models
+
+    """
+
+    def __init__(self, models, methods=None, max_batch_size=64, max_delay=0.005, device='cpu'):
+
+        self.batchers = {}
+        for name, model in models.items():
+            model.to(device)
+            model.eval()
+            self.batchers[name] = Batcher(model, methods=methods, max_batch_size=max_batch_size,
+                                          max_delay=max_delay, device=device)
+            self.batchers[name].start()
+
+    def models(self):
+
+        return {name: {'type': b.model.type, 'input_shape': b.model.input_shape,
+                       'methods': b.methods, 'predict_methods': b.predict_methods}
+                for name, b in self.batchers.items()}
+
+    def score(self, name, x):
+        """x of size N x D1 x ... x Dt or D1 x ... x Dt (one image)
+
+        """
+        batcher = self.batchers[name]
+        input_shape = tuple(batcher.model.input_shape)
+        x = torch.as_tensor(x, dtype=torch.float)
+        if tuple(x.shape) == input_shape:
+            x = x.unsqueeze(0)
+        if tuple(x.shape[1:]) != input_shape:
+            raise ValueError('Input of shape {} for model {} of input shape {}'.format(tuple(x.shape), name,
+                                                                                      input_shape))
+        return batcher.submit(x).wait()
+
+    def stats(self):
+
+        return {name: b.stats() for name, b in self.batchers.items()}
+
+    def close(self):
+
+        for b in self.batchers.values():
+            b.close()
+        for b in self.batchers.values():
+            b.join()
+
+
+def load_models(*jobs, job_dir='jobs', quantized=False):
+    """Models of jobs in job_dir, by job number
+
+    """
+    from utils.save_load import find_by_job_number, load_model
+
+    models = {}
+    for job, d in find_by_job_number(*jobs, job_dir=job_dir, force_dict=True).items():
+        model = load_model(d['dir'], build_module=True, load_state=True)
+        models[str(job)] = model.quantized() if quantized else model
+        logging.info('Model of job {} loaded'.format(job))
+
+    return models
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _send(self, code, d):
+
+        body = json.dumps(d).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        scoring = self.server.scoring
+        if self.path == '/models':
+            self._send(200, scoring.models())
+        elif self.path == '/stats':
+            self._send(200, scoring.stats())
+        else:
+            self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+
+        if self.path != '/score':
+            self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        try:
+            d = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            name = str(d['model'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': 'Bad request: {}'.format(e)})
+            return
+
+        if name not in self.server.scoring.batchers:
+            self._send(404, {'error': 'Unknown model {}'.format(name)})
+            return
+
+        try:
+            result = self.server.scoring.score(name, d.get('x'))
+        except (ValueError, TypeError, RuntimeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        self._send(200, {k: {m: v.tolist() for m, v in result[k].items()} for k in result})
+
+    def address_string(self):
+        # client address is empty on unix sockets
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def is_unix_address(address):
+    return os.sep in address or address.endswith('.sock')
+
+
+def serve(scoring, address='localhost:8000'):
+    """Returns an http server (to be run with serve_forever) on address
+    host:port or on unix socket at path address
+
+    """
+    if is_unix_address(address):
+        if os.path.exists(address):
+            os.remove(address)
+        httpd = _UnixHTTPServer(address, _Handler)
+    else:
+        host, port = address.rsplit(':', 1)
+        httpd = ThreadingHTTPServer((host, int(port)), _Handler)
+        httpd.daemon_threads = True
+
+    httpd.scoring = scoring
+    logging.info('Serving {} on {}'.format(', '.join(scoring.batchers), address))
+    return httpd
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, **kw):
+        super().__init__('localhost', **kw)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class Client:
+
+    def __init__(self, address='localhost:8000', timeout=60):
+
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self):
+
+        if is_unix_address(self.address):
+            return _UnixHTTPConnection(self.address, timeout=self.timeout)
+        host, port = self.address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+    def _request(self, method, path, d=None):
+
+        conn = self._connection()
+        try:
+            body = None if d is None else json.dumps(d)
+            conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            result = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError('{} {}'.format(response.status, result.get('error')))
+        return result
+
+    def score(self, model, x):
+        """Returns dicts of scores and predictions (as tensors) by method
+
+        """
+        x = torch.as_tensor(x).tolist()
+        result = self._request('POST', '/score', {'model': str(model), 'x': x})
+        return {k: {m: torch.tensor(v) for m, v in result[k].items()} for k in result}
+
+    def models(self):
+        return self._request('GET', '/models')
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Scoring server of jobs')
+    parser.add_argument('jobs', nargs='+', type=int)
+    parser.add_argument('--job-dir', default='./jobs')
+    parser.add_argument('--address', default='localhost:8000', help='host:port or path of unix socket')
+    parser.add_argument('-m', '--methods', nargs='+', help='default is ood methods of models')
+    parser.add_argument('--max-batch-size', default=64, type=int)
+    parser.add_argument('--max-delay', default=5., type=float, help='in ms')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--quantized', action='store_true', help='serve int8 copies of models (on cpu)')
+    parser.add_argument('-v', action='count', default=0)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING - 10 * args.v)
+
+    models = load_models(*args.jobs, job_dir=args.job_dir, quantized=args.quantized)
+    if not models:
+        logging.error('No model found')
+        sys.exit(1)
+
+    scoring = ScoringServer(models, methods=args.methods, max_batch_size=args.max_batch_size,
+                            max_delay=args.max_delay / 1000, device=args.device)
+    httpd = serve(scoring, args.address)
+    print('Serving {} on {}'.format(' '.join(models), args.address))
+    sys.stdout.flush()
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        scoring.close()
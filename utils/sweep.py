@@ -0,0 +1,331 @@
+"""Local sweeps of train.py
+
+A sweep is a section of an ini file (e.g. grid.ini). Each key is an
+option of train.py ('_' for '-') whose value lists, space separated,
+the values of the grid (a value with ',' gives several args, true and
+false are for flags). repeat is the number of runs of each point of the
+grid.
+
+Runs are packed on the machine: each one is pinned on its own cores,
+with as many torch threads, and is given a memory budget (a limit of
+its data segment); as many runs as cores and memory allow are run at
+once.
+
+The job numbers of each run are kept in a json file of the job dir, so
+that an interrupted sweep can be started again: finished runs (as found
+in the registry of models) are skipped, begun ones are resumed. Runs
+without a job in this file (launched by hand, or with the file lost)
+are looked for in the registry by the values of their grid keys.
+
+"""
+import os
+import sys
+import math
+import time
+import logging
+import resource
+import itertools
+import subprocess
+import configparser
+from utils.parameters import allocate_jobnumbers
+from utils.save_load import fetch_models, load_json, save_json
+from utils.filters import get_filter_keys
+
+
+STATE_DIR = 'sweeps'
+
+
+def expand_section(config, section):
+    """List of (run key, args, params) for the runs of section of config,
+    a ConfigParser, params being the grid values of the run
+
+    """
+    params = dict(config[section])
+    repeat = int(params.pop('repeat', 1))
+
+    options = []
+    for k, v in params.items():
+        option = '--' + k.replace('_', '-')
+        values = []
+        for value in v.split():
+            if value.lower() == 'true':
+                values.append((k, True, [option]))
+            elif value.lower() == 'false':
+                values.append((k, False, []))
+            else:
+                value = value.split(',')
+                values.append((k, value if len(value) > 1 else value[0], [option, *value]))
+        options.append(values)
+
+    runs = []
+    for point in itertools.product(*options):
+        args = [a for k, v, option in point for a in option]
+        grid_values = {k: v for k, v, option in point}
+        for i in range(repeat):
+            runs.append(('{} #{}'.format(' '.join(args), i), args, grid_values))
+
+    return runs
+
+
+def available_cores():
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count()))
+
+
+def available_memory():
+    """Available memory in GB, None if unknown
+
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 2 ** 20
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _same_value(value, registered):
+
+    if isinstance(value, list):
+        return (isinstance(registered, (list, tuple)) and len(value) == len(registered)
+                and all(_same_value(*_) for _ in zip(value, registered)))
+    if isinstance(value, bool):
+        return registered is not None and bool(registered) == value
+    try:
+        # registered values may have been float32
+        return math.isclose(float(value), float(registered), rel_tol=1e-6)
+    except (TypeError, ValueError):
+        return str(value) == str(registered)
+
+
+def match_params(model, params, filter_keys):
+    """Whether the registered model dict has the values of params, keys
+    of params being options of train.py ('_' for '-'), False if one of
+    them is not registered
+
+    """
+    for k, v in params.items():
+        if k not in filter_keys or not _same_value(v, model.get(filter_keys[k]['dest'])):
+            return False
+    return True
+
+
+class Run:
+
+    def __init__(self, key, args, job, resumed=None):
+
+        self.key = key
+        self.args = args
+        self.job = job
+        self.resumed = resumed
+        self.process = None
+        self.cores = []
+
+    def command(self, train_script='train.py', common_args=[]):
+
+        cmd = [sys.executable, train_script, *common_args, *self.args]
+        if self.job:
+            cmd += ['--job-number', str(self.job)]
+        if self.resumed:
+            cmd += ['--resume', str(self.resumed)]
+        return cmd
+
+
+class Sweep:
+
+    def __init__(self, runs, name='sweep', job_dir='./jobs', train_script='train.py', common_args=[],
+                 threads=None, memory=None, cores=None):
+        """-- runs: list of (key, args, params) (see expand_section)
+
+        -- threads: per run, default is to share cores between runs to be done
+
+        -- memory: per run (in GB)
+
+        """
+        # runs with other train args are other runs
+        self.runs = [(' '.join([*common_args, key]), args, params) for key, args, params in runs]
+        self.name = name
+        self.job_dir = job_dir
+        self.train_script = train_script
+        self.common_args = ['--job-dir', job_dir, *common_args]
+
+        self.cores = cores or available_cores()
+        self._threads = threads
+        self.threads = None
+        self.memory = memory
+
+        self.state_dir = os.path.join(job_dir, STATE_DIR)
+        self.state_file = '{}.json'.format(name)
+        try:
+            self.state = load_json(self.state_dir, self.state_file)
+        except FileNotFoundError:
+            self.state = {}
+
+    def _save_state(self):
+        save_json(self.state, self.state_dir, self.state_file)
+
+    def _registered_models(self):
+        """Models of the registry, collected again (only new directories
+        are loaded) if jobs of the sweep are missing
+
+        """
+        if not os.path.isdir(self.job_dir):
+            return {}
+        registered = {m['job']: m for m in fetch_models(self.job_dir, flash=True, light=True)}
+        if any(j not in registered for jobs in self.state.values() for j in jobs):
+            logging.debug('Jobs of the sweep not registered, collecting models')
+            registered = {m['job']: m for m in fetch_models(self.job_dir, flash=False, light=True)}
+        return registered
+
+    def plan(self):
+        """Runs to be launched, finished ones being skipped
+
+        """
+        registered = self._registered_models()
+        filter_keys = get_filter_keys(by='key')
+
+        # jobs of the sweep cannot be taken for other runs
+        taken = {j for jobs in self.state.values() for j in jobs}
+        todo = []
+        for key, args, params in self.runs:
+            # last job of the run that has been saved
+            job = next((_ for _ in self.state.get(key, [])[::-1] if _ in registered), None)
+            if job is None:
+                # finished ones first, then the last begun one
+                matching = sorted((m for j, m in registered.items()
+                                   if j not in taken and match_params(m, params, filter_keys)),
+                                  key=lambda m: (m['finished'], m['job']), reverse=True)
+                if matching:
+                    job = matching[0]['job']
+                    taken.add(job)
+                    logging.debug('{} found in registry: job {}'.format(key, job))
+            m = registered.get(job)
+            if m and m['finished']:
+                logging.debug('{} done in job {}'.format(key, job))
+                continue
+            todo.append(Run(key, args, job=None, resumed=job))
+            if m:
+                logging.info('{} will be resumed from job {} ({} epochs done)'.format(key, job, m['done']))
+
+        logging.info('{} runs out of {} to be done'.format(len(todo), len(self.runs)))
+        return todo
+
+    def _launch(self, run, free_cores):
+
+        run.cores = [free_cores.pop(0) for _ in range(self.threads)]
+        run.job = allocate_jobnumbers(1)[0]
+        self.state.setdefault(run.key, []).append(run.job)
+        self._save_state()
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads), MKL_NUM_THREADS=str(self.threads))
+        memory = self.memory and int(self.memory * 2 ** 30)
+
+        def preexec():
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, run.cores)
+            if memory:
+                resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+
+        cmd = run.command(self.train_script, [*self.common_args, '--num-threads', str(self.threads)])
+        log_file = os.path.join(self.state_dir, '{}-{:06d}.out'.format(self.name, run.job))
+        with open(log_file, 'w') as f:
+            run.process = subprocess.Popen(cmd, env=env, stdout=f, stderr=subprocess.STDOUT,
+                                           preexec_fn=preexec)
+        logging.info('Job {} launched on cores {}: {}'.format(run.job, ','.join(map(str, run.cores)), run.key))
+
+    def max_parallel_runs(self):
+
+        n = len(self.cores) // self.threads
+        if self.memory:
+            memory = available_memory()
+            if memory:
+                n = min(n, int(memory // self.memory))
+        return max(n, 1)
+
+    def run(self, dry_run=False):
+        """Returns the number of failed runs
+
+        """
+        todo = self.plan()
+        self.threads = min(self._threads or max(1, len(self.cores) // max(len(todo), 1)), len(self.cores))
+        n = self.max_parallel_runs()
+        logging.info('Up to {} runs at once with {} threads'.format(n, self.threads))
+
+        if dry_run:
+            for run in todo:
+                print(' '.join(run.command(self.train_script, self.common_args)))
+            return 0
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        free_cores = list(self.cores)
+        running = {}
+        failed = 0
+        t0 = time.time()
+        done = 0
+
+        while todo or running:
+            while todo and len(running) < n and len(free_cores) >= self.threads:
+                run = todo.pop(0)
+                self._launch(run, free_cores)
+                running[run.process.pid] = run
+
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                # runs got the signal too, and save themselves
+                logging.warning('Interrupted, waiting for {} runs'.format(len(running)))
+                for run in running.values():
+                    run.process.wait()
+                raise
+            run = running.pop(pid, None)
+            if run is None:
+                continue
+            run.process.returncode = os.waitstatus_to_exitcode(status)
+            free_cores.extend(run.cores)
+            free_cores.sort()
+            done += 1
+            if run.process.returncode:
+                failed += 1
+                logging.error('Job {} failed ({}): {}'.format(run.job, run.process.returncode, run.key))
+            else:
+                logging.info('Job {} done: {}'.format(run.job, run.key))
+            logging.info('{} runs done in {:.0f}s, {} running, {} to go'.format(done, time.time() - t0,
+                                                                                 len(running), len(todo)))
+
+        return failed
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local sweeps of train.py, other args are passed to train.py')
+    parser.add_argument('sections', nargs='+')
+    parser.add_argument('--grid-file', default='grid.ini')
+    parser.add_argument('--job-dir', default='./jobs')
+    parser.add_argument('--train-script', default='train.py')
+    parser.add_argument('--threads', type=int, help='per run, default is to share cores between runs')
+    parser.add_argument('--memory', type=float, help='budget per run, in GB')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('-v', action='count', default=0)
+
+    args, train_args = parser.parse_known_args()
+    logging.getLogger().setLevel(logging.WARNING - 10 * args.v)
+
+    config = configparser.ConfigParser()
+    config.read(args.grid_file)
+
+    runs = []
+    for section in args.sections:
+        runs += expand_section(config, section)
+
+    name = '{}-{}'.format(os.path.splitext(os.path.basename(args.grid_file))[0], '-'.join(args.sections))
+    sweep = Sweep(runs, name=name, job_dir=args.job_dir, train_script=args.train_script,
+                  common_args=train_args, threads=args.threads, memory=args.memory)
+
+    sys.exit(sweep.run(dry_run=args.dry_run))
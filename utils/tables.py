@@ -1,16 +1,17 @@
 import sys
 import functools
-from utils.save_load import create_file_for_job as create_file, find_by_job_number
+from utils.save_load import create_file_for_job as create_file, find_by_job_number, flatten_model_dict
 from utils.print_log import harddebug, printdebug
-from utils.misc import make_list
+from utils.misc import make_list, lazy_import
 import numpy as np
-import pandas as pd
 import hashlib
 import argparse
 import logging
 from utils.parameters import DEFAULT_RESULTS_DIR
 import os
 
+pd = lazy_import('pandas')
+
 
 def printout(s='', file_id=None, std=True, end='\n'):
     if file_id:
@@ -125,6 +126,7 @@ def results_dataframe(models,
                 metrics.append(m + '@{:.0f}'.format(100 * _))
 
     if not dataset:
+        models = [flatten_model_dict(n) for n in models]
         testsets = {n['set'] for n in models}
         return {s: results_dataframe(models,
                                      predict_methods=predict_methods,
@@ -184,12 +186,6 @@ def results_dataframe(models,
 
     indices = arch_index + train_index
 
-    # acc_cols = ['best_accuracy', 'accuracies']
-    # ood_cols = ['ood_fpr', 'ood_fprs']
-
-    acc_cols = ['accuracies']
-    in_out_cols = ['in_out_rates']
-
     meas_cols = []
 
     if show_measures:
@@ -200,8 +196,10 @@ def results_dataframe(models,
                       'train_loss', 'test_loss',
                       'train_zdist', 'test_zdist']
 
-    columns = indices + acc_cols + in_out_cols + meas_cols
-    df = pd.DataFrame.from_records([n for n in models if n['set'] == dataset],
+    rows = [flatten_model_dict(n) for n in models if n['set'] == dataset]
+
+    columns = indices + meas_cols
+    df = pd.DataFrame.from_records([{c: n[c] for c in columns if c in n} for n in rows],
                                    columns=columns)
 
     df['batch_norm'] = df['batch_norm'].apply(lambda x: x[0] if x else x)
@@ -215,27 +213,11 @@ def results_dataframe(models,
 
     col_names = ['set', 'method', 'metrics']
 
-    acc_df = unfold_df_from_dict(df['accuracies'], depth=1, names=['method'])
-    acc_df.columns = pd.MultiIndex.from_product([[dataset],
-                                                 acc_df.columns,
-                                                 ['acc']],
-                                                names=col_names)
-
-    # DEBUG
-    # print('ACC\n', *acc_df.columns)
-    in_out_df = unfold_df_from_dict(df['in_out_rates'], depth=3,
-                                    names=col_names,
-                                    keep={'method': ['starred']})
-
-    # DEBUG
-    # print('INOUT\n', *in_out_df.index.names)
-    # print('INOUT\n', *in_out_df.columns)
+    acc_df, in_out_df = _results_cells(rows, dataset, df.index)
 
     meas_df = df[meas_cols]
     meas_df.columns = pd.MultiIndex.from_product([['measures'], [''], meas_df.columns],
                                                  names=col_names)
-    # DEBUG
-    # print('MEAS\n', meas_df.index.names)
 
     df = pd.concat([acc_df, in_out_df, meas_df], axis=1)
 
@@ -610,6 +592,101 @@ def format_df_index(df, float_format='{:.3g}', int_format='{}',
         return df_
 
 
+def _keep_col(keeper, col, *cols):
+    is_in = []
+    startswith = []
+    endswith = []
+    str_cols = [_ for _ in cols if isinstance(_, str)]
+    starred = [_ for _ in str_cols if _.endswith('*')]
+    nonstarred = [_ for _ in str_cols if not any(_.startswith(s[:-1]) for s in starred)]
+    approx = []
+    if not keeper:
+        return True
+    for k in keeper:
+        if isinstance(k, str):
+            if '~' in k:
+                v, a = k.split('~')
+                v = float(v)
+                if not a:
+                    a = v / 1000
+                else:
+                    a = v * float(a)
+                approx.append((v, a))
+            if k.startswith('?'):
+                endswith.append(k[1:])
+            elif k.endswith('?'):
+                startswith.append(k[:-1])
+            elif k == 'starred':
+                is_in.extend(starred)
+                is_in.extend(nonstarred)
+            else:
+                is_in.append(k)
+        else:
+            is_in.append(k)
+
+    if isinstance(col, str):
+        is_kept = (col in is_in
+                   or any(col.startswith(_) for _ in startswith)
+                   or any(col.endswith(_) for _ in endswith))
+        return is_kept
+    elif isinstance(col, (float, int)):
+        return col in is_in or any(abs(col - v) < a for (v, a) in approx)
+    else:
+        return col in is_in
+
+
+def _unfolded_columns(rows, prefix, names, keep=None):
+    """Columns (tuples of keys) of cells of flat rows (see
+    flatten_model_dict) starting with prefix, as unfold_df_from_dict
+    would unfold them: keys are ordered as they first appear, all
+    NaN columns are dropped, and keys are kept by keep
+
+    """
+    keep = keep or {}
+
+    # tree of keys ordered by first appearance, leaves being True if not null
+    tree = {}
+    for r in rows:
+        for k, v in r.items():
+            if not isinstance(k, tuple) or k[0] != prefix:
+                continue
+            node = tree
+            for _ in k[1:-1]:
+                node = node.setdefault(_, {})
+            node[k[-1]] = node.get(k[-1], False) or not (v is None or v != v)
+
+    def _columns(node, level=0):
+        if not isinstance(node, dict):
+            return [()] if node else []
+        return [(k, *c) for k in node if _keep_col(keep.get(names[level]), k, *node)
+                for c in _columns(node[k], level + 1)]
+
+    return [(prefix, *_) for _ in _columns(tree)]
+
+
+def _results_cells(rows, dataset, index):
+    """Frames of accuracies and of in/out rates of flat rows (see
+    flatten_model_dict), with columns (set, method, metrics), as made by
+    unfold_df_from_dict from the dicts of models
+
+    """
+    col_names = ['set', 'method', 'metrics']
+
+    def _cells_df(cols, col_format):
+        cells = pd.DataFrame({col_format(c): [n.get(c) for n in rows] for c in cols}, index=index)
+        cells.columns = pd.MultiIndex.from_tuples(cells.columns, names=col_names)
+        return cells
+
+    acc_df = _cells_df(_unfolded_columns(rows, 'accuracies', names=['method']),
+                       lambda c: (dataset, c[1], 'acc'))
+
+    in_out_df = _cells_df(_unfolded_columns(rows, 'in_out_rates', names=col_names,
+                                            keep={'method': ['starred']}),
+                          lambda c: c[1:])
+
+    return acc_df, in_out_df
+
+
 def unfold_df_from_dict(df, depth=1, names=None, keep=None):
     if not depth:
         if isinstance(df, pd.Series):
@@ -630,48 +707,6 @@ def unfold_df_from_dict(df, depth=1, names=None, keep=None):
     except AttributeError:
         current_keeper = keep
 
-    def keep_col(keeper, col, *cols):
-        is_in = []
-        startswith = []
-        endswith = []
-        str_cols = [_ for _ in cols if isinstance(_, str)]
-        starred = [_ for _ in str_cols if _.endswith('*')]
-        nonstarred = [_ for _ in str_cols if not any(_.startswith(s[:-1]) for s in starred)]
-        approx = []
-        if not keeper:
-            return True
-        for k in keeper:
-            if isinstance(k, str):
-                if '~' in k:
-                    v, a = k.split('~')
-                    v = float(v)
-                    if not a:
-                        a = v / 1000
-                    else:
-                        a = v * float(a)
-                    approx.append((v, a))
-                if k.startswith('?'):
-                    endswith.append(k[1:])
-                elif k.endswith('?'):
-                    startswith.append(k[:-1])
-                elif k == 'starred':
-                    is_in.extend(starred)
-                    is_in.extend(nonstarred)
-                else:
-                    is_in.append(k)
-            else:
-                is_in.append(k)
-
-        if isinstance(col, str):
-            is_kept = (col in is_in
-                       or any(col.startswith(_) for _ in startswith)
-                       or any(col.endswith(_) for _ in endswith))
-            return is_kept
-        elif isinstance(col, (float, int)):
-            return col in is_in or any(abs(col - v) < a for (v, a) in approx)
-        else:
-            return col in is_in
-
     df_ = pd.DataFrame(df.values.tolist(), index=df.index)
     # print('*** in tables:551\n', df_.index.names)
 
@@ -687,7 +722,7 @@ def unfold_df_from_dict(df, depth=1, names=None, keep=None):
         # df_ = df_[non_null_cols].apply(replace_floats, axis=1, result_type='broadcast')
         # print('*** in tables:561\n', df_.index.names)
     unfolded = {_: unfold_df_from_dict(df_[_], depth=depth - 1, names=names[1:], keep=keep)
-                for _ in df_.columns if keep_col(current_keeper, _, *df_.columns)}
+                for _ in df_.columns if _keep_col(current_keeper, _, *df_.columns)}
     try:
         concatenated_df = pd.concat({_: unfolded[_] for _ in unfolded
                                      if unfolded[_] is not None and not unfolded[_].empty},
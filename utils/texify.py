@@ -7,12 +7,14 @@ from module.optimizers import Optimizer
 import torch
 import utils.torch_load as torchdl
 import string
-import pandas as pd
 import numpy as np
+from utils.misc import lazy_import
 from utils.print_log import texify_str
 from datetime import datetime
 from utils.parameters import DEFAULT_RESULTS_DIR
 
+pd = lazy_import('pandas')
+
 
 def bold_best_values(data, value, format_string='{:.1f}', prec=1, highlight='\\bfseries ', max_value=99.9):
 
@@ -1,9 +1,6 @@
 from collections import namedtuple
 from itertools import accumulate
-from torchvision import datasets, transforms
-import torchvision
 import torch
-import matplotlib.pyplot as plt
 from contextlib import contextmanager
 import sys
 import os
@@ -11,15 +8,20 @@ import logging
 import string
 import re
 import collections
+import functools
 import numpy as np
 import torch
-from torchvision.utils import save_image
 from torch.utils.data import Dataset
 import configparser
-from matplotlib import pyplot as plt
+from utils.misc import lazy_import
 # from torch.utils.data._utils import collate
 import time
 
+datasets = lazy_import('torchvision.datasets')
+transforms = lazy_import('torchvision.transforms')
+vutils = lazy_import('torchvision.utils')
+plt = lazy_import('matplotlib.pyplot')
+
 CONF_FILE = 'data/sets.ini'
 
 set_props = None
@@ -145,6 +147,14 @@ def letters_getter(**kw):
     return s
 
 
+def torchvision_getter(name):
+
+    def getter(*a, **kw):
+        return getattr(datasets, name)(*a, **kw)
+
+    return getter
+
+
 target_transforms = {'y-1': lambda y: y - 1}
 
 
@@ -213,43 +223,6 @@ class DTDConcatTestVal(torch.utils.data.ConcatDataset):
         return self.datasets[0].target_transform
 
 
-class ImageFolderWithClassesInFile(datasets.ImageFolder):
-
-    def __init__(self, root, classes_file, *a, **kw):
-
-        logging.debug('Creating dataset in folder {} based on classes listed in {}'.format(root, classes_file))
-        self.root = root
-        self._classes_file = classes_file
-        self._compile_dict()
-
-        super().__init__(root, *a, **kw)
-
-    def _compile_dict(self):
-        self.node_to_idx = {}
-        self.idx_to_class = {}
-        self.idx_to_node = {}
-
-        with open(self._classes_file) as f:
-            i = 0
-            for line in f:
-                if not line.startswith('#'):
-                    splitted_line = line.split()
-                    node = splitted_line[0]
-                    classi = ' '.join(splitted_line[1:])
-                    self.node_to_idx[node] = i
-                    self.idx_to_class[i] = classi
-                    self.idx_to_node[i] = node
-                    i += 1
-
-            self.classes = [self.idx_to_class[i] for i in range(len(self.idx_to_class))]
-            self.nodes = [self.idx_to_node[i] for i in range(len(self.idx_to_class))]
-
-    def find_classes(self, directory):
-
-        classes = self.nodes
-        return classes, self.node_to_idx
-
-
 class ListofTensors(list):
 
     def to(self, device):
@@ -373,8 +346,7 @@ class SubSampledDataset(Dataset):
 
         if self.sampling_mode == 'slice':
             _shifts = rng.integers(0, self._sample_every, self._length) * (self._seed != 0)
-            self._idx = [i * self._sample_every_coarse // self.COARSE + _shifts[i]
-                         for i in range(len(self))]
+            self._idx = np.arange(len(self)) * self._sample_every_coarse // self.COARSE + _shifts
 
         elif self.sampling_mode == 'batch':
             if self._task >= self._sample_every:
@@ -425,6 +397,18 @@ class SubSampledDataset(Dataset):
                 raise IndexError
         return self._dataset[self._idx[idx]]
 
+    def __getitems__(self, indices):
+
+        indices = np.asarray(indices, dtype=int)
+        if len(indices) and indices.max() >= self._length:
+            raise IndexError
+        idx = self._idx[indices].tolist()
+
+        getitems = getattr(self._dataset, '__getitems__', None)
+        if getitems is not None:
+            return getitems(idx)
+        return [self._dataset[_] for _ in idx]
+
 
 class MixtureDataset(Dataset):
 
@@ -485,6 +469,8 @@ class MixtureDataset(Dataset):
             self._mix_ = self._mix
             for d in self._datasets:
                 d.shrink(0)
+            self._cum_lengths = [0] * (len(self._datasets) + 1)
+            self._build_idx()
 
             return
 
@@ -510,6 +496,7 @@ class MixtureDataset(Dataset):
         self._length = sum(self._lengths)
 
         self._cum_lengths = [0] + list(accumulate(self._lengths))
+        self._build_idx()
 
         self._mix_ = [l / self._length for l in self._lengths]
 
@@ -517,6 +504,13 @@ class MixtureDataset(Dataset):
             _s = 'In mixture dataset {}; wanted length: {}, maximum length: {}'
             logging.warning(_s.format('-'.join(self.classes), length, sum(self._lengths)))
 
+    def _build_idx(self):
+        """Build (subset, local index) arrays of length len(self) for O(1) lookups
+
+        """
+        self._which_idx = np.repeat(np.arange(len(self._datasets)), self._lengths)
+        self._sub_idx = np.arange(len(self._which_idx)) - np.repeat(self._cum_lengths[:-1], self._lengths)
+
     def _build_classes_from_dict(self, **datasets):
 
         self._classes = []
@@ -567,11 +561,7 @@ class MixtureDataset(Dataset):
 
     def __geti__(self, idx):
 
-        which, l_ = max((w, l) for w, l in enumerate(self._cum_lengths) if l <= idx)
-
-        sub_idx = idx - l_
-
-        return which, sub_idx
+        return int(self._which_idx[idx]), int(self._sub_idx[idx])
 
     def __getitem__(self, idx):
 
@@ -585,6 +575,29 @@ class MixtureDataset(Dataset):
 
         return x, which
 
+    def __getitems__(self, indices):
+
+        indices = np.asarray(indices, dtype=int)
+        if len(indices) and indices.max() >= len(self):
+            raise IndexError('Idx {} for length {}'.format(indices.max(), len(self)))
+
+        which = self._which_idx[indices]
+        sub_idx = self._sub_idx[indices]
+
+        samples = [None] * len(indices)
+
+        for w in np.unique(which):
+            i_ = np.flatnonzero(which == w)
+            d = self._datasets[w]
+            if hasattr(d, '__getitems__'):
+                xy = d.__getitems__(sub_idx[i_].tolist())
+            else:
+                xy = [d[_] for _ in sub_idx[i_].tolist()]
+            for i, (x, y) in zip(i_, xy):
+                samples[i] = (x, int(w))
+
+        return samples
+
     def __str__(self):
 
         return '\n\n'.join('Subdataset {}: {}\n{}'.format(i, n, d)
@@ -645,9 +658,61 @@ class SubDataset(Dataset):
         return self._dataset[idx_]
 
 
+@functools.lru_cache()
+def _image_folder_with_classes_in_file():
+    """ImageFolderWithClassesInFile is defined on demand, not to import
+    torchvision when loading the module
+
+    """
+
+    class ImageFolderWithClassesInFile(datasets.ImageFolder):
+
+        def __init__(self, root, classes_file, *a, **kw):
+
+            logging.debug('Creating dataset in folder {} based on classes listed in {}'.format(root, classes_file))
+            self.root = root
+            self._classes_file = classes_file
+            self._compile_dict()
+
+            super().__init__(root, *a, **kw)
+
+        def _compile_dict(self):
+            self.node_to_idx = {}
+            self.idx_to_class = {}
+            self.idx_to_node = {}
+
+            with open(self._classes_file) as f:
+                i = 0
+                for line in f:
+                    if not line.startswith('#'):
+                        splitted_line = line.split()
+                        node = splitted_line[0]
+                        classi = ' '.join(splitted_line[1:])
+                        self.node_to_idx[node] = i
+                        self.idx_to_class[i] = classi
+                        self.idx_to_node[i] = node
+                        i += 1
+
+                self.classes = [self.idx_to_class[i] for i in range(len(self.idx_to_class))]
+                self.nodes = [self.idx_to_node[i] for i in range(len(self.idx_to_class))]
+
+        def find_classes(self, directory):
+
+            classes = self.nodes
+            return classes, self.node_to_idx
+
+    return ImageFolderWithClassesInFile
+
+
+def __getattr__(name):
+    if name == 'ImageFolderWithClassesInFile':
+        return _image_folder_with_classes_in_file()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
 def create_image_dataset(classes_file):
 
-    class Dataset(ImageFolderWithClassesInFile):
+    class Dataset(_image_folder_with_classes_in_file()):
 
         def __init__(self, root, *a, **kw):
             super().__init__(root, classes_file, *a, **kw)
@@ -657,14 +722,14 @@ def create_image_dataset(classes_file):
 
 getters = {'const': ConstantDataset,
            'uniform': UniformDataset,
-           'mnist': datasets.MNIST,
-           'fashion': datasets.FashionMNIST,
+           'mnist': torchvision_getter('MNIST'),
+           'fashion': torchvision_getter('FashionMNIST'),
            'letters': letters_getter,
-           'cifar10': datasets.CIFAR10,
-           'cifar100': datasets.CIFAR100,
-           'svhn': datasets.SVHN,
-           'lsunc': datasets.LSUN,
-           'lsunr': datasets.LSUN,
+           'cifar10': torchvision_getter('CIFAR10'),
+           'cifar100': torchvision_getter('CIFAR100'),
+           'svhn': torchvision_getter('SVHN'),
+           'lsunc': torchvision_getter('LSUN'),
+           'lsunr': torchvision_getter('LSUN'),
            'dtd': DTDConcatTestVal,
            }
 
@@ -1117,10 +1182,75 @@ def export_png(imageset, directory, by_class=False):
                 os.makedirs
             filename = os.path.join(image_dir, f'{i:05}.png')
             print(i, c, *image_tensor.shape)
-            save_image(image_tensor, filename)
+            vutils.save_image(image_tensor, filename)
             i += 1
 
 
+def interleaved_batches(iterators, batch_size):
+    """Interleave batches of several sets into one stream of batches of
+    batch_size samples (but the last one), taking one batch of each set
+    in turn
+
+    -- iterators: dict name: iterator of (x, y) batches, x being a
+       tensor or a list of tensors (e.g. a ListofTensors of x and
+       estimated labels)
+
+    Yields x, y and segments, a list of (name, start, end, last) where
+    x[start:end] are samples of set name, last telling whether they are
+    the last ones of the set.
+
+    """
+    heads = {n: next(it, None) for n, it in iterators.items()}
+    heads = {n: h for n, h in heads.items() if h is not None}
+
+    # pieces of not yet yielded samples: name, x, y, last
+    pieces = []
+    n_pieces = 0
+
+    def _is_list(t):
+        return isinstance(t, (list, tuple))
+
+    def _len(t):
+        return len(t[0]) if _is_list(t) else len(t)
+
+    def _slice(t, s):
+        return type(t)(_[s] for _ in t) if _is_list(t) else t[s]
+
+    def _cat(ts):
+        return type(ts[0])(torch.cat(_) for _ in zip(*ts)) if _is_list(ts[0]) else torch.cat(ts)
+
+    def _pop(n):
+        x, y, segments = [], [], []
+        start = 0
+        while start < n:
+            name, x_, y_, last = pieces.pop(0)
+            taken = min(n - start, _len(x_))
+            if taken < _len(x_):
+                pieces.insert(0, (name, _slice(x_, slice(taken, None)), y_[taken:], last))
+            x.append(_slice(x_, slice(None, taken)))
+            y.append(y_[:taken])
+            segments.append((name, start, start + taken, last and taken == _len(x_)))
+            start += taken
+
+        return _cat(x), torch.cat(y), segments
+
+    while heads:
+        for n in list(heads):
+            x, y = heads[n][:2]
+            heads[n] = next(iterators[n], None)
+            if heads[n] is None:
+                heads.pop(n)
+            pieces.append((n, x, y, n not in heads))
+            n_pieces += _len(x)
+
+            while n_pieces >= batch_size:
+                n_pieces -= batch_size
+                yield _pop(batch_size)
+
+    if n_pieces:
+        yield _pop(n_pieces)
+
+
 np_str_obj_array_pattern = re.compile(r'[SaUO]')
 
 collate_err_msg_format = (